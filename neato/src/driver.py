@@ -32,25 +32,46 @@ __author__ = "ferguson@cs.albany.edu (Michael Ferguson)"
 
 import serial
 import rospy
-import roslib
 import time
 import threading
 
 from enum import Enum
-from math import sin, cos, pi
-from tf.broadcaster import TransformBroadcaster
+from math import sin, cos, radians
 from nav_msgs.msg import Odometry
 from geometry_msgs.msg import Twist
-from geometry_msgs.msg import Quaternion
+from geometry_msgs.msg import TransformStamped
+from diagnostic_msgs.msg import DiagnosticArray, DiagnosticStatus, KeyValue
 from neato.msg import ButtonEvent, BumperEvent, Sensors
-from sensor_msgs.msg import LaserScan, BatteryState
+from sensor_msgs.msg import LaserScan, BatteryState, PointCloud2, PointField
+from rospy.numpy_msg import numpy_msg
+from neato_serial import (CaptureWriter, CapturingPort, CommandCoalescer,
+                          CommandEngine, LinkStats, PollScheduler, ReplayPort,
+                          ResponseFramer, afterHeader, monotonic,
+                          requestTime, splitLines)
+from neato_lds import (BEAMS, ROTATION_PERIOD, ScanBuffer, ScanDeskewer,
+                       ScanFilter, ScanView, bodyMask)
+from neato_odom import (POSE_COVARIANCE, TWIST_COVARIANCE, WheelOdometry,
+                        diagonal)
+from neato_sensors import ANALOG, BUTTONS, CHARGER, DIGITAL, ChangePublisher
+from neato_profile import LoopProfiler, NullProfiler, dump
 
 BASE_WIDTH = 248  # millimeters
 MAX_SPEED = 300  # millimeters/second
 CMD_RATE = 2
+LOOP_RATE = 20  # Hz
+SAFETY = 10  # priority of motor commands that must not be overridden
 
 START_LIDAR = rospy.get_param('START_LIDAR', True)
 
+# changes smaller than these are not published on neato/sensors and the
+# battery topic, on top of ~sensors_publish/deadbands and
+# ~battery_publish/deadbands
+SENSOR_DEADBANDS = {"BatteryVoltageInmV": 50, "ChargeVoltInmV": 50,
+                    "CurrentInmA": 20, "VacuumCurrentInmA": 20,
+                    "SideBrushCurrentInmA": 20, "VoltageReferenceInmV": 10,
+                    "AccelXInmG": 20, "AccelYInmG": 20, "AccelZInmG": 20}
+BATTERY_DEADBANDS = {"voltage": 0.05, "current": 0.02}
+
 
 class LED(Enum):
     BacklightOn = "BacklightOn"
@@ -66,14 +87,42 @@ class LED(Enum):
 
 class Neato:
 
-    def __init__(self):
-        """ Start up connection to the Neato Robot. """
-        rospy.init_node('neato')  # ,anonymous = True
+    def __init__(self, name='', loop=None, executor=None):
+        """ Start up connection to the Neato Robot.
+
+            name is set when one process drives several robots (see
+            NeatoHost). It prefixes the topics and TF frames of the robot,
+            and its parameters are read from ~name/ before ~. The serial
+            link then runs on the shared event loop and scans are
+            processed and published on the executor. """
+        started = monotonic()
+        self.name = name
+        self.executor = executor
 
-        port = rospy.get_param('~port', "/dev/ttyACM0")
+        port = self.param('port', "/dev/ttyACM0")
         rospy.loginfo("Using port: %s" % port)
 
-        self.port = serial.Serial(port, 115200, timeout=0.1)
+        if port == "sim":
+            # software robot, see neato_sim.py. The robot is on USB so the
+            # baud rate does not limit it, ~sim_baud simulates a slower link.
+            from neato_sim import SimulatedNeato
+            self.port = SimulatedNeato(
+                port, self.param('sim_baud', 0) or None, timeout=0.1)
+        elif port.startswith("replay:"):
+            # play back what the robot sent in a capture file
+            self.port = ReplayPort(
+                port[len("replay:"):],
+                self.param('replay_realtime', True), timeout=0.1)
+        else:
+            self.port = serial.Serial(port, 115200, timeout=0.1)
+
+        # record all serial traffic to a capture file, see neato_serial.py
+        self.capture = None
+        capture = self.param('capture', '')
+        if capture:
+            self.capture = CaptureWriter(capture)
+            self.port = CapturingPort(self.port, self.capture)
+            rospy.loginfo("Capturing serial traffic to %s" % capture)
 
         if not self.port.isOpen():
             rospy.logerror("Failed To Open Serial Port")
@@ -94,124 +143,294 @@ class Neato:
 
         self.stop_state = True
         self.moving_forward = False
+        self.bumperEngaged = None
         self.lifted = False
 
         # turn things on
-        self.comsData = []
-        self.responseData = []
-        self.currentResponse = []
-
+        # the default engine reads the port from a reader thread, the asyncio
+        # engine (python 3 only) runs the reads on an event loop instead.
+        max_in_flight = self.param('max_in_flight', 4)
+        self.useAsyncio = (loop is not None or
+                           self.param('engine', 'thread') == 'asyncio')
         self.reading = False
-
-        self.readLock = threading.RLock()
-        self.readThread = threading.Thread(None, self.read)
-        self.readThread.start()
-
-        self.port.flushInput()
-        self.sendCmd("\n\n\n")
+        self.scanning = False  # scanLoop runs while set, see spin
+        self.stats = LinkStats()
+
+        if self.useAsyncio:
+            from neato_aio import AsyncCommandEngine
+            self.engine = AsyncCommandEngine(
+                self.port, max_in_flight, stats=self.stats, loop=loop)
+            self.reading = True
+            self.readThread = None
+        else:
+            self.framer = ResponseFramer()
+            self.engine = CommandEngine(
+                self.port, max_in_flight, stats=self.stats)
+            self.readThread = threading.Thread(None, self.read)
+            self.readThread.start()
+
+        # the motor and LED commands of a cycle are coalesced and written
+        # together by self.output.flush(). An unchanged setmotor is only
+        # repeated after ~motor_keepalive seconds, which has to stay below
+        # the one second of travel each setmotor asks for.
+        self.output = CommandCoalescer(
+            self.engine, self.param('motor_keepalive', 0.5))
+        self.output.actuator("motors", self.motorCommand)
+
+        # cmd_vel is sent as soon as it arrives, ahead of the queries
+        # waiting for the link, but no more than ~cmd_vel_rate times a
+        # second. What is held back goes out with the next cycle, as is
+        # everything until the bumpers, drop sensors and charger were read.
+        rate = self.param('cmd_vel_rate', 20.0)
+        self.cmdVelPeriod = 1.0 / rate if rate > 0 else 0.0
+        self.cmdVelDispatched = 0.0  # monotonic time of the last one sent
+        self.cmdVelWaiting = False  # the last cmd_vel is not on the wire yet
+        self.unread = set(("digital", "analog", "charger"))  # not answered yet
+
+        # end any command line a previous run left half sent, then wait for
+        # the neato to answer instead of sleeping
         self.port.flushInput()
+        self.port.write(b"\n")
+        if not self.handshake():
+            rospy.logwarn("Neato did not answer testmode on")
 
-        self.setTestMode("On")
+        # the rest of the start up is pipelined behind it
         self.setLed(LED.BacklightOn)
         self.setLed(LED.LEDGreen)
-
-        time.sleep(0.5)
+        self.output.flush()
+        if START_LIDAR:
+            self.setLdsRotation("On")
+        initial = self.engine.submitMany(
+            [schema.command for schema in (DIGITAL, ANALOG, CHARGER, BUTTONS)])
 
         self.base_width = BASE_WIDTH
         self.max_speed = MAX_SPEED
+        self.odometry = WheelOdometry(self.base_width / 1000.0)
+
+        # ~deskew moves the beams of each scan to the pose halfway through
+        # it using the encoder odometry, see neato_lds.ScanDeskewer.
+        # ~laser_offset is where the LDS sits on base_link (x, y, z).
+        self.deskewer = None
+        if self.param('deskew', False):
+            self.deskewer = ScanDeskewer(
+                self.odometry.posesAt,
+                self.param('laser_offset', [-0.090, 0.0, 0.037]))
+
+        # ~body_mask lists [first, last(, range)] degree sectors where the
+        # LDS sees the robot itself, see neato_lds.bodyMask
+        # ~scan_filter cleans up every scan before it is published, see
+        # neato_lds.ScanFilter: {window: 3, median: false, fill: true,
+        #  outlier: 0.3, min_intensity: 0}
+        config = self.param('scan_filter', {})
+        scan_filter = None
+        if config:
+            scan_filter = ScanFilter(
+                config.get('window', 3), config.get('median', False),
+                config.get('fill', True), config.get('outlier', 0.0),
+                config.get('min_intensity', 0))
+        self.scans = ScanBuffer(
+            bodyMask(self.param('body_mask', [])), scan_filter, self.deskewer)
+
+        # sensor responses are decoded in place, see neato_sensors.py. The
+        # analog and digital sensors go straight into the Sensors message.
+        self.sensors = Sensors()
+        self.buttons = BUTTONS.state()
+        self.charger = CHARGER.state()
+        self.battery = BatteryState()
+        self.battery.power_supply_technology = 1  # POWER_SUPPLY_TECHNOLOGY_NIMH
 
         # set initial read values from neato
-        self.getDigitalSensors()
-        time.sleep(0.5)
-        self.getAnalogSensors()
-        time.sleep(0.5)
-        self.getCharger()
-        time.sleep(0.5)
-        self.getButtons()
-
-        self.flush()
+        self.getDigitalSensors(initial[0])
+        self.getAnalogSensors(initial[1])
+        self.getCharger(initial[2])
+        self.getButtons(initial[3])
 
         # initialize publishers and subscribers
-        rospy.Subscriber("cmd_vel", Twist, self.cmdVelCb)
-        self.scanPub = rospy.Publisher('base_scan', LaserScan, queue_size=10)
-        self.odomPub = rospy.Publisher('odom', Odometry, queue_size=10)
+        rospy.Subscriber(self.topic("cmd_vel"), Twist, self.cmdVelCb)
+        self.odomPub = rospy.Publisher(
+            self.topic('odom'), Odometry, queue_size=10)
         self.batteryPub = rospy.Publisher(
-            'sensor_msgs', BatteryState, queue_size=10)
+            self.topic('sensor_msgs'), BatteryState, queue_size=10, latch=True)
         self.buttonEventPub = rospy.Publisher(
-            'neato/button_event', ButtonEvent, queue_size=10)
+            self.topic('neato/button_event'), ButtonEvent, queue_size=10)
         self.bumperEventPub = rospy.Publisher(
-            'neato/bumper_event', BumperEvent, queue_size=10)
+            self.topic('neato/bumper_event'), BumperEvent, queue_size=10)
         self.sensorsPub = rospy.Publisher(
-            'neato/sensors', Sensors, queue_size=10)
-
+            self.topic('neato/sensors'), Sensors, queue_size=10, latch=True)
+
+        # the sensors and battery state are only published when they change,
+        # no faster than max_rate and at least at min_rate (Hz, 0 for none)
+        self.sensorsPublisher = self.changePublisher(
+            self.sensorsPub, 'sensors_publish',
+            [f[0] for f in ANALOG.fields + DIGITAL.fields], SENSOR_DEADBANDS)
+        self.batteryPublisher = self.changePublisher(
+            self.batteryPub, 'battery_publish',
+            ("voltage", "current", "percentage", "power_supply_status",
+             "power_supply_health", "present"), BATTERY_DEADBANDS)
+
+        # every scan is published on base_scan, and on each topic in
+        # ~scan_views as a subset of the beams (see neato_lds.ScanView):
+        # [{topic: scan_amcl, first: -90, last: 90, step: 2,
+        #   intensities: false}, ...]
+        scan_link = self.param('frame_id', self.frame('base_laser_link'))
+        intensities = self.param('scan_intensities', True)
+        self.scanViews = [self.scanView(
+            self.topic('base_scan'), scan_link, ScanView(intensities=intensities))]
+        for config in self.param('scan_views', []):
+            self.scanViews.append(self.scanView(
+                self.topic(config['topic']), scan_link, ScanView(
+                    config.get('first', 0), config.get('last', BEAMS - 1),
+                    config.get('step', 1),
+                    config.get('intensities', intensities))))
+
+        # the deskewed readings as points in the odom frame on ~deskew_cloud
+        self.cloudPub = None
+        cloud_topic = self.param('deskew_cloud', '')
+        if self.deskewer and cloud_topic:
+            self.cloud = PointCloud2(
+                header=rospy.Header(frame_id=self.frame("odom")), height=1,
+                fields=[PointField(name, 4 * i, PointField.FLOAT32, 1)
+                        for i, name in enumerate("xyz")],
+                is_bigendian=False, point_step=12, is_dense=True)
+            self.cloudPub = rospy.Publisher(
+                self.topic(cloud_topic), PointCloud2, queue_size=10)
+
+        self.diagnosticsPub = rospy.Publisher(
+            '/diagnostics', DiagnosticArray, queue_size=1)
+
+        # Neato cannot handle reads of all sensors every cycle,
+        # reading too much results in errors like:
+        # navigation costmap2DROS transform timeout.
+        # Could not get robot pose.
+        # so each query gets a target rate (Hz) and a priority and
+        # self.poller picks the ones that fit in each cycle.
+        rates = self.param('poll_rates', {})
+        self.poller = PollScheduler(
+            1.0 / LOOP_RATE, self.param('poll_budget', 0.6))
+        self.poller.add("motors", "getmotors", LOOP_RATE, 100, required=True)
+        self.poller.add("digital", "getdigitalsensors",
+                        rates.get("digital", 10), 90)  # bumpers
+        self.poller.add("analog", "getanalogsensors",
+                        rates.get("analog", 5), 50)  # drop and mag sensors
+        self.poller.add("buttons", "GetButtons", rates.get("buttons", 5), 20)
+        self.poller.add("charger", "getcharger", rates.get("charger", 5), 10)
+
+        from tf.broadcaster import TransformBroadcaster  # slow to import
         self.odomBroadcaster = TransformBroadcaster()
         self.cmd_vel = [0, 0]
+        self.cmdVelTime = 0.0  # monotonic time of the last cmd_vel
         self.old_vel = self.cmd_vel
 
-    def spin(self):
-        encoders = [0, 0]
-
-        self.x = 0  # position in xy plane
-        self.y = 0
-        self.th = 0
-        then = rospy.Time.now()
-
-        # things that don't ever change
-        scan_link = rospy.get_param('~frame_id', 'base_laser_link')
-        scan = LaserScan(header=rospy.Header(frame_id=scan_link))
+        # the odometry message and transform are filled in place, they
+        # share the orientation.
+        self.odom = Odometry(header=rospy.Header(frame_id=self.frame("odom")),
+                             child_frame_id=self.frame('base_footprint'))
+        self.odom.pose.covariance = diagonal(POSE_COVARIANCE)
+        self.odom.twist.covariance = diagonal(TWIST_COVARIANCE)
+        self.odomTransform = TransformStamped()
+        self.odomTransform.header.frame_id = self.frame("odom")
+        self.odomTransform.child_frame_id = self.frame("base_footprint")
+        self.odomTransform.transform.rotation = self.odom.pose.pose.orientation
+
+        # odometry is published with every encoder read, or at ~odom_rate
+        # (Hz) extrapolated from the last read when that is faster.
+        self.odomRate = self.param('odom_rate', 0.0)
+        self.odomTimer = None
+
+        # ~profile times every phase of the control and scan loops (see
+        # neato_profile.py), reports their percentiles on /diagnostics and
+        # writes a trace of the last cycles to ~profile_file when the
+        # ~dump_profile service is called.
+        self.profile = NullProfiler()
+        self.scanProfile = NullProfiler()
+        if self.param('profile', False):
+            from std_srvs.srv import Trigger
+            self.profile = LoopProfiler("spin", 1.0 / LOOP_RATE)
+            self.scanProfile = LoopProfiler("scanLoop", ROTATION_PERIOD)
+            self.profileFile = self.param(
+                'profile_file', '/tmp/%s_profile.json' % (self.name or 'neato'))
+            rospy.Service(self.topic('dump_profile'), Trigger,
+                          self.dumpProfile)
+
+        self.stats.startup = monotonic() - started
+        rospy.loginfo("Neato ready in %.2f s" % self.stats.startup)
 
-        scan.angle_min = 0.0
-        scan.angle_max = 359.0 * pi / 180.0
-        scan.angle_increment = pi / 180.0
-        scan.range_min = 0.020
-        scan.range_max = 5.0
+    def spin(self):
+        # the laser is read and published by its own thread (or event loop
+        # task) so a slow scan never holds up odometry and motor commands.
+        scan_rate = self.param('scan_rate', 0.0)
+        self.scanning = True
+        if self.useAsyncio:
+            self.scanThread = None
+            scanTask = self.engine.run(self.engine.link.pollScans(
+                self.scans, self.publishScan, scan_rate, self.executor))
+        else:
+            self.scanThread = threading.Thread(
+                None, self.scanLoop, args=(scan_rate,))
+            self.scanThread.start()
 
-        odom = Odometry(header=rospy.Header(frame_id="odom"),
-                        child_frame_id='base_footprint')
+        if self.odomRate > LOOP_RATE:
+            self.odomTimer = rospy.Timer(
+                rospy.Duration(1.0 / self.odomRate), self.odomTimerCb)
 
         # main loop of driver
-        r = rospy.Rate(20)
+        r = rospy.Rate(LOOP_RATE)
         cycle_count = 0
         self.bumperEngaged = None
+        diagnostics_time = monotonic() + 1
+        profile = self.profile
 
         while not rospy.is_shutdown():
+            cycle_start = monotonic()
+            profile.start()
 
             # Emergency shutdown checks.
-            if int(self.chargerValues["FuelPercent"]) < 10:
-                rospy.logerr("Neato battery is less than 10%. Terminating Node")
-                rospy.signal_shutdown(
-                    "Neato battery is less than 10%. Terminating Node")
+            charger = self.charger
+            if charger.valid and charger.FuelPercent < 10:
+                self.terminate("Neato battery is less than 10%. Terminating Node")
                 break
-            if self.chargerValues["BatteryFailure"] == "1":
-                rospy.logerr("Neato battery failure. Terminating Node")
-                rospy.signal_shutdown(
-                    "Neato battery failure. Terminating Node")
+            if charger.BatteryFailure:
+                self.terminate("Neato battery failure. Terminating Node")
                 break
-            if self.chargerValues["EmptyFuel"] == "1":
+            if charger.EmptyFuel:
                 rospy.logerr("Neato battery is empty. Terminating Node")
                 break
+            profile.mark("emergency checks")
+
+            # send the queries due this cycle so they overlap on the wire,
+            # each response is collected further down.
+            queries = self.poller.select()
+            pending = dict(zip([q.name for q in queries],
+                               self.engine.submitMany(
+                                   [q.command for q in queries])))
+            profile.mark("send queries")
 
             # get motor encoder values
-            left, right = self.getMotors()
+            motors = pending.get("motors") or self.sendCmd("getmotors")
+            encoders = self.getMotors(motors)
+            profile.mark("getMotors")
 
             if not self.lifted and cycle_count % 2 == 0:
 
                 # bumper engaged procedure
-                # left or right bumpers
+                reverse = None
                 if self.moving_forward and self.bumperEngaged == 0:
                     # left bump
-                    self.setMotors(-100, -110, MAX_SPEED/2)
-
-                if self.moving_forward and self.bumperEngaged == 1:
+                    reverse = (-100, -110)
+                elif self.moving_forward and self.bumperEngaged == 1:
                     # right bump
-                    self.setMotors(-110, -100, MAX_SPEED/2)
+                    reverse = (-110, -100)
+                elif self.moving_forward and (self.bumperEngaged or 0) > 1:
+                    # all other bumpers
+                    reverse = (-100, -100)
 
-                # all other bumpers
-                elif self.moving_forward and self.bumperEngaged > 1:
-                    self.setMotors(-100, -100, MAX_SPEED/2)
+                if reverse:
+                    # back off now, without waiting for room in the window
+                    self.setMotors(reverse[0], reverse[1], MAX_SPEED/2, SAFETY)
+                    self.flushOutput(urgent=True)
 
                 # undock proceedure
-                if self.cmd_vel[0] and self.chargerValues["ChargingActive"]:
+                elif self.cmd_vel[0] and self.charger.ChargingActive:
                     self.setMotors(-400, -400, MAX_SPEED/2)
 
                 else:
@@ -219,86 +438,64 @@ class Neato:
                     self.setMotors(self.cmd_vel[0], self.cmd_vel[1],
                                    max(abs(self.cmd_vel[0]), abs(self.cmd_vel[1])))
 
-            self.old_vel = self.cmd_vel
-
-            # prepare laser scan
-            scan.header.stamp = rospy.Time.now()
-
-            self.getldsscan()
-            scan.ranges, scan.intensities = self.getScanRanges()
+                self.flushOutput()
+                profile.mark("setMotors")
 
-            # now update position information
-            dt = (scan.header.stamp - then).to_sec()
-            then = scan.header.stamp
-
-            d_left = (left - encoders[0]) / 1000.0
-            d_right = (right - encoders[1]) / 1000.0
-            encoders = [left, right]
-
-            dx = (d_left + d_right) / 2
-            dth = (d_right - d_left) / (self.base_width / 1000.0)
-
-            x = cos(dth) * dx
-            y = -sin(dth) * dx
-            self.x += cos(self.th) * x - sin(self.th) * y
-            self.y += sin(self.th) * x + cos(self.th) * y
-            self.th += dth
-
-            # prepare tf from base_link to odom
-            quaternion = Quaternion()
-            quaternion.z = sin(self.th / 2.0)
-            quaternion.w = cos(self.th / 2.0)
+            self.old_vel = self.cmd_vel
 
-            # prepare odometry
-            odom.header.stamp = rospy.Time.now()
-            odom.pose.pose.position.x = self.x
-            odom.pose.pose.position.y = self.y
-            odom.pose.pose.position.z = 0
-            odom.pose.pose.orientation = quaternion
-            odom.twist.twist.linear.x = dx / dt
-            odom.twist.twist.angular.z = dth / dt
+            # now update position information. The encoders are stamped
+            # with the time the robot read them.
+            if encoders is not None:
+                odometry = self.odometry
+                odometry.update(encoders[0], encoders[1],
+                                requestTime(motors) or monotonic())
+                profile.mark("odometry")
+                if not self.odomTimer:
+                    self.publishOdometry(
+                        odometry.stamp, (odometry.x, odometry.y, odometry.th),
+                        odometry.v, odometry.w)
+                    profile.mark("publish odometry")
 
             # read sensors and data
-            # Neato cannot handle reads of all sensors every cycle.
-            # use cycle_count to rate limit the reads or
-            # you will get errors like:
-            # navigation costmap2DROS transform timeout.
-            # Could not get robot pose.
-
-            if cycle_count % 2 == 0:
-                self.getDigitalSensors()
+            sensors_refreshed = False
+            if "digital" in pending:
+                if self.getDigitalSensors(pending["digital"]):
+                    sensors_refreshed = True
+                    self.unread.discard("digital")
 
                 for i, b in enumerate(("LSIDEBIT", "RSIDEBIT",
                                        "LFRONTBIT", "RFRONTBIT")):
 
-                    engaged = None
-                    engaged = self.digitalSensors[b]  # Bumper Switches
+                    engaged = getattr(self.sensors, b)  # Bumper Switches
                     self.bumperHandler(b, engaged, i)
+                profile.mark("getDigitalSensors")
 
-            if cycle_count == 2:
-                self.getAnalogSensors()
+            if "analog" in pending:
+                if self.getAnalogSensors(pending["analog"]):
+                    sensors_refreshed = True
+                    self.unread.discard("analog")
 
                 for i, b in enumerate(("LeftDropInMM", "RightDropInMM",
                                        "LeftMagSensor", "RightMagSensor")):
 
-                    engaged = None
                     if i < 2:
                         # Optical Sensors (no drop: ~0-60)
-                        engaged = (self.analogSensors[b] > 100)
+                        engaged = (getattr(self.sensors, b) > 100)
                     else:
                         # Mag Sensors (no mag: ~ +/-20)
-                        engaged = (abs(self.analogSensors[b]) > 20)
+                        engaged = (abs(getattr(self.sensors, b)) > 20)
 
                     self.bumperHandler(b, engaged, i)
+                profile.mark("getAnalogSensors")
 
-            if cycle_count == 1:
-                self.getButtons()
+            if "buttons" in pending:
+                self.getButtons(pending["buttons"])
 
                 # region Publish Button Events
 
                 for i, b in enumerate(("BTN_SOFT_KEY", "BTN_SCROLL_UP", "BTN_START",
                                        "BTN_BACK", "BTN_SCROLL_DOWN")):
-                    engaged = (self.buttons[b] == 1)
+                    engaged = getattr(self.buttons, b)
                     if engaged != self.state[b]:
                         buttonEvent = ButtonEvent()
                         buttonEvent.button = i
@@ -308,58 +505,30 @@ class Neato:
                     self.state[b] = engaged
 
                 # endregion Publish Button Info
+                profile.mark("getButtons")
+
+            battery_refreshed = False
+            if "charger" in pending:
+                battery_refreshed = bool(self.getCharger(pending["charger"]))
+                if battery_refreshed:
+                    self.unread.discard("charger")
+                profile.mark("getCharger")
 
-            if cycle_count == 3:
-                self.getCharger()
-
-                # region Publish Battery Info
-                # pulls data from analogSensors and charger info to publish battery state
-                battery = BatteryState()
-                # http://docs.ros.org/en/api/sensor_msgs/html/msg/BatteryState.html
-
-                power_supply_health = 1  # POWER_SUPPLY_HEALTH_GOOD
-                if self.chargerValues["BatteryOverTemp"]:
-                    power_supply_health = 2  # POWER_SUPPLY_HEALTH_OVERHEAT
-                elif self.chargerValues["EmptyFuel"]:
-                    power_supply_health = 3  # POWER_SUPPLY_HEALTH_DEAD
-                elif self.chargerValues["BatteryFailure"]:
-                    power_supply_health = 5  # POWER_SUPPLY_HEALTH_UNSPEC_FAILURE
-
-                power_supply_status = 3  # POWER_SUPPLY_STATUS_NOT_CHARGING
-                if self.chargerValues["ChargingActive"]:
-                    power_supply_status = 1  # POWER_SUPPLY_STATUS_CHARGING
-                elif (self.chargerValues["FuelPercent"] == 100):
-                    power_supply_status = 4  # POWER_SUPPLY_STATUS_FULL
-
-                battery.voltage = self.analogSensors["BatteryVoltageInmV"] // 1000
-                # battery.temperature = self.analogSensors["BatteryTemp0InC"]
-                battery.current = self.analogSensors["CurrentInmA"] // 1000
-                # battery.charge
-                # battery.capacity
-                # battery.design_capacity
-                battery.percentage = self.chargerValues["FuelPercent"]
-                battery.power_supply_status = power_supply_status
-                battery.power_supply_health = power_supply_health
-                battery.power_supply_technology = 1  # POWER_SUPPLY_TECHNOLOGY_NIMH
-                battery.present = self.chargerValues['FuelPercent'] > 0
-                # battery.cell_voltage
-                # battery.cell_temperature
-                # battery.location
-                # battery.serial_number
-                self.batteryPub.publish(battery)
-
-                # endregion Publish Battery Info
-
-            self.publishSensors()
-            # region publish lidar and odom
-            self.odomBroadcaster.sendTransform(
-                (self.x, self.y, 0),
-                (quaternion.x, quaternion.y, quaternion.z, quaternion.w), then,
-                "base_footprint", "odom")
-            self.scanPub.publish(scan)
-            self.odomPub.publish(odom)
-
-            # endregion publish lidar and odom
+            self.publishBattery(battery_refreshed)
+            profile.mark("publish battery")
+            self.publishSensors(sensors_refreshed)
+            profile.mark("publish sensors")
+
+            for query in queries:
+                self.poller.record(query, pending[query.name])
+
+            if monotonic() >= diagnostics_time:
+                diagnostics_time += 1
+                self.publishDiagnostics()
+                profile.mark("publish diagnostics")
+
+            self.stats.loop(monotonic() - cycle_start, 1.0 / LOOP_RATE)
+            profile.end()
 
             # wait, then do it again
             r.sleep()
@@ -369,76 +538,175 @@ class Neato:
                 cycle_count = 0
 
         # shut down
+        if self.odomTimer:
+            self.odomTimer.shutdown()
+        self.scanning = False  # also when the loop was left by a break
+        if self.scanThread:
+            self.scanThread.join()
+        else:
+            scanTask.cancel()
         self.setLed(LED.BacklightOff)
         self.setLed(LED.ButtonOff)
+        self.output.flush()
         self.setLdsRotation("Off")
         self.testmode("Off")
+        if self.capture:
+            self.capture.close()
+
+    def terminate(self, reason):
+        """ Shut down the node, or only stop this robot when the process
+            drives several. """
+        rospy.logerr(reason)
+        if not self.name:
+            rospy.signal_shutdown(reason)
+
+    def param(self, name, default):
+        """ The private parameter name, looked up under ~self.name/ first
+            when the robot has a name. """
+        if self.name:
+            return rospy.get_param(
+                "~%s/%s" % (self.name, name), rospy.get_param("~" + name, default))
+        return rospy.get_param("~" + name, default)
+
+    def topic(self, name):
+        """ Topic name in the namespace of the robot. """
+        if self.name and not name.startswith("/"):
+            return "%s/%s" % (self.name, name)
+        return name
+
+    def frame(self, frame_id):
+        """ TF frame id prefixed with the name of the robot. """
+        return "%s/%s" % (self.name, frame_id) if self.name else frame_id
+
+    def changePublisher(self, publisher, param, fields, deadbands):
+        """ ChangePublisher for a topic, configured by the param dict with
+            max_rate, min_rate and deadbands (field -> smallest change). """
+        config = self.param(param, {})
+        deadbands = dict(deadbands, **config.get('deadbands', {}))
+        return ChangePublisher(publisher.publish, fields, deadbands,
+                               config.get('max_rate', 0.0),
+                               config.get('min_rate', 1.0))
+
+    def publishSensors(self, refreshed=True):
+        """ Publish the analog and digital sensors decoded into self.sensors
+            if they changed, see self.sensorsPublisher. """
+        sensors = self.sensors
+        self.lifted = (sensors.SNSR_LEFT_WHEEL_EXTENDED or
+                       sensors.SNSR_RIGHT_WHEEL_EXTENDED)
+        self.sensorsPublisher.update(sensors, refreshed)
+
+    def publishBattery(self, refreshed=True):
+        """ Publish the battery state from the charger and analog sensors
+            if it changed, see self.batteryPublisher. """
+        # http://docs.ros.org/en/api/sensor_msgs/html/msg/BatteryState.html
+        charger = self.charger
+        battery = self.battery
+        if not refreshed:
+            self.batteryPublisher.update(battery, False)
+            return
 
-    def publishSensors():
-
-        # region Publish Sensors
-
-        self.sensors = Sensors()
-
-        # for i, s in enumerate(self.analogSensors):
-        #    self.sensors[s] = self.analogSensors[s]
-
-        # for i, s in enumerate(self.digitalSensors):
-        #    self.sensors[s] = self.digitalSensors
-
-        # if you receive an error similar to "KeyError: 'XTemp0InC'" after startup
-        # just comment out the value. It means it's not supported by your neato.
-
-        self.WallSensorInMM = self.analogSensors["WallSensorInMM"]
-        self.sensors.BatteryVoltageInmV = self.analogSensors["BatteryVoltageInmV"]
-        self.sensors.LeftDropInMM = self.analogSensors["LeftDropInMM"]
-        self.sensors.RightDropInMM = self.analogSensors["RightDropInMM"]
-        # self.sensors.XTemp0InC = self.analogSensors["XTemp0InC"]
-        # self.sensors.XTemp1InC = self.analogSensors["XTemp1InC"]
-        self.sensors.LeftMagSensor = self.analogSensors["LeftMagSensor"]
-        self.sensors.RightMagSensor = self.analogSensors["RightMagSensor"]
-        self.sensors.UIButtonInmV = self.analogSensors["UIButtonInmV"]
-        self.sensors.VacuumCurrentInmA = self.analogSensors["VacuumCurrentInmA"]
-        self.sensors.ChargeVoltInmV = self.analogSensors["ChargeVoltInmV"]
-        self.sensors.BatteryTemp0InC = self.analogSensors["BatteryTemp0InC"]
-        self.sensors.BatteryTemp1InC = self.analogSensors["BatteryTemp1InC"]
-        self.sensors.CurrentInmA = self.analogSensors["CurrentInmA"]
-        self.sensors.SideBrushCurrentInmA = self.analogSensors["SideBrushCurrentInmA"]
-        self.sensors.VoltageReferenceInmV = self.analogSensors["VoltageReferenceInmV"]
-        self.sensors.AccelXInmG = self.analogSensors["AccelXInmG"]
-        self.sensors.AccelYInmG = self.analogSensors["AccelYInmG"]
-        self.sensors.AccelZInmG = self.analogSensors["AccelZInmG"]
-
-        self.sensors.SNSR_DC_JACK_CONNECT = self.digitalSensors["SNSR_DC_JACK_CONNECT"]
-        self.sensors.SNSR_DUSTBIN_IS_IN = self.digitalSensors["SNSR_DUSTBIN_IS_IN"]
-        self.sensors.SNSR_LEFT_WHEEL_EXTENDED = self.digitalSensors["SNSR_LEFT_WHEEL_EXTENDED"]
-        self.sensors.SNSR_RIGHT_WHEEL_EXTENDED = self.digitalSensors[
-            "SNSR_RIGHT_WHEEL_EXTENDED"]
-        self.sensors.LSIDEBIT = self.digitalSensors["LSIDEBIT"]
-        self.sensors.LFRONTBIT = self.digitalSensors["LFRONTBIT"]
-        self.sensors.RSIDEBIT = self.digitalSensors["RSIDEBIT"]
-        self.sensors.RFRONTBIT = self.digitalSensors["RFRONTBIT"]
-
-        self.lifted = (
-            self.sensors.SNSR_LEFT_WHEEL_EXTENDED or self.sensors.SNSR_RIGHT_WHEEL_EXTENDED)
-
-        self.sensorsPub.publish(self.sensors)
-
-        # endregion Publish Sensors
+        battery.power_supply_health = 1  # POWER_SUPPLY_HEALTH_GOOD
+        if charger.BatteryOverTemp:
+            battery.power_supply_health = 2  # POWER_SUPPLY_HEALTH_OVERHEAT
+        elif charger.EmptyFuel:
+            battery.power_supply_health = 3  # POWER_SUPPLY_HEALTH_DEAD
+        elif charger.BatteryFailure:
+            battery.power_supply_health = 5  # POWER_SUPPLY_HEALTH_UNSPEC_FAILURE
+
+        battery.power_supply_status = 3  # POWER_SUPPLY_STATUS_NOT_CHARGING
+        if charger.ChargingActive:
+            battery.power_supply_status = 1  # POWER_SUPPLY_STATUS_CHARGING
+        elif charger.FuelPercent == 100:
+            battery.power_supply_status = 4  # POWER_SUPPLY_STATUS_FULL
+
+        battery.voltage = self.sensors.BatteryVoltageInmV / 1000.0
+        battery.current = self.sensors.CurrentInmA / 1000.0
+        battery.percentage = charger.FuelPercent / 100.0  # 0 to 1
+        battery.present = charger.FuelPercent > 0
+        self.batteryPublisher.update(battery)
+
+    def publishDiagnostics(self):
+        """ Publish the achieved polling rates and the serial link
+            statistics (see self.stats.snapshot()) on /diagnostics. """
+        robot = self.name or "neato"
+        status = DiagnosticStatus(name="%s: polling" % robot,
+                                  hardware_id=robot)
+        status.level = DiagnosticStatus.OK
+        status.message = "OK"
+        status.values = []
+        for query, rate in self.poller.rates():
+            status.values.append(KeyValue(
+                "%s rate (Hz)" % query.name, "%.1f" % rate))
+            status.values.append(KeyValue(
+                "%s target rate (Hz)" % query.name, "%.1f" % query.rate))
+            status.values.append(KeyValue(
+                "%s link time (ms)" % query.name,
+                "%.1f" % ((query.cost or 0) * 1000)))
+            if rate < query.rate * 0.5:
+                status.level = DiagnosticStatus.WARN
+                status.message = "Polling below target rate"
+
+        link = DiagnosticStatus(name="%s: serial link" % robot,
+                                hardware_id=robot)
+        link.level = DiagnosticStatus.OK
+        link.message = "OK"
+        values = self.stats.snapshot()
+        link.values = [KeyValue(k, "%g" % values[k]) for k in sorted(values)]
+        if self.stats.timeouts or self.stats.overruns:
+            link.level = DiagnosticStatus.WARN
+            link.message = "%d timeouts, %d loop overruns" % (
+                self.stats.timeouts, self.stats.overruns)
+
+        diagnostics = DiagnosticArray(status=[status, link])
+        for profile in (self.profile, self.scanProfile):
+            if profile.enabled and profile.cycles:
+                diagnostics.status.append(self.profileStatus(robot, profile))
+        diagnostics.header.stamp = rospy.Time.now()
+        self.diagnosticsPub.publish(diagnostics)
+
+    def dumpProfile(self, req):
+        """ ~dump_profile service: write the profiled loop phases to
+            self.profileFile, see neato_profile.dump. """
+        from std_srvs.srv import TriggerResponse
+        try:
+            dump(self.profileFile, [self.profile, self.scanProfile])
+        except (IOError, OSError) as ex:
+            return TriggerResponse(False, str(ex))
+        return TriggerResponse(True, self.profileFile)
+
+    def profileStatus(self, robot, profile):
+        """ DiagnosticStatus with the phase timings of a LoopProfiler. """
+        status = DiagnosticStatus(name="%s: %s profile" % (robot, profile.name),
+                                  hardware_id=robot)
+        status.level = DiagnosticStatus.OK
+        status.message = "OK"
+        status.values = [
+            KeyValue("cycles", str(profile.cycles)),
+            KeyValue("overruns", str(profile.overruns)),
+            KeyValue("worst cycle (ms)", "%.1f" % (profile.worst / 1e6))]
+        for phase, (p50, p95, p99), worst in profile.percentiles():
+            status.values.append(KeyValue(
+                "%s p50/p95/p99/max (ms)" % phase,
+                "%.2f/%.2f/%.2f/%.2f" % (p50, p95, p99, worst)))
+        if profile.overruns:
+            status.level = DiagnosticStatus.WARN
+            status.message = "%d of %d cycles overran" % (
+                profile.overruns, profile.cycles)
+        return status
 
     def bumperHandler(self, name, engaged, i):
         if engaged != self.state[name]:
 
             # set bumper
-            if not this.bumperEngaged:
-                this.bumperEngaged = bumperIndex
+            if not self.bumperEngaged:
+                self.bumperEngaged = i
 
             # clear bumper
-            elif this.bumperEngaged == bumperIndex and not engaged:
-                this.bumperEngaged = None
+            elif self.bumperEngaged == i and not engaged:
+                self.bumperEngaged = None
 
             bumperEvent = BumperEvent()
-            bumperEvent.bumper = bumperIndex
+            bumperEvent.bumper = i
             bumperEvent.engaged = engaged
             # rospy.loginfobumperEvent)
             self.bumperEventPub.publish(bumperEvent)
@@ -451,6 +719,42 @@ class Neato:
         else:
             return -1
 
+    def publishOdometry(self, t, pose, v, w):
+        """ Publish odometry and the base_footprint to odom transform for
+            pose (x, y, th) and velocities v, w at monotonic time t. """
+        stamp = self.rosTime(t)
+        x, y, th = pose
+        odom = self.odom
+        odom.header.stamp = stamp
+        odom.pose.pose.position.x = x
+        odom.pose.pose.position.y = y
+        odom.pose.pose.orientation.z = sin(th / 2)
+        odom.pose.pose.orientation.w = cos(th / 2)
+        odom.twist.twist.linear.x = v
+        odom.twist.twist.angular.z = w
+        transform = self.odomTransform
+        transform.header.stamp = stamp
+        transform.transform.translation.x = x
+        transform.transform.translation.y = y
+        self.odomBroadcaster.sendTransformMessage(transform)
+        self.odomPub.publish(odom)
+
+    def odomTimerCb(self, event):
+        """ Publish odometry extrapolated to now from the last encoder read,
+            at the commanded velocity if cmd_vel changed since that read. """
+        now = monotonic()
+        odometry = self.odometry
+        if odometry.stamp is None:
+            return
+        v, w = odometry.v, odometry.w
+        if self.cmdVelTime > odometry.stamp:
+            # wheel speeds in mm/s
+            left, right = self.cmd_vel
+            v = (left + right) / 2000.0
+            w = (right - left) / 1000.0 / odometry.baseWidth
+        pose = odometry.predict(now, (v, w))
+        self.publishOdometry(now, pose, v, w)
+
     def cmdVelCb(self, req):
         x = req.linear.x * 1000
         th = req.angular.z * (self.base_width / 2)
@@ -462,10 +766,37 @@ class Neato:
             th = th * self.max_speed / k
 
         self.cmd_vel = [int(x - th), int(x + th)]
+        self.cmdVelTime = monotonic()
+        self.cmdVelWaiting = True
+
+        # bumps, lifts and undocking are left to spin(), which also has to
+        # read the sensors they are detected with first
+        if (self.unread or self.lifted or self.bumperEngaged is not None or
+                self.charger.ChargingActive or
+                self.cmdVelTime - self.cmdVelDispatched < self.cmdVelPeriod):
+            return
+        self.cmdVelDispatched = self.cmdVelTime
+        self.setMotors(self.cmd_vel[0], self.cmd_vel[1],
+                       max(abs(self.cmd_vel[0]), abs(self.cmd_vel[1])))
+        self.flushOutput(urgent=True)
+
+    def flushOutput(self, urgent=False):
+        """ Send the queued motor and LED commands, recording how long the
+            last cmd_vel took to get on the wire. """
+        self.output.flush(urgent=urgent)
+        if self.cmdVelWaiting:
+            last = self.output.last.get("motors")
+            if last and last.sent is None:
+                return  # not written yet (asyncio engine), see next flush
+            self.cmdVelWaiting = False
+            if last and last.sent >= self.cmdVelTime:
+                self.stats.command("cmd_vel_to_wire",
+                                   last.sent - self.cmdVelTime)
 
     def exit(self):
         self.setLdsRotation("Off")
         self.setLed(LED.ButtonOff)
+        self.output.flush()
 
         time.sleep(1)
 
@@ -473,10 +804,23 @@ class Neato:
         self.port.flush()
 
         self.reading = False
-        self.readThread.join()
+        if self.readThread:
+            self.readThread.join()
+        else:
+            self.engine.cancel()
 
         self.port.close()
 
+    def handshake(self, timeout=2.0):
+        """ Send testmode on until the neato echoes it back, which also
+            skips past anything a previous run left unanswered.
+            Returns False if it did not answer within timeout seconds. """
+        deadline = monotonic() + timeout
+        while monotonic() < deadline:
+            if self.sendCmd("testmode On").raw(0.25) is not None:
+                return True
+        return False
+
     def testmode(self, value):
         """ Turn test mode on/off. """
         self.sendCmd("testmode " + value)
@@ -486,63 +830,101 @@ class Neato:
 
     def getldsscan(self):
         """ Ask neato for an array of scan reads. """
-        self.sendCmd("getldsscan")
-
-    def getScanRanges(self):
-        """ Read values of a scan -- call requestScan first! """
-        ranges = list()
-        intensities = list()
-
-        angle = 0
-
-        if not self.readTo("AngleInDegrees"):
-            self.flush()
-            return ranges, intensities
-
-        last = False
-        while not last:  # angle < 360:
-            try:
-                vals, last = self.getResponse()
-            except Exception as ex:
-                rospy.logerr("Exception Reading Neato lidar: " + str(ex))
-                last = True
-                vals = []
-
-            vals = vals.split(",")
-
-            if ((not last) and ord(vals[0][0]) >= 48
-                    and ord(vals[0][0]) <= 57):
-                # rospy.loginfo(angle, vals)
-                try:
-                    a = int(vals[0])
-                    r = int(vals[1])
-                    i = int(vals[2])
-                    e = int(vals[3])
-
-                    while (angle < a):
-                        ranges.append(0)
-                        intensities.append(0)
-                        angle += 1
-
-                    if (e == 0):
-                        ranges.append(r / 1000.0)
-                        intensities.append(i)
-                    else:
-                        ranges.append(0)
-                        intensities.append(0)
-                except:
-                    ranges.append(0)
-                    intensities.append(0)
-
-                angle += 1
-
-        if len(ranges) != 360:
-            rospy.loginfo("Missing laser scans: got %d points" % len(ranges))
-
-        return ranges, intensities
-
-    def setMotors(self, l, r, s):
-        """ Set motors, distance left & right + speed """
+        self.scanRequest = self.sendCmd("getldsscan")
+        return self.scanRequest
+
+    def getScanRanges(self, pending=None):
+        """ Read values of a scan -- call getldsscan first!
+            Returns the ranges and intensities arrays of the scan, which
+            also becomes self.scans.latest. """
+        pending = pending or self.scanRequest
+        frame = self.readFrame(pending) or b""
+
+        scan = self.scans.parse(frame, pending)
+        if scan.count != 360:
+            rospy.loginfo("Missing laser scans: got %d points" % scan.count)
+
+        return scan.ranges, scan.intensities
+
+    # thread to read and publish laser scans
+    # polls the LDS at rate, or at the rotation speed the LDS reports when that is 0
+    # the newest scan is left in self.scans.latest for the other threads
+    def scanLoop(self, rate):
+        profile = self.scanProfile
+        while self.scanning and self.reading and not rospy.is_shutdown():
+            start = monotonic()
+            profile.start()
+
+            pending = self.getldsscan()
+            profile.mark("getldsscan")
+            self.getScanRanges(pending)
+            profile.mark("getScanRanges")
+            self.publishScan(self.scans.latest)
+            profile.mark("publishScan")
+            profile.end()
+
+            hz = rate or self.scans.latest.rotationSpeed or 5.0
+            delay = start + 1.0 / hz - monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+    def scanView(self, topic, frame_id, view):
+        """ The (view, LaserScan, publisher) publishing a ScanView. """
+        scan = numpy_msg(LaserScan)(header=rospy.Header(frame_id=frame_id))
+        scan.angle_min = radians(view.first)
+        scan.angle_increment = radians(view.step)
+        scan.angle_max = scan.angle_min + (len(view.ranges) - 1) * scan.angle_increment
+        scan.range_min = 0.020
+        scan.range_max = 5.0
+        publisher = rospy.Publisher(topic, numpy_msg(LaserScan), queue_size=10)
+        return view, scan, publisher
+
+    def publishScan(self, scan):
+        """ Publish a scan read into self.scans on base_scan and the
+            ~scan_views topics that have subscribers. """
+        self.stats.scan(scan.count)
+
+        perBeam = scan.scanTime / BEAMS
+        for i, (view, msg, publisher) in enumerate(self.scanViews):
+            if i and not publisher.get_num_connections():
+                continue
+            view.update(scan)
+            if scan.deskewed is not None:
+                # every beam is as seen from the pose at scan.deskewed
+                msg.header.stamp = self.rosTime(scan.deskewed)
+                msg.time_increment = 0.0
+            else:
+                msg.header.stamp = self.rosTime(
+                    scan.start + view.indices[0] * perBeam)
+                # the beams of a view through 0 are not in the order measured
+                msg.time_increment = 0.0 if view.wraps else perBeam * view.step
+            msg.scan_time = scan.scanTime
+            msg.ranges = view.ranges
+            msg.intensities = view.intensities
+            publisher.publish(msg)
+
+        if (self.cloudPub and scan.deskewed is not None and
+                self.cloudPub.get_num_connections()):
+            count = self.deskewer.count
+            cloud = self.cloud
+            cloud.header.stamp = self.rosTime(scan.deskewed)
+            cloud.width = count
+            cloud.row_step = 12 * count
+            cloud.data = self.deskewer.points[:count].tobytes()
+            self.cloudPub.publish(cloud)
+
+    def rosTime(self, t):
+        """ ROS time of a monotonic time t. """
+        return rospy.Time.from_sec(rospy.get_time() - (monotonic() - t))
+
+    def setMotors(self, l, r, s, priority=0):
+        """ Set motors, distance left & right + speed. Sent by the next
+            self.output.flush(), unless a command of a higher priority
+            is set before then. """
+        self.output.set("motors", (l, r, s), priority)
+
+    def motorCommand(self, l, r, s):
+        """ The setmotor command line for the motor values sent. """
         # This is a work-around for a bug in the Neato API. The bug is that the
         # robot won't stop instantly if a 0-velocity command is sent - the robot
         # could continue moving for up to a second. To work around this bug, the
@@ -559,26 +941,21 @@ class Neato:
 
         self.moving_forward = (l > 0 or r > 0)
 
-        self.sendCmd("setmotor" + " lwheeldist " + str(int(l)) +
-                     " rwheeldist " + str(int(r)) + " speed " + str(int(s)))
+        return ("setmotor" + " lwheeldist " + str(int(l)) +
+                " rwheeldist " + str(int(r)) + " speed " + str(int(s)))
 
-    def getMotors(self):
+    def getMotors(self, pending=None):
         """ Update values for motors in the self.state dictionary.
-            Returns current left, right encoder values. """
-
-        self.sendCmd("getmotors")
+            Returns current left, right encoder values, None on a timeout. """
 
-        if not self.readTo("Parameter"):
-            self.flush()
-            return [0, 0]
+        lines = self.readResponse(
+            pending or self.sendCmd("getmotors"), "Parameter")
+        if lines is None:
+            return None
 
-        last = False
-        while not last:
-            # for i in range(len(xv11_motor_info)):
+        for line in lines:
             try:
-                vals, last = self.getResponse()
-                # rospy.loginfo(vals,last)
-                values = vals.split(",")
+                values = line.split(",")
                 self.state[values[0]] = float(values[1])
             except Exception as ex:
                 rospy.logerr("Exception Reading Neato motors: " + str(ex))
@@ -588,248 +965,138 @@ class Neato:
             self.state["RightWheel_PositionInMM"]
         ]
 
-    def getAnalogSensors(self):
-        """ Update values for analog sensors in the self.state dictionary. """
-
-        self.sendCmd("getanalogsensors")
-
-        if not self.readTo("SensorName"):
-            self.flush()
-            return
-
-        last = False
-        analogSensors = {}
-        while not last:  # for i in range(len(xv11_analog_sensors)):
-            try:
-                vals, last = self.getResponse()
-                values = vals.split(",")
-                # self.state[values[0]] = int(values[1])
-                analogSensors[values[0]] = int(values[1])
-            except Exception as ex:
-                rospy.logerr("Exception Reading Neato Analog sensors: " +
-                             str(ex))
-
-        if analogSensors:
-            self.analogSensors = analogSensors
-
-        return analogSensors
-
-    def getDigitalSensors(self):
-        """ Update values for digital sensors in the self.state dictionary. """
-
-        self.sendCmd("getdigitalsensors")
-
-        if not self.readTo("Digital Sensor Name"):
-            self.flush()
-            return {}
-
-        last = False
-        digitalSensors = {}
-        while not last:  # for i in range(len(xv11_digital_sensors)):
-            try:
-                vals, last = self.getResponse()
-                # rospy.loginfo(vals)
-                values = vals.split(",")
-                # rospy.loginfo("Got Sensor: %s=%s" %(values[0],values[1]))
-                # self.state[values[0]] = int(values[1])
-                digitalSensors[values[0]] = int(values[1])
-            except Exception as ex:
-                rospy.logerr("Exception Reading Neato Digital sensors: " +
-                             str(ex))
-
-        if digitalSensors:
-            self.digitalSensors = digitalSensors
-
-        return digitalSensors
+    def getSensors(self, schema, state, pending=None):
+        """ Decode the response to a sensor query into state, see
+            neato_sensors.py. Returns the number of values decoded. """
+        frame = self.readFrame(pending or self.sendCmd(schema.command))
+        if frame is None:
+            return 0
+        return schema.parse(frame, state)
 
-    def getButtons(self):
-        """ Get button values from neato. """
+    def getAnalogSensors(self, pending=None):
+        """ Update the analog sensors in self.sensors. """
+        return self.getSensors(ANALOG, self.sensors, pending)
 
-        self.sendCmd("GetButtons")
+    def getDigitalSensors(self, pending=None):
+        """ Update the digital sensors in self.sensors. """
+        return self.getSensors(DIGITAL, self.sensors, pending)
 
-        if not self.readTo("Button Name"):
-            self.flush()
-            return {}
+    def getButtons(self, pending=None):
+        """ Update the buttons in self.buttons. """
+        return self.getSensors(BUTTONS, self.buttons, pending)
 
-        last = False
-        buttons = {}
-        while not last:
-            vals, last = self.getResponse()
-            values = vals.split(",")
-            try:
-                # self.state[values[0]] = (values[1] == '1')
-                buttons[values[0]] = (values[1] == '1')
-            except Exception as ex:
-                rospy.logerr("Exception Reading Neato button info: " +
-                             str(ex))
-
-        if buttons:
-            self.buttons = buttons
-
-        return buttons
-
-    def getCharger(self):
-        """ Update values for charger/battery related info in self.state dictionary. """
-
-        self.sendCmd("getcharger")
-
-        if not self.readTo("Label"):
-            self.flush()
-            return
-
-        last = False
-        chargerValues = {}
-        while not last:  # for i in range(len(xv11_charger_info)):
-
-            vals, last = self.getResponse()
-            values = vals.split(",")
-            try:
-                if values[0] in ["VBattV", "VExtV"]:
-                    # convert to millivolt to maintain as int and become mVBattV & mVExtV.
-                    # self.state['m' + values[0]] = int(float(values[1]) * 100)
-                    chargerValues['m' + values[0]] = int(
-                        float(values[1]) * 100)
-                elif values[0] in ["BatteryOverTemp", "ChargingActive", "ChargingEnabled", "ConfidentOnFuel", "OnReservedFuel", "EmptyFuel", "BatteryFailure", "ExtPwrPresent"]:
-                    # boolean values
-                    # self.state[values[0]] = (values[1] == '1')
-                    chargerValues[values[0]] = (values[1] == '1')
-                elif values[0] in ["FuelPercent", "MaxPWM", "PWM"]:
-                    # int values
-                    # self.state[values[0]] = int(values[1])
-                    chargerValues[values[0]] = int(values[1])
-                # other values not supported.
-
-            except Exception as ex:
-                rospy.logerr("Exception Reading Neato charger info: " +
-                             str(ex))
-
-        if chargerValues:
-            self.chargerValues = chargerValues
-        return chargerValues
+    def getCharger(self, pending=None):
+        """ Update the charger/battery info in self.charger. """
+        return self.getSensors(CHARGER, self.charger, pending)
 
     def setLed(self, command):
-        self.sendCmd("setled %s" % command)
+        """ Set a LED, sent by the next self.output.flush(). The backlight
+            and the button each take the last command set for them. """
+        name = getattr(command, "value", command)
+        actuator = name
+        for group in ("Backlight", "Button"):
+            if name.startswith(group):
+                actuator = group
+        self.output.set(actuator, "setled %s" % name)
 
     def sendCmd(self, cmd):
+        """ Send a command, returns a CommandFuture for its response. """
         # rospy.loginfo("Sent command: %s"%cmd)
-        self.port.write("%s\n" % cmd)
-
-    def readTo(self, tag, timeout=1):
-        try:
-            line, last = self.getResponse(timeout)
-        except:
-            return False
-
-        if line == "":
-            return False
-
-        while line.split(",")[0] != tag:
-            try:
-                line, last = self.getResponse(timeout)
-                if line == "":
-                    return False
-            except:
-                return False
-
-        return True
+        return self.engine.submit(cmd)
+
+    # wait for the response to a command sent with sendCmd
+    # returns the lines following the header line whose first field is tag
+    # returns None if the response timed out, was lost or has no such header
+    def readFrame(self, pending, timeout=1):
+        """ Wait for the response frame of a command, None on a timeout. """
+        frame = pending.raw(timeout)
+        if frame is None:
+            rospy.loginfo("Time Out: %s" % pending.command)
+            self.stats.timeouts += 1
+        return frame
+
+    def readResponse(self, pending, tag, timeout=1):
+        frame = self.readFrame(pending, timeout)
+        if frame is None:
+            return None
+
+        return afterHeader(splitLines(frame), tag)
 
     # thread to read data from the serial port
-    # buffers each line in a list (self.comsData)
-    # when an end of response (^Z) is read, adds the complete list of response lines to self.responseData and resets the comsData list for the next command response.
+    # pulls whatever is waiting in the OS buffer and hands it to self.framer
+    # when an end of response (^Z) is read, the complete response frame is handed to the command engine to complete the command it belongs to.
     def read(self):
         self.reading = True
-        line = ""
 
         while (self.reading and not rospy.is_shutdown()):
             try:
-                # read from serial 1 char at a time so we can parse each character
-                val = self.port.read(1)
+                # read everything that is buffered, or block (up to the port
+                # timeout) for the next byte when the port is idle
+                val = self.port.read(self.port.in_waiting or 1)
             except Exception as ex:
                 rospy.logerr("Exception Reading Neato Serial: " + str(ex))
-                val = []
+                val = b""
 
             if len(val) > 0:
-                '''
-                if ord(val[0]) < 32:
-                    rospy.loginfo"'%s'"% hex(ord(val[0])))
-                else:
-                    rospy.loginfo"'%s'"%str(val))
-                '''
-
-                if ord(val[0]) == 13:  # ignore the CRs
-                    pass
-
-                elif ord(val[0]) == 26:  # ^Z (end of response)
-                    if len(line) > 0:
-                        # add last line to response set if it is not empty
-                        self.comsData.append(line)
-                        # rospy.loginfo"Got Last Line: %s" % line)
-                        line = ""  # clear the line buffer for the next line
-
-                    # rospy.loginfo("Got Last")
-                    with self.readLock:  # got the end of the command response so add the full set of response data as a new item in self.responseData
-                        self.responseData.append(list(self.comsData))
-
-                    self.comsData = [
-                    ]  # clear the bucket for the lines of the next command response
-
-                # NL, terminate the current line and add it to the response data list (comsData) (if it is not a blank line)
-                elif ord(val[0]) == 10:
-                    if len(line) > 0:
-                        self.comsData.append(line)
-                        # rospy.loginfo"Got Line: %s" % line)
-                        line = ""  # clear the bufer for the next line
-                else:
-                    line = line + val  # add the character to the current line buffer
-
-    # read response data for a command
-    # returns tuple (line,last)
-    # line is one complete line of text from the command response
-    # last = true if the line was the last line of the response data (indicated by a ^Z from the neato)
-    # returns the next line of data from the buffer.
-    # if the line was the last line last = true
-    # if no data is avaialable and we timeout returns line=""
-    def getResponse(self, timeout=1):
-
-        # if we don't have any data in currentResponse, wait for more data to come in (or timeout)
-        while (len(self.currentResponse)
-               == 0) and (not rospy.is_shutdown()) and timeout > 0:
-
-            # pop a new response data list out of self.responseData (should contain all data lines returned for the last sent command)
-            with self.readLock:
-                if len(self.responseData) > 0:
-                    self.currentResponse = self.responseData.pop(0)
-                    # rospy.loginfo("New Response Set")
-                else:
-                    self.currentResponse = []  # no data to get
-
-            if len(self.currentResponse
-                   ) == 0:  # nothing in the buffer so wait (or until timeout)
-                time.sleep(0.010)
-                timeout = timeout - 0.010
-
-        # default to nothing to return
-        line = ""
-        last = False
-
-        # if currentResponse has data pop the next line
-        if not len(self.currentResponse) == 0:
-            line = self.currentResponse.pop(0)
-            # rospy.loginfo(line,len(self.currentResponse))
-            if len(self.currentResponse) == 0:
-                last = True  # if this was the last line in the response set the last flag
-        else:
-            rospy.loginfo("Time Out")  # no data so must have timedout
-        # rospy.loginfo("Got Response: %s, Last: %d" %(line,last))
-        return (line, last)
+                self.stats.bytesIn += len(val)
+                frames = self.framer.feed(val)
+                if frames:  # got the end of one or more command responses
+                    self.engine.dispatch(frames, self.framer.starts)
+
+        self.engine.cancel()
+
+
+class NeatoHost:
+    """ Drives several robots from one process.
+
+        ~robots lists their names, each robot is configured by the
+        parameters under ~name/ (falling back to ~) and publishes under
+        name/. All serial links share one event loop, and scans are
+        processed and published on a shared pool of ~publish_threads
+        threads. Every robot runs its control loop in its own thread so a
+        slow link only holds up its own robot. """
+
+    def __init__(self, names):
+        import concurrent.futures
+        from neato_aio import loopThread
+        self.names = names
+        self.loop, self.loopThread = loopThread()
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            rospy.get_param('~publish_threads', min(4, len(names))))
+        self.robots = {}
+
+    def run(self, name):
+        try:
+            robot = Neato(name, self.loop, self.executor)
+            self.robots[name] = robot
+            robot.spin()
+        except Exception as ex:
+            rospy.logerr("Neato %s stopped: %s" % (name, ex))
+        finally:
+            robot = self.robots.get(name)
+            if robot:
+                # let its shutdown commands be answered, and its tasks end,
+                # before the loop is stopped
+                robot.engine.cancel()
 
-    def flush(self):
-        while (1):
-            l, last = self.getResponse(1)
-            if l == "":
-                return
+    def spin(self):
+        threads = [threading.Thread(None, self.run, args=(name,))
+                   for name in self.names]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.executor.shutdown()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loopThread.join()
+        self.loop.close()
 
 
 if __name__ == "__main__":
-    robot = Neato()
-    robot.spin()
+    rospy.init_node('neato')  # ,anonymous = True
+    names = rospy.get_param('~robots', [])
+    if names:
+        NeatoHost(names).spin()
+    else:
+        robot = Neato()
+        robot.spin()
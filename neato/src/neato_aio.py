@@ -0,0 +1,302 @@
+"""
+neato_aio.py is an asyncio based alternative to the reader thread and
+CommandEngine of neato_serial.py. It needs python 3.
+
+One event loop reads the serial port through a non-blocking file descriptor
+reader, dispatches the response frames and runs polling tasks such as the
+laser scan loop. The synchronous driver API talks to it through
+AsyncCommandEngine, which has the same interface as CommandEngine. The
+sensor queries are still picked and sent by Neato.spin() through that
+facade, only the scan loop runs as a task on the loop.
+"""
+
+import asyncio
+import concurrent.futures
+import threading
+
+from neato_serial import CommandEngine, ResponseFramer, monotonic, splitLines
+
+
+class AsyncCommand:
+    """ A command waiting for its response on the event loop. """
+
+    def __init__(self, command):
+        self.command = command
+        self.sent = None  # monotonic time the command was written
+        self.started = None  # monotonic time the response began arriving
+        self.received = None
+        self.frame = None
+        self.future = None  # awaited on the loop, created by send
+        self.done = concurrent.futures.Future()  # waited on by other threads
+
+    def set(self, frame):
+        if frame is not None:
+            self.received = monotonic()
+        self.frame = frame
+        if self.future is not None and not self.future.done():
+            self.future.set_result(frame)
+        if not self.done.done():
+            self.done.set_result(frame)
+
+
+class AsyncNeatoLink(CommandEngine):
+    """ Serial link to the Neato driven by an asyncio event loop.
+
+        Response frames are matched to commands exactly like CommandEngine
+        does, but everything runs on the loop so no reader thread is needed.
+        All methods must be called from the loop. """
+
+    def __init__(self, port, maxInFlight=4, timeout=1, stats=None):
+        CommandEngine.__init__(self, port, maxInFlight, timeout, stats)
+        self.framer = ResponseFramer()
+        self.slots = None
+        self.fd = None
+        self.poller = None
+        self.tasks = set()  # coroutines run for other threads, see tracked
+
+    def start(self):
+        """ Start reading the port, call once the loop is running. """
+        self.slots = asyncio.Semaphore(self.maxInFlight)
+        loop = asyncio.get_event_loop()
+        try:
+            fd = self.port.fileno()
+        except (AttributeError, ValueError):
+            fd = None
+
+        if fd is not None:
+            self.fd = fd
+            loop.add_reader(fd, self.onReadable)
+        else:
+            # not backed by a file descriptor, read from the executor
+            self.poller = loop.create_task(self.pollPort())
+
+    def stop(self):
+        """ Stop reading the port and fail every pending command. """
+        if self.fd is not None:
+            asyncio.get_event_loop().remove_reader(self.fd)
+            self.fd = None
+        if self.poller:
+            self.poller.cancel()
+        self.cancel()
+
+    async def tracked(self, coro):
+        """ Run coro as one of the tasks close waits for. """
+        task = asyncio.current_task()
+        self.tasks.add(task)
+        try:
+            return await coro
+        finally:
+            self.tasks.discard(task)
+
+    async def close(self, timeout=None):
+        """ Give the commands still being sent up to timeout seconds to be
+            answered, then stop the link and cancel its remaining tasks,
+            returning once they have finished. """
+        tasks = list(self.tasks)
+        if tasks:
+            await asyncio.wait(tasks, timeout=self.timeout
+                               if timeout is None else timeout)
+        self.stop()
+        tasks = [task for task in self.tasks if not task.done()]
+        if self.poller:
+            tasks.append(self.poller)
+            self.poller = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def onReadable(self):
+        try:
+            data = self.port.read(self.port.in_waiting or 1)
+        except Exception:
+            data = b""
+        if data:
+            self.stats.bytesIn += len(data)
+            self.dispatch(self.framer.feed(data), self.framer.starts)
+
+    async def pollPort(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            data = await loop.run_in_executor(None, self.port.read, 4096)
+            if data:
+                self.stats.bytesIn += len(data)
+                self.dispatch(self.framer.feed(data), self.framer.starts)
+
+    async def command(self, cmd, timeout=None):
+        """ Send a command and wait for its response frame (bytes, without
+            the echoed command line). Returns None on a timeout. """
+        return (await self.request(cmd, timeout)).frame
+
+    async def request(self, cmd, timeout=None):
+        """ Send a command and wait for its response.
+            Returns the AsyncCommand, its frame is None on a timeout. """
+        return (await self.requestMany([cmd], timeout))[0]
+
+    async def requestMany(self, cmds, timeout=None, urgent=False):
+        """ Send several commands in one write and wait for their responses.
+            Returns the AsyncCommands, frames are None on a timeout.
+            Urgent commands do not wait for a free slot. """
+        return await self.send([AsyncCommand(cmd) for cmd in cmds], timeout,
+                               urgent)
+
+    async def send(self, entries, timeout=None, urgent=False):
+        """ requestMany for AsyncCommands made by the caller, each one is
+            completed as soon as its own response is matched. """
+        loop = asyncio.get_event_loop()
+        for entry in entries:
+            entry.future = loop.create_future()
+        slots = 0 if urgent else min(len(entries), self.maxInFlight)
+        for _ in range(slots):
+            await self.slots.acquire()
+        try:
+            data = "".join("%s\n" % entry.command
+                           for entry in entries).encode("ascii")
+            with self.lock:
+                sent = monotonic()
+                for entry in entries:
+                    entry.sent = sent
+                    self.pending.append(entry)
+                self.port.write(data)
+            self.stats.bytesOut += len(data)
+            self.stats.writes += 1
+            try:
+                await asyncio.wait_for(
+                    asyncio.gather(*[asyncio.shield(entry.future)
+                                     for entry in entries]),
+                    timeout or self.timeout)
+            except asyncio.TimeoutError:
+                # give up on the unanswered ones like waitForSlots does, so
+                # they neither stay pending nor take a later response
+                with self.lock:
+                    for entry in entries:
+                        if entry.frame is None and entry in self.pending:
+                            self.pending.remove(entry)
+                            entry.set(None)
+                            self.stats.lost += 1
+            return entries
+        finally:
+            for _ in range(slots):
+                self.slots.release()
+
+    async def getLdsScan(self, scans):
+        """ Read a scan into a neato_lds.ScanBuffer, returns the scan. """
+        entry = await self.request("getldsscan")
+        return scans.parse(entry.frame or b"", entry)
+
+    async def pollScans(self, scans, publish, rate=0.0, executor=None):
+        """ Read scans forever, handing each one to publish.
+            Polls at rate, or at the rotation speed of the LDS when it is 0.
+            With an executor the scans are parsed and published on it,
+            keeping that work off the loop shared with other links. """
+        loop = asyncio.get_event_loop()
+        while True:
+            start = monotonic()
+            if executor is None:
+                scan = await self.getLdsScan(scans)
+                publish(scan)
+            else:
+                entry = await self.request("getldsscan")
+                scan = await loop.run_in_executor(
+                    executor, self.parseAndPublish, scans, entry, publish)
+
+            hz = rate or scan.rotationSpeed or 5.0
+            await asyncio.sleep(max(0.0, start + 1.0 / hz - monotonic()))
+
+    @staticmethod
+    def parseAndPublish(scans, entry, publish):
+        """ Parse the response to a getldsscan into scans and publish it. """
+        scan = scans.parse(entry.frame or b"", entry)
+        publish(scan)
+        return scan
+
+
+def loopThread():
+    """ A new event loop running in a daemon thread of its own.
+        Returns the loop and the thread. """
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(None, loop.run_forever)
+    thread.daemon = True
+    thread.start()
+    return loop, thread
+
+
+class PendingCommand:
+    """ CommandFuture interface for a command sent on the event loop. """
+
+    def __init__(self, entry):
+        self.entry = entry  # the AsyncCommand on the loop
+        self.command = entry.command
+
+    # the times are those of the entry, so sent stays None until the loop
+    # has written the command
+    @property
+    def sent(self):
+        return self.entry.sent
+
+    @property
+    def started(self):
+        return self.entry.started
+
+    @property
+    def received(self):
+        return self.entry.received
+
+    def raw(self, timeout=1):
+        try:
+            return self.entry.done.result(timeout)
+        except (concurrent.futures.TimeoutError,
+                concurrent.futures.CancelledError):
+            return None
+
+    def result(self, timeout=1):
+        frame = self.raw(timeout)
+        if frame is None:
+            return None
+        return splitLines(frame)
+
+
+class AsyncCommandEngine:
+    """ Synchronous CommandEngine facade over an AsyncNeatoLink running in
+        its own event loop thread, which replaces the reader thread.
+
+        Several engines can share one loop (see loopThread) by passing it
+        in, cancelling one then only stops its own link. """
+
+    def __init__(self, port, maxInFlight=4, timeout=1, stats=None, loop=None):
+        self.link = AsyncNeatoLink(port, maxInFlight, timeout, stats)
+        self.stats = self.link.stats
+        if loop is None:
+            self.loop, self.thread = loopThread()
+        else:
+            self.loop, self.thread = loop, None
+        self.closed = False
+        self.loop.call_soon_threadsafe(self.link.start)
+
+    def submit(self, cmd):
+        """ Send a command, returns a PendingCommand for its response. """
+        return self.submitMany([cmd])[0]
+
+    def submitMany(self, cmds, urgent=False):
+        """ Send several commands in one write, returns their
+            PendingCommands. """
+        entries = [AsyncCommand(cmd) for cmd in cmds]
+        self.run(self.link.send(entries, urgent=urgent))
+        return [PendingCommand(entry) for entry in entries]
+
+    def run(self, coro):
+        """ Schedule a coroutine on the event loop, returns its future. """
+        return asyncio.run_coroutine_threadsafe(self.link.tracked(coro),
+                                                self.loop)
+
+    def cancel(self):
+        """ Close the link, waiting for its tasks to finish, then stop and
+            close the event loop unless it is shared. """
+        if self.closed:
+            return
+        self.closed = True
+        asyncio.run_coroutine_threadsafe(self.link.close(),
+                                         self.loop).result()
+        if self.thread is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
@@ -0,0 +1,392 @@
+"""
+neato_lds.py decodes the laser distance sensor (LDS) scans of the Neato.
+
+Like neato_serial.py it does not depend on ROS.
+"""
+
+import numpy as np
+
+from neato_serial import monotonic, requestTime
+
+BEAMS = 360  # one reading per degree
+ROTATION_PERIOD = 0.2  # seconds per rotation when the LDS does not say
+
+HEADER = b"AngleInDegrees"
+ROTATION_SPEED = b"ROTATION_SPEED"
+
+# the error code column is hex, only whether it is zero matters so the hex
+# letters are mapped to a digit to let the whole body be parsed as decimals.
+_HEX_TO_DIGIT = bytearray(range(256))
+for _c in bytearray(b"ABCDEFabcdef"):
+    _HEX_TO_DIGIT[_c] = ord("1")
+_HEX_TO_DIGIT = bytes(_HEX_TO_DIGIT)
+
+_NUMBER_CHARS = b"0123456789,-\n"
+
+
+class ScanParser:
+    """ Decodes getldsscan responses into fixed 360 element arrays.
+
+        The same ranges (meters) and intensities arrays are refilled by every
+        call to parse, readings with an error code or missing from the
+        response are left at 0. """
+
+    def __init__(self):
+        self.ranges = np.zeros(BEAMS, np.float32)
+        self.intensities = np.zeros(BEAMS, np.float32)
+        self.count = 0  # number of readings in the last response
+        self.rotationSpeed = 0.0  # revolutions per second reported by the LDS
+        self.start = None  # monotonic time of the first reading
+        self.scanTime = ROTATION_PERIOD  # seconds between first and last reading
+        self.deskewed = None  # monotonic time the beams were moved to
+
+    def parse(self, frame):
+        """ Decode a getldsscan response frame (bytes).
+            Returns the number of readings it contained. """
+        self.ranges.fill(0)
+        self.intensities.fill(0)
+        self.count = 0
+
+        start = frame.find(HEADER)
+        if start < 0:
+            return 0
+        start = frame.find(b"\n", start) + 1
+
+        end = frame.find(ROTATION_SPEED, start)
+        if end < 0:
+            end = len(frame)
+        else:
+            try:
+                speed = frame[end:].split(b"\n", 1)[0].split(b",")[1]
+                self.rotationSpeed = float(speed)
+            except (IndexError, ValueError):
+                pass
+
+        # one line per reading: angle,distance in mm,intensity,error code
+        body = frame[start:end].translate(_HEX_TO_DIGIT, b"\r ").strip(b"\n")
+        if not body:
+            return 0
+
+        readings = None
+        values = body.replace(b"\n", b",")
+        if not values.translate(None, _NUMBER_CHARS) and b",," not in values:
+            readings = np.fromstring(values, dtype=np.int32, sep=",")
+            if readings.size % 4:
+                readings = None
+        if readings is None:
+            readings = self.parseLines(body)  # malformed line(s)
+        else:
+            readings = readings.reshape(-1, 4)
+
+        angles = readings[:, 0]
+        valid = (angles >= 0) & (angles < BEAMS) & (readings[:, 3] == 0)
+        angles = angles[valid]
+        self.ranges[angles] = readings[valid, 1] * 0.001
+        self.intensities[angles] = readings[valid, 2]
+
+        self.count = len(readings)
+        return self.count
+
+    def applyMask(self, mask):
+        """ Zero the readings closer than mask, a per beam range array. """
+        masked = self.ranges < mask
+        self.ranges[masked] = 0
+        self.intensities[masked] = 0
+
+    def parseLines(self, body):
+        """ Slow path for a response with malformed lines, which are skipped. """
+        readings = []
+        for line in body.split(b"\n"):
+            fields = line.split(b",")
+            if len(fields) != 4:
+                continue
+            try:
+                readings.append([int(f) for f in fields])
+            except ValueError:
+                pass
+        return np.array(readings, dtype=np.int32).reshape(-1, 4)
+
+
+def scanTiming(command, rotationSpeed):
+    """ Estimate when the readings of a getldsscan response were taken.
+        Returns the monotonic time of the first reading and the seconds
+        one rotation takes.
+
+        The Neato answers with the last complete rotation of the LDS at the
+        time it gets the command (see neato_serial.requestTime). That
+        rotation ended anywhere up to a rotation earlier, half of one on
+        average. """
+    period = 1.0 / rotationSpeed if rotationSpeed > 0 else ROTATION_PERIOD
+    requested = requestTime(command)
+    if requested is None:
+        requested = monotonic()
+    return requested - 1.5 * period, period
+
+
+def bodyMask(sectors):
+    """ Per beam range array for ScanParser.applyMask from a list of
+        [first, last] or [first, last, range] sectors: readings between the
+        first and last angle (degrees, may wrap through 0) closer than range
+        meters, or any range, are returns from the robot itself. None if
+        there are no sectors. """
+    if not sectors:
+        return None
+    mask = np.zeros(BEAMS, np.float32)
+    for sector in sectors:
+        first, last = int(sector[0]) % BEAMS, int(sector[1]) % BEAMS
+        limit = sector[2] if len(sector) > 2 else np.inf
+        beams = (first + np.arange((last - first) % BEAMS + 1)) % BEAMS
+        mask[beams] = np.maximum(mask[beams], limit)
+    return mask
+
+
+class ScanView:
+    """ A decimated and/or angle limited subset of the scan beams.
+
+        The view covers first to last degrees (may be negative, or wrap
+        through 0) taking every step-th beam. Its arrays are refilled by
+        every call to update. """
+
+    def __init__(self, first=0, last=BEAMS - 1, step=1, intensities=True):
+        # a last before first (350 to 10) wraps through 0
+        count = (last - first) % BEAMS // step + 1
+        self.first = first  # angle of the first beam in degrees
+        self.step = step
+        self.indices = (first + step * np.arange(count)) % BEAMS
+        self.wraps = bool(np.any(np.diff(self.indices) < 0))
+        self.ranges = np.zeros(count, np.float32)
+        self.intensities = np.zeros(count if intensities else 0, np.float32)
+
+    def update(self, scan):
+        """ Copy the view out of a ScanParser. """
+        np.take(scan.ranges, self.indices, out=self.ranges)
+        if len(self.intensities):
+            np.take(scan.intensities, self.indices, out=self.intensities)
+
+
+class ScanFilter:
+    """ Cleans up scans using the last few scans and the neighbouring beams.
+
+        apply works in place on the arrays of a ScanParser. Readings weaker
+        than minIntensity are dropped, as are single beams more than outlier
+        meters from both neighbours (0 disables it). The result goes into a
+        ring buffer of the last window scans, then the beams without a
+        reading are filled with the median of the readings the ring has for
+        them (fill), or every beam is replaced by that median (median).
+        Filled beams get the mean intensity of those readings.
+
+        The ring and scratch arrays are allocated once. Filtering over time
+        smears moving obstacles, and the whole scan while the robot turns,
+        so the window should stay small. """
+
+    def __init__(self, window=3, median=False, fill=True, outlier=0.0,
+                 minIntensity=0):
+        self.window = window
+        self.median = median
+        self.fill = fill
+        self.outlier = outlier
+        self.minIntensity = minIntensity
+        # one row per scan, oldest overwritten first, 0 is no reading
+        self.ranges = np.zeros((window, BEAMS), np.float32)
+        self.intensities = np.zeros((window, BEAMS), np.float32)
+        self.head = 0  # row the next scan goes in
+        self.rejected = 0  # readings dropped from the last scan
+        self.filled = 0  # holes filled in the last scan
+
+        self.sorted = np.zeros((window, BEAMS), np.float32)
+        self.medianRanges = np.zeros(BEAMS, np.float32)
+        self.meanIntensities = np.zeros(BEAMS, np.float32)
+        self.counts = np.zeros(BEAMS, np.intp)
+        self.beams = np.arange(BEAMS)
+        self.previous = (self.beams - 1) % BEAMS
+        self.next = (self.beams + 1) % BEAMS
+
+    def apply(self, scan):
+        """ Filter the ranges and intensities of a ScanParser in place. """
+        ranges, intensities = scan.ranges, scan.intensities
+        before = np.count_nonzero(ranges)
+
+        if self.minIntensity:
+            weak = intensities < self.minIntensity
+            ranges[weak] = 0
+            intensities[weak] = 0
+
+        if self.outlier:
+            # a reading with no neighbours at all counts as an outlier too
+            isolated = (
+                (np.abs(ranges - ranges[self.previous]) > self.outlier) &
+                (np.abs(ranges - ranges[self.next]) > self.outlier))
+            ranges[isolated] = 0
+            intensities[isolated] = 0
+
+        valid = np.count_nonzero(ranges)
+        self.rejected = before - valid
+        self.ranges[self.head] = ranges
+        self.intensities[self.head] = intensities
+        self.head = (self.head + 1) % self.window
+
+        if self.median:
+            self.temporalMedian()
+            np.copyto(ranges, self.medianRanges)
+            np.copyto(intensities, self.meanIntensities)
+            self.filled = np.count_nonzero(ranges) - valid
+        elif self.fill and valid < BEAMS:
+            self.temporalMedian()
+            holes = ranges == 0
+            np.copyto(ranges, self.medianRanges, where=holes)
+            np.copyto(intensities, self.meanIntensities, where=holes)
+            self.filled = np.count_nonzero(ranges) - valid
+        else:
+            self.filled = 0
+
+    def temporalMedian(self):
+        """ Per beam median of the readings in the ring into medianRanges,
+            and their mean intensity into meanIntensities. 0 where the ring
+            has no reading. """
+        counts = self.counts
+        np.sum(self.ranges > 0, axis=0, out=counts)
+
+        # sorting the missing readings to the end leaves the median of the
+        # count readings of a beam at rows (count - 1) // 2 and count // 2
+        s = self.sorted
+        np.copyto(s, self.ranges)
+        s[s == 0] = np.inf
+        s.sort(axis=0)
+        low = s[np.maximum(counts - 1, 0) // 2, self.beams]
+        high = s[np.minimum(counts // 2, self.window - 1), self.beams]
+        np.add(low, high, out=self.medianRanges)
+        self.medianRanges *= 0.5
+        self.medianRanges[counts == 0] = 0
+
+        np.sum(self.intensities, axis=0, out=self.meanIntensities)
+        self.meanIntensities /= np.maximum(counts, 1)
+
+    def reset(self):
+        """ Forget the scans in the ring. """
+        self.ranges.fill(0)
+        self.intensities.fill(0)
+        self.head = 0
+        self.rejected = self.filled = 0
+
+
+class ScanDeskewer:
+    """ Moves every beam of a scan to where the LDS was halfway through the
+        rotation, undoing the skew of a scan taken while the robot moves.
+
+        poses(times) returns the x, y, th arrays of the robot pose at an
+        array of monotonic times (None if unknown), offset is the (x, y, z)
+        of the LDS on the robot. The moved readings are binned to the
+        nearest degree, the nearest one wins where two land on one beam.
+        The odom frame points of the last scan are left in
+        points[:count]. """
+
+    def __init__(self, poses, offset=(0.0, 0.0, 0.0), minMotion=1e-3):
+        self.poses = poses
+        self.offset = offset
+        self.minMotion = minMotion  # meters or radians, below it beams stay
+        self.beams = np.arange(BEAMS)
+        angles = np.radians(self.beams)
+        self.cos = np.cos(angles)
+        self.sin = np.sin(angles)
+        self.ranges = np.zeros(BEAMS, np.float32)
+        self.intensities = np.zeros(BEAMS, np.float32)
+        self.points = np.zeros((BEAMS, 3), np.float32)
+        self.points[:, 2] = offset[2]
+        self.count = 0
+
+    def apply(self, scan):
+        """ Deskew the ranges and intensities of a ScanParser in place.
+            Returns False if the poses during the scan are unknown. """
+        reference = scan.start + scan.scanTime / 2
+        poses = self.poses(scan.start + self.beams * (scan.scanTime / BEAMS))
+        if poses is None:
+            self.count = 0
+            return False
+        xr, yr, thr = self.poses(reference)
+
+        # each reading in the odom frame, from the pose at its beam's time
+        valid = np.flatnonzero(scan.ranges)
+        ranges = scan.ranges[valid]
+        ox, oy, _ = self.offset
+        lx = ranges * self.cos[valid] + ox
+        ly = ranges * self.sin[valid] + oy
+        x, y, th = (p[valid] for p in poses)
+        c, s = np.cos(th), np.sin(th)
+        wx = x + c * lx - s * ly
+        wy = y + s * lx + c * ly
+        self.count = len(valid)
+        self.points[:self.count, 0] = wx
+        self.points[:self.count, 1] = wy
+
+        scan.deskewed = reference
+        if not self.count or max(np.ptp(poses[0]), np.ptp(poses[1]),
+                                 np.ptp(poses[2])) < self.minMotion:
+            return True
+
+        # and back into the LDS frame at the reference pose
+        c, s = np.cos(thr), np.sin(thr)
+        dx, dy = wx - xr, wy - yr
+        px = c * dx + s * dy - ox
+        py = c * dy - s * dx - oy
+        moved = np.hypot(px, py).astype(np.float32)
+        beams = np.rint(np.degrees(np.arctan2(py, px))).astype(np.intp) % BEAMS
+
+        out = self.ranges
+        out.fill(np.inf)
+        np.minimum.at(out, beams, moved)
+        nearest = out[beams] == moved
+        self.intensities.fill(0)
+        self.intensities[beams[nearest]] = scan.intensities[valid][nearest]
+        out[out == np.inf] = 0
+        np.copyto(scan.ranges, out)
+        np.copyto(scan.intensities, self.intensities)
+        return True
+
+
+class ScanBuffer:
+    """ Double buffered hand-off of the newest scan from the thread reading
+        the LDS to any other thread.
+
+        Each scan is parsed into the back buffer, which then becomes latest by
+        swapping a reference, so readers never wait on the scan thread and a
+        scan they hold is not overwritten until two scans later.
+
+        The filter starts over when the LDS stops or more than maxGap
+        seconds pass between scans, instead of filling the holes of a scan
+        from readings taken somewhere else. """
+
+    def __init__(self, mask=None, scanFilter=None, deskewer=None, maxGap=1.0):
+        self.buffers = [ScanParser(), ScanParser()]
+        self.back = 0
+        self.latest = None
+        self.mask = mask  # see bodyMask
+        self.filter = scanFilter  # ScanFilter applied to every scan
+        self.deskewer = deskewer  # ScanDeskewer applied before the filter
+        self.maxGap = maxGap
+        self.filtered = None  # start of the last scan filtered
+
+    def parse(self, frame, command=None):
+        """ Decode a getldsscan response and make it the latest scan.
+            Its start and scan time come from the timing of its command. """
+        scan = self.buffers[self.back]
+        scan.parse(frame)
+        scan.start, scan.scanTime = scanTiming(command, scan.rotationSpeed)
+        scan.deskewed = None
+        if self.mask is not None:
+            scan.applyMask(self.mask)
+        if self.deskewer is not None:
+            self.deskewer.apply(scan)
+        if self.filter is not None:
+            if not scan.rotationSpeed or not scan.ranges.any():
+                # stopped or spinning up, nothing to filter
+                self.filter.reset()
+                self.filtered = None
+            else:
+                if (self.filtered is not None and
+                        scan.start - self.filtered > self.maxGap):
+                    self.filter.reset()
+                self.filter.apply(scan)
+                self.filtered = scan.start
+        self.latest = scan
+        self.back ^= 1
+        return scan
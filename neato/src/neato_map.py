@@ -0,0 +1,287 @@
+"""
+neato_map.py builds occupancy grid maps offline from recorded laser scans
+and odometry, in the format map_server loads (see scripts/build_map.py).
+
+Each scan is first matched against the one before it to correct the
+odometry between them, then against the window of scans before it as
+placed by those corrections, and finally all scans are ray cast into the
+grid. Each match in a pass only depends on the poses from the pass before,
+not on the other matches, so they can be spread over processes, and so can
+the ray casting since grids add up.
+
+Like neato_serial.py it does not depend on ROS.
+"""
+
+import os
+
+import numpy as np
+
+# map_server cell thresholds, as written by map_saver
+OCCUPIED_THRESH = 0.65
+FREE_THRESH = 0.196
+
+# pgm values of map_saver for occupied, free and unknown cells
+OCCUPIED = 0
+FREE = 254
+UNKNOWN = 205
+
+
+def compose(a, b):
+    """ Pose b (x, y, th) relative to pose a, in the frame a is in. """
+    c, s = np.cos(a[2]), np.sin(a[2])
+    return (a[0] + c * b[0] - s * b[1], a[1] + s * b[0] + c * b[1],
+            a[2] + b[2])
+
+
+def relative(a, b):
+    """ Pose b in the frame of pose a, the inverse of compose. """
+    c, s = np.cos(a[2]), np.sin(a[2])
+    dx, dy = b[0] - a[0], b[1] - a[1]
+    return c * dx + s * dy, -s * dx + c * dy, b[2] - a[2]
+
+
+def transform(points, pose):
+    """ (n, 2) points moved from the frame of pose into its parent frame. """
+    c, s = np.cos(pose[2]), np.sin(pose[2])
+    x, y = points[:, 0], points[:, 1]
+    return np.column_stack((pose[0] + c * x - s * y, pose[1] + s * x + c * y))
+
+
+def scanPoints(ranges, angles, offset=(0.0, 0.0), minRange=0.02,
+               maxRange=5.0):
+    """ The readings of a scan as (n, 2) float32 points on base_link, for a
+        laser at offset (x, y) on it. Readings outside [minRange, maxRange]
+        (0 is no return on the Neato) are dropped. """
+    ranges = np.asarray(ranges, np.float64)
+    valid = (ranges >= minRange) & (ranges <= maxRange)
+    r, a = ranges[valid], np.asarray(angles)[valid]
+    return np.column_stack((r * np.cos(a) + offset[0],
+                            r * np.sin(a) + offset[1])).astype(np.float32)
+
+
+def keyframes(poses, distance=0.05, angle=0.05):
+    """ Indices of the poses (an (n, 3) array) that moved more than distance
+        meters or angle radians from the previous one kept. A robot standing
+        still records the same scan over and over, matching and ray casting
+        them all only costs time. """
+    if not len(poses):
+        return []
+    kept = [0]
+    last = poses[0]
+    for i in range(1, len(poses)):
+        pose = poses[i]
+        if (np.hypot(pose[0] - last[0], pose[1] - last[1]) > distance or
+                abs(pose[2] - last[2]) > angle):
+            kept.append(i)
+            last = pose
+    return kept
+
+
+class LikelihoodField:
+    """ How close every cell of a grid is to the points it was built from,
+        1 on a point falling off as a gaussian of width sigma, for scoring
+        how well other points lie on them. margin meters of zeros are kept
+        around the points so a search can step that far outside. """
+
+    def __init__(self, points, resolution=0.02, sigma=0.04, margin=0.2):
+        self.resolution = resolution
+        radius = int(np.ceil(2 * sigma / resolution))
+        pad = radius + int(np.ceil(margin / resolution)) + 1
+        self.origin = points.min(axis=0) - pad * resolution
+        cells = np.floor((points - self.origin) / resolution).astype(np.int64)
+        self.shape = tuple(cells.max(axis=0)[::-1] + pad + 1)  # rows, cols
+
+        hits = np.zeros(self.shape, np.float32)
+        hits[cells[:, 1], cells[:, 0]] = 1.0
+
+        # the gaussian is separable and the cells are 0 or 1, so the max of
+        # the neighbours weighted by it can be taken along x and then y.
+        weights = np.exp(-0.5 * (np.arange(-radius, radius + 1) *
+                                 resolution / sigma) ** 2)
+        field = hits
+        for axis in (0, 1):
+            spread = np.zeros_like(field)
+            for offset, weight in zip(range(-radius, radius + 1), weights):
+                np.maximum(spread, np.roll(field, offset, axis) * weight,
+                           out=spread)
+            field = spread
+        self.field = field
+
+    def cells(self, points):
+        """ Column and row of the cells points fall in. """
+        cells = np.floor((points - self.origin) / self.resolution)
+        return cells[:, 0].astype(np.int64), cells[:, 1].astype(np.int64)
+
+
+def matchScan(field, points, guess, search=0.1, angle=0.1, angleStep=0.005):
+    """ Pose near guess (x, y, th) that lays points (on base_link) best on
+        the field, searching search meters and angle radians around guess.
+
+        A correlative search: every heading in angleStep steps, and for each
+        every shift by whole cells, is scored. Returns the pose and its
+        score (the mean field value under the points, 1 is a perfect fit). """
+    resolution = field.resolution
+    steps = int(round(search / resolution))
+    shifts = np.arange(-steps, steps + 1)
+    dx, dy = np.meshgrid(shifts, shifts)
+    dx, dy = dx.ravel(), dy.ravel()
+    rows, cols = field.shape
+    flat = field.field.ravel()
+
+    best = (-1.0, guess)
+    for dth in np.arange(-angle, angle + angleStep / 2, angleStep):
+        pose = (guess[0], guess[1], guess[2] + dth)
+        col, row = field.cells(transform(points, pose))
+        # points that stay on the grid however they are shifted
+        inside = ((col >= steps) & (col < cols - steps) &
+                  (row >= steps) & (row < rows - steps))
+        index = row[inside] * cols + col[inside]
+        scores = flat[index[None, :] + (dy * cols + dx)[:, None]].sum(axis=1)
+        i = int(np.argmax(scores))
+        score = scores[i] / max(len(points), 1)
+        if score > best[0]:
+            grid = scores.reshape(len(shifts), len(shifts))
+            row, col = divmod(i, len(shifts))
+            best = (score, (
+                guess[0] + (dx[i] + peak(grid[row, col - 1:col + 2])) *
+                resolution,
+                guess[1] + (dy[i] + peak(grid[row - 1:row + 2, col])) *
+                resolution, pose[2]))
+    return best[1], best[0]
+
+
+def peak(scores):
+    """ Offset (-0.5 to 0.5) of the top of the parabola through three
+        scores around a maximum, 0 at the edge of a search. """
+    if len(scores) != 3:
+        return 0.0
+    curvature = scores[0] - 2 * scores[1] + scores[2]
+    if curvature >= 0:
+        return 0.0
+    return float(np.clip(0.5 * (scores[0] - scores[2]) / curvature,
+                         -0.5, 0.5))
+
+
+def matchWindow(window, points, guess, minScore=0.3, **options):
+    """ Pose of a scan near guess that fits it best to the scans before it.
+
+        window lists the (points, pose) of the scans it is matched against
+        and points are the readings of the scan, all (n, 2) arrays on
+        base_link. Returns guess when the match scores below minScore or
+        there is too little to match. options are passed to matchScan. """
+    reference = [transform(scan, pose) for scan, pose in window if len(scan)]
+    if not reference or len(points) < 10:
+        return tuple(guess)
+    field = LikelihoodField(np.concatenate(reference),
+                            margin=options.get("search", 0.1))
+    pose, score = matchScan(field, points, guess, **options)
+    return pose if score >= minScore else tuple(guess)
+
+
+def chain(start, steps):
+    """ Absolute poses from a start pose and each pose relative to the
+        previous one. """
+    poses = [start]
+    for step in steps:
+        poses.append(compose(poses[-1], step))
+    return np.array(poses)
+
+
+class OccupancyGrid:
+    """ Counts how often each cell was seen occupied (a beam ended in it)
+        and free (a beam went through it). Grids over the same area add up,
+        so scans can be cast into several and the grids summed. """
+
+    def __init__(self, origin, shape, resolution=0.05):
+        self.origin = np.asarray(origin, np.float64)  # meters, cell (0, 0)
+        self.shape = shape  # rows, cols
+        self.resolution = resolution
+        self.hits = np.zeros(shape, np.int32)
+        self.misses = np.zeros(shape, np.int32)
+
+    @classmethod
+    def around(cls, scans, poses, resolution=0.05, margin=1.0):
+        """ A grid large enough for the scans taken at poses. """
+        points = np.concatenate([transform(scan, pose)
+                                 for scan, pose in zip(scans, poses)] +
+                                [np.asarray(poses)[:, :2]])
+        low = points.min(axis=0) - margin
+        high = points.max(axis=0) + margin
+        cols, rows = np.ceil((high - low) / resolution).astype(int)
+        return cls(low, (rows, cols), resolution)
+
+    def add(self, other):
+        self.hits += other.hits
+        self.misses += other.misses
+
+    def cast(self, scans, poses, offset=(0.0, 0.0)):
+        """ Ray cast scans ((n, 2) points on base_link) taken at poses from a
+            laser at offset on base_link into the grid. """
+        cols = self.shape[1]
+        size = self.shape[0] * cols
+        hits, misses = [], []
+        for scan, pose in zip(scans, poses):
+            if not len(scan):
+                continue
+            origin = transform(np.array([offset], np.float64), pose)[0]
+            ends = transform(scan, pose)
+
+            # free cells sampled every half cell from the laser to short of
+            # each end, counted once per scan
+            vectors = ends - origin
+            lengths = np.hypot(vectors[:, 0], vectors[:, 1])
+            step = self.resolution / 2
+            t = np.arange(0.0, lengths.max(), step)
+            fractions = t[None, :] / np.maximum(lengths, 1e-9)[:, None]
+            through = t[None, :] < (lengths - self.resolution)[:, None]
+            xs = origin[0] + vectors[:, 0:1] * fractions
+            ys = origin[1] + vectors[:, 1:2] * fractions
+            misses.append(np.unique(self.index(xs[through], ys[through])))
+            hits.append(np.unique(self.index(ends[:, 0], ends[:, 1])))
+
+        if hits:
+            self.hits += np.bincount(np.concatenate(hits), minlength=size)[
+                :size].reshape(self.shape).astype(np.int32)
+            self.misses += np.bincount(np.concatenate(misses), minlength=size)[
+                :size].reshape(self.shape).astype(np.int32)
+
+    def index(self, xs, ys):
+        """ Flat cell indices of points, clamped to the grid. """
+        col = np.clip(((xs - self.origin[0]) / self.resolution).astype(
+            np.int64), 0, self.shape[1] - 1)
+        row = np.clip(((ys - self.origin[1]) / self.resolution).astype(
+            np.int64), 0, self.shape[0] - 1)
+        return row * self.shape[1] + col
+
+    def probabilities(self):
+        """ Occupancy probability of each cell, NaN where never seen. """
+        seen = self.hits + self.misses
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(seen > 0, self.hits / seen.astype(np.float64),
+                            np.nan)
+
+    def image(self):
+        """ The grid as map_saver would write it: rows top (+y) down, walls
+            OCCUPIED, open space FREE, the rest UNKNOWN. """
+        p = self.probabilities()
+        image = np.full(self.shape, UNKNOWN, np.uint8)
+        with np.errstate(invalid="ignore"):
+            image[p >= OCCUPIED_THRESH] = OCCUPIED
+            image[p <= FREE_THRESH] = FREE
+        return image[::-1]
+
+
+def writeMap(path, grid):
+    """ Write grid as path.pgm and path.yaml for map_server. """
+    image = grid.image()
+    with open(path + ".pgm", "wb") as f:
+        f.write(b"P5\n# CREATOR: neato_map.py %.3f m/pix\n%d %d\n255\n" %
+                (grid.resolution, image.shape[1], image.shape[0]))
+        f.write(image.tobytes())
+    with open(path + ".yaml", "w") as f:
+        f.write("image: %s.pgm\n" % os.path.basename(path))
+        f.write("resolution: %f\n" % grid.resolution)
+        f.write("origin: [%f, %f, 0.000000]\n" % tuple(grid.origin))
+        f.write("negate: 0\n")
+        f.write("occupied_thresh: %s\n" % OCCUPIED_THRESH)
+        f.write("free_thresh: %s\n" % FREE_THRESH)
@@ -0,0 +1,103 @@
+"""
+neato_odom.py turns the wheel encoder positions of the Neato into a pose
+and velocities.
+
+Like neato_serial.py it does not depend on ROS.
+"""
+
+from collections import deque
+from math import cos, sin
+
+import numpy as np
+
+# covariance of the odometry pose and twist (x, y, z, roll, pitch, yaw),
+# the robot moves in the plane so z, roll and pitch are not measured at all.
+POSE_COVARIANCE = (1e-3, 1e-3, 1e6, 1e6, 1e6, 1e-2)
+TWIST_COVARIANCE = (1e-3, 1e-3, 1e6, 1e6, 1e6, 1e-2)
+
+
+def diagonal(values):
+    """ Row major 6x6 covariance matrix with values on the diagonal. """
+    matrix = [0.0] * 36
+    for i, value in enumerate(values):
+        matrix[i * 7] = value
+    return matrix
+
+
+def arc(x, y, th, d, dth):
+    """ Pose reached by moving d meters while turning dth radians at a
+        constant rate from pose (x, y, th). """
+    # chord of the arc: along the heading halfway through the turn,
+    # shortened by sin(dth/2)/(dth/2)
+    half = dth / 2
+    if abs(half) > 1e-9:
+        d *= sin(half) / half
+    heading = th + half
+    return x + d * cos(heading), y + d * sin(heading), th + dth
+
+
+class WheelOdometry:
+    """ Dead reckoning from the wheel encoders of a differential drive.
+
+        Each update moves the robot along the arc the two wheel distances
+        describe, which is exact for a constant velocity over the update. """
+
+    def __init__(self, baseWidth, history=64):
+        self.baseWidth = baseWidth  # meters between the wheels
+        self.history = deque(maxlen=history)  # (stamp, x, y, th) per update
+        self.encoders = None  # last encoder positions in mm
+        self.stamp = None  # seconds of the last update
+        self.x = 0.0  # meters
+        self.y = 0.0
+        self.th = 0.0  # radians
+        self.v = 0.0  # forward velocity in m/s
+        self.w = 0.0  # rotational velocity in rad/s
+
+    def update(self, left, right, stamp):
+        """ Integrate new encoder positions (mm) read at stamp (seconds).
+            Returns False if there was nothing to integrate. """
+        if self.encoders is None:
+            # the encoders count from power on, start from where they are
+            self.encoders = (left, right)
+            self.stamp = stamp
+            self.history.append((stamp, self.x, self.y, self.th))
+            return False
+
+        d_left = (left - self.encoders[0]) / 1000.0
+        d_right = (right - self.encoders[1]) / 1000.0
+        dt = stamp - self.stamp
+        self.encoders = (left, right)
+        self.stamp = stamp
+
+        d = (d_left + d_right) / 2
+        dth = (d_right - d_left) / self.baseWidth
+        self.x, self.y, self.th = arc(self.x, self.y, self.th, d, dth)
+
+        if dt > 0:
+            self.v = d / dt
+            self.w = dth / dt
+        self.history.append((stamp, self.x, self.y, self.th))
+        return True
+
+    def posesAt(self, stamps):
+        """ Poses at an array of stamps, interpolated between the updates
+            around each one and clamped to the oldest or newest pose outside
+            the history. Returns the x, y and th arrays, None before the
+            first update. """
+        history = list(self.history)
+        if not history:
+            return None
+        t, x, y, th = np.array(history).T
+        return (np.interp(stamps, t, x), np.interp(stamps, t, y),
+                np.interp(stamps, t, th))
+
+    def predict(self, stamp, velocity=None, horizon=0.25):
+        """ Pose (x, y, th) extrapolated from the last update to stamp at
+            velocity (v, w), or the measured velocity. Extrapolates no more
+            than horizon seconds. None before the first update. """
+        if not self.history:
+            return None
+        last, x, y, th = self.history[-1]
+        v, w = velocity or (self.v, self.w)
+        dt = min(max(stamp - last, 0.0), horizon)
+        return arc(x, y, th, v * dt, w * dt)
@@ -0,0 +1,138 @@
+"""
+neato_profile.py times the phases of the driver loops, for finding out
+where a control cycle of driver.py goes.
+
+Like neato_serial.py it does not depend on ROS.
+"""
+
+import json
+import os
+import threading
+import time
+
+from collections import deque
+
+# python 2 has no integer nanosecond clock, fall back to wall time there
+perf_counter_ns = getattr(time, "perf_counter_ns", None) or \
+    (lambda: int(time.time() * 1e9))
+
+
+class NullProfiler:
+    """ Stands in for a LoopProfiler when profiling is off. """
+
+    enabled = False
+
+    def start(self):
+        pass
+
+    def mark(self, phase):
+        pass
+
+    def end(self):
+        pass
+
+
+class LoopProfiler:
+    """ Times the phases of a loop.
+
+        start() begins a cycle, each mark(phase) ends the named phase that
+        began at the previous mark (or the start) and end() closes the
+        cycle. The last window durations of every phase are kept for
+        percentiles, and the last events phases for a trace dump. """
+
+    enabled = True
+
+    def __init__(self, name, period, window=200, events=4000):
+        self.name = name
+        self.period = int(period * 1e9)  # ns a cycle is allowed to take
+        self.window = window
+        self.phases = {}  # phase -> deque of durations in ns
+        self.order = []  # phases in the order first seen
+        self.events = deque(maxlen=events)  # (phase, start ns, duration ns)
+        self.thread = None  # ident of the thread running the loop
+        self.cycleStart = None
+        self.last = None
+        self.cycles = 0
+        self.overruns = 0  # cycles longer than period
+        self.worst = 0  # ns of the longest cycle
+
+    def start(self):
+        self.cycleStart = self.last = perf_counter_ns()
+        if self.thread is None:
+            self.thread = threading.current_thread().ident
+
+    def mark(self, phase):
+        now = perf_counter_ns()
+        self.record(phase, self.last, now - self.last)
+        self.last = now
+
+    def end(self):
+        now = perf_counter_ns()
+        elapsed = now - self.cycleStart
+        self.record("cycle", self.cycleStart, elapsed)
+        self.cycles += 1
+        if elapsed > self.period:
+            self.overruns += 1
+        if elapsed > self.worst:
+            self.worst = elapsed
+
+    def record(self, phase, start, duration):
+        durations = self.phases.get(phase)
+        if durations is None:
+            durations = self.phases[phase] = deque(maxlen=self.window)
+            self.order.append(phase)
+        durations.append(duration)
+        self.events.append((phase, start, duration))
+
+    def percentiles(self, points=(50, 95, 99)):
+        """ Returns [(phase, [ms at each percentile], max ms)] over the
+            window, the whole cycle last. """
+        result = []
+        for phase in self.order:
+            durations = sorted(self.phases[phase])
+            n = len(durations)
+            values = [durations[min(n - 1, int(n * p / 100.0))] / 1e6
+                      for p in points]
+            result.append((phase, values, durations[-1] / 1e6))
+        result.sort(key=lambda r: r[0] == "cycle")
+        return result
+
+
+def chromeTrace(profilers):
+    """ The events of profilers as a Chrome trace (chrome://tracing,
+        Perfetto), one track per loop with its phases nested in the
+        cycles. """
+    pid = os.getpid()
+    events = []
+    for profiler in profilers:
+        tid = profiler.thread or 0
+        events.append({"name": "thread_name", "ph": "M", "pid": pid,
+                       "tid": tid, "args": {"name": profiler.name}})
+        for phase, start, duration in list(profiler.events):
+            events.append({"name": phase, "cat": profiler.name, "ph": "X",
+                           "ts": start / 1000.0, "dur": duration / 1000.0,
+                           "pid": pid, "tid": tid})
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def foldedStacks(profilers):
+    """ The events of profilers as folded stacks for flamegraph.pl,
+        loop;phase followed by the microseconds spent in it. """
+    totals = {}
+    for profiler in profilers:
+        for phase, start, duration in list(profiler.events):
+            if phase != "cycle":
+                key = "%s;%s" % (profiler.name, phase)
+                totals[key] = totals.get(key, 0) + duration
+    return "".join("%s %d\n" % (key, totals[key] // 1000)
+                   for key in sorted(totals))
+
+
+def dump(path, profilers):
+    """ Write the events of profilers to path, a Chrome trace if it ends
+        in .json and folded stacks otherwise. """
+    with open(path, "w") as f:
+        if path.endswith(".json"):
+            json.dump(chromeTrace(profilers), f)
+        else:
+            f.write(foldedStacks(profilers))
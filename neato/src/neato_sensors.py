@@ -0,0 +1,173 @@
+"""
+neato_sensors.py describes the name,value responses of the Neato sensor
+queries and decodes them.
+
+Each query has one SensorSchema listing its fields and how to convert
+them. A schema decodes a response straight into the attributes of a state
+object, either one of its own slotted SensorState objects or a message
+with the same field names, such as neato/Sensors. ChangePublisher decides
+which of those updates are worth publishing.
+
+Like neato_serial.py it does not depend on ROS.
+"""
+
+from neato_serial import monotonic
+
+
+def flag(value):
+    """ Converts the 0/1 values of the Neato to a bool. """
+    return value == "1"
+
+
+class SensorState(object):
+    """ Base of the state classes made by SensorSchema, which give it a
+        slot per field. valid is False until a response was decoded. """
+
+    __slots__ = ("valid",)
+
+
+class SensorSchema:
+    """ The fields of the name,value lines a query is answered with. """
+
+    def __init__(self, command, fields):
+        self.command = command
+        self.fields = fields  # (name, convert, default) in the order sent
+        self.index = dict((name, convert) for name, convert, _ in fields)
+        self.State = type(str(command), (SensorState,),
+                          {"__slots__": tuple(f[0] for f in fields)})
+
+    def state(self):
+        """ A new State object with every field at its default. """
+        state = self.State()
+        state.valid = False
+        for name, _, default in self.fields:
+            setattr(state, name, default)
+        return state
+
+    def parse(self, frame, state):
+        """ Decode a response frame (bytes) into the attributes of state.
+            Header lines, unknown names and malformed values are skipped.
+            Returns the number of fields decoded. """
+        index = self.index
+        count = 0
+        for line in frame.decode("ascii", "replace").split("\n"):
+            name, _, value = line.partition(",")
+            convert = index.get(name)
+            if convert is None:
+                continue
+            try:
+                # analog values are followed by a comma, lines end in CR
+                setattr(state, name, convert(value.partition(",")[0].rstrip()))
+            except ValueError:
+                continue
+            count += 1
+        if count and isinstance(state, SensorState):
+            state.valid = True
+        return count
+
+
+class ChangePublisher:
+    """ Publishes a message that is refreshed in place only when it changed.
+
+        A refreshed message is published if any field moved by more than
+        its deadband (0 when not given) since it was last published, but
+        no faster than maxRate. It is republished at minRate even when
+        nothing changed. A rate of 0 means no limit. """
+
+    def __init__(self, publish, fields, deadbands=None, maxRate=0.0,
+                 minRate=0.0):
+        self.publish = publish  # called with the message
+        self.fields = tuple(fields)
+        deadbands = deadbands or {}
+        self.deadbands = tuple(deadbands.get(f, 0) for f in self.fields)
+        self.maxRate = maxRate
+        self.minRate = minRate
+        self.last = None  # field values last published
+        self.published = None  # monotonic time of the last publish
+
+    def changed(self, msg):
+        """ True if a field moved past its deadband since the last publish. """
+        for name, deadband, old in zip(self.fields, self.deadbands, self.last):
+            if abs(getattr(msg, name) - old) > deadband:
+                return True
+        return False
+
+    def update(self, msg, refreshed=True, now=None):
+        """ Offer msg for publishing, refreshed tells whether its values
+            were updated since the last call. Returns True if published. """
+        if now is None:
+            now = monotonic()
+        if self.published is None:
+            if not refreshed:
+                return False  # nothing was read into it yet
+        else:
+            elapsed = now - self.published
+            if self.minRate and elapsed >= 1.0 / self.minRate:
+                pass  # due for a republish
+            elif not refreshed:
+                return False
+            elif self.maxRate and elapsed < 1.0 / self.maxRate:
+                return False
+            elif not self.changed(msg):
+                return False
+
+        self.last = [getattr(msg, f) for f in self.fields]
+        self.published = now
+        self.publish(msg)
+        return True
+
+
+ANALOG = SensorSchema("getanalogsensors", (
+    ("WallSensorInMM", int, 0),
+    ("BatteryVoltageInmV", int, 0),
+    ("LeftDropInMM", int, 0),
+    ("RightDropInMM", int, 0),
+    ("LeftMagSensor", int, 0),
+    ("RightMagSensor", int, 0),
+    ("UIButtonInmV", int, 0),
+    ("VacuumCurrentInmA", int, 0),
+    ("ChargeVoltInmV", int, 0),
+    ("BatteryTemp0InC", int, 0),
+    ("BatteryTemp1InC", int, 0),
+    ("CurrentInmA", int, 0),
+    ("SideBrushCurrentInmA", int, 0),
+    ("VoltageReferenceInmV", int, 0),
+    ("AccelXInmG", int, 0),
+    ("AccelYInmG", int, 0),
+    ("AccelZInmG", int, 0),
+))
+
+DIGITAL = SensorSchema("getdigitalsensors", (
+    ("SNSR_DC_JACK_CONNECT", flag, False),
+    ("SNSR_DUSTBIN_IS_IN", flag, False),
+    ("SNSR_LEFT_WHEEL_EXTENDED", flag, False),
+    ("SNSR_RIGHT_WHEEL_EXTENDED", flag, False),
+    ("LSIDEBIT", flag, False),
+    ("LFRONTBIT", flag, False),
+    ("RSIDEBIT", flag, False),
+    ("RFRONTBIT", flag, False),
+))
+
+BUTTONS = SensorSchema("GetButtons", (
+    ("BTN_SOFT_KEY", flag, False),
+    ("BTN_SCROLL_UP", flag, False),
+    ("BTN_START", flag, False),
+    ("BTN_BACK", flag, False),
+    ("BTN_SCROLL_DOWN", flag, False),
+))
+
+CHARGER = SensorSchema("getcharger", (
+    ("FuelPercent", int, 0),
+    ("BatteryOverTemp", flag, False),
+    ("ChargingActive", flag, False),
+    ("ChargingEnabled", flag, False),
+    ("ConfidentOnFuel", flag, False),
+    ("OnReservedFuel", flag, False),
+    ("EmptyFuel", flag, False),
+    ("BatteryFailure", flag, False),
+    ("ExtPwrPresent", flag, False),
+    ("VBattV", float, 0.0),
+    ("VExtV", float, 0.0),
+    ("MaxPWM", int, 0),
+    ("PWM", int, 0),
+))
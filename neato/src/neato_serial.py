@@ -0,0 +1,693 @@
+"""
+neato_serial.py contains the serial protocol helpers used by driver.py.
+
+Nothing in here depends on ROS so the framing and parsing code can be
+exercised (and benchmarked) without a robot attached.
+"""
+
+import bisect
+import mmap
+import struct
+import threading
+import time
+
+from collections import deque
+
+CTRL_Z = b"\x1a"  # end of response marker sent by the Neato
+
+# python 2 has no monotonic clock, fall back to wall time there
+monotonic = getattr(time, "monotonic", time.time)
+
+
+class ResponseFramer:
+    """ Splits the raw byte stream from the Neato into ^Z terminated frames. """
+
+    def __init__(self, size=16384):
+        # a getldsscan response is ~5KB, so the default buffer holds a few
+        # responses without ever having to grow.
+        self.buffer = bytearray(size)
+        self.length = 0
+        self.started = None  # monotonic time the partial frame began arriving
+        self.starts = []  # arrival times of the frames returned by feed
+
+    def feed(self, data, stamp=None):
+        """ Add a chunk of bytes read from the port at stamp (monotonic time,
+            defaults to now). Returns the list of frames (bytes, without the
+            ^Z) completed by it, the time the first byte of each arrived is
+            left in self.starts. """
+        if stamp is None:
+            stamp = monotonic()
+        start = self.length
+        if start == 0:
+            self.started = stamp
+        end = start + len(data)
+        if end > len(self.buffer):
+            self.buffer.extend(bytearray(end - len(self.buffer)))
+        self.buffer[start:end] = data
+        self.length = end
+
+        frames = []
+        self.starts = []
+        idx = self.buffer.find(CTRL_Z, start, end)
+        if idx < 0:
+            return frames
+
+        begin = 0
+        while idx >= 0:
+            frames.append(bytes(self.buffer[begin:idx]))
+            self.starts.append(self.started)
+            self.started = stamp  # later frames began in this chunk
+            begin = idx + 1
+            idx = self.buffer.find(CTRL_Z, begin, end)
+
+        # move the partial frame (if any) to the front of the buffer
+        remaining = end - begin
+        self.buffer[0:remaining] = self.buffer[begin:end]
+        self.length = remaining
+        return frames
+
+    def reset(self):
+        """ Drop any partially received frame. """
+        self.length = 0
+        self.started = None
+
+
+def splitLines(frame):
+    """ Break a frame into its non-empty lines, ignoring the CRs. """
+    if not isinstance(frame, str):
+        frame = frame.decode("ascii", "replace")
+    return [line for line in frame.replace("\r", "").split("\n") if line]
+
+
+def afterHeader(lines, tag):
+    """ Returns the lines following the header line whose first field is tag,
+        or None if there is no such line. """
+    for i, line in enumerate(lines):
+        if line.split(",")[0] == tag:
+            return lines[i + 1:]
+    return None
+
+
+class CommandFuture:
+    """ The pending response to a command sent through a CommandEngine. """
+
+    def __init__(self, command):
+        self.command = command
+        self.sent = None  # monotonic time the command was written
+        self.started = None  # monotonic time the response began arriving
+        self.received = None  # monotonic time the response arrived
+        self.frame = None
+        self.done = threading.Event()
+
+    def set(self, frame):
+        """ Complete the command, frame is None if the response was lost. """
+        if frame is not None:
+            self.received = monotonic()
+        self.frame = frame
+        self.done.set()
+
+    def raw(self, timeout=1):
+        """ Wait for the response frame (bytes, without the echoed command line).
+            Returns None on a timeout or if the response was lost. """
+        self.done.wait(timeout)
+        return self.frame
+
+    def result(self, timeout=1):
+        """ Wait for the response lines (without the echoed command line).
+            Returns None on a timeout or if the response was lost. """
+        frame = self.raw(timeout)
+        if frame is None:
+            return None
+        return splitLines(frame)
+
+
+class CommandEngine:
+    """ Keeps several commands in flight to the Neato and ties each ^Z
+        terminated response frame to the command that produced it.
+
+        Commands are answered in the order they were sent. The Neato echoes
+        each command line at the start of its response, which is used to find
+        the matching command so a lost response only fails its own command. """
+
+    def __init__(self, port, maxInFlight=4, timeout=1, stats=None):
+        self.port = port
+        self.maxInFlight = maxInFlight
+        self.timeout = timeout  # seconds before an unanswered command is given up on
+        self.stats = stats or LinkStats()
+        self.pending = deque()
+        self.lock = threading.Condition(threading.Lock())
+
+    def submit(self, cmd):
+        """ Send a command, returns a CommandFuture for its response. """
+        return self.submitMany([cmd])[0]
+
+    def submitMany(self, cmds, urgent=False):
+        """ Send several commands in one write, returns their
+            CommandFutures. Urgent commands do not wait for a free slot,
+            they go out ahead of anything still waiting for one. """
+        futures = [CommandFuture(cmd) for cmd in cmds]
+        data = "".join("%s\n" % cmd for cmd in cmds).encode("ascii")
+        with self.lock:
+            if not urgent:
+                self.waitForSlots(len(futures))
+
+            # write while holding the lock so the wire order matches self.pending
+            sent = monotonic()
+            for future in futures:
+                future.sent = sent
+                self.pending.append(future)
+            self.port.write(data)
+        self.stats.bytesOut += len(data)
+        self.stats.writes += 1
+        return futures
+
+    def reserve(self, count):
+        """ Wait until count more commands fit in flight, so that sending
+            them urgently right after does not overfill the window. """
+        with self.lock:
+            self.waitForSlots(count)
+
+    def waitForSlots(self, count):
+        """ Wait, with self.lock held, for count free slots. Commands that
+            were never answered are failed to free up theirs. """
+        while self.pending and len(self.pending) + count > self.maxInFlight:
+            oldest = self.pending[0]
+            remaining = oldest.sent + self.timeout - monotonic()
+            if remaining <= 0:
+                # never answered, free up its slot
+                self.pending.popleft().set(None)
+                self.stats.lost += 1
+            else:
+                self.lock.wait(remaining)
+
+    def dispatch(self, frames, starts=None):
+        """ Hand response frames read from the port to their commands.
+            starts are the times the frames began arriving, if known. """
+        for i, frame in enumerate(frames):
+            frame = frame.lstrip(b"\r\n")
+            if not frame.strip():
+                continue  # response to a blank line
+
+            # only the first line is looked at here, the rest of the frame
+            # is left for the consumer to parse
+            echo, _, body = frame.partition(b"\n")
+            echo = echo.strip().decode("ascii", "replace").lower()
+            with self.lock:
+                future = self.match(echo)
+                self.lock.notify_all()
+            if future is None:
+                # a late response to a command already given up on, or a
+                # garbled echo. Handing it to the oldest command would
+                # shift every response after it onto the wrong command.
+                self.stats.unmatched += 1
+                continue
+
+            if starts:
+                future.started = starts[i]
+            future.set(body)
+            self.stats.command(future.command, future.received - future.sent)
+
+    def match(self, echo):
+        """ Pop the pending command the echoed command line belongs to.
+            Commands sent before it have lost their response and are failed.
+            Returns None if the echo matches no pending command. """
+        for i, future in enumerate(self.pending):
+            if future.command.strip().lower() == echo:
+                for _ in range(i):
+                    self.pending.popleft().set(None)
+                self.stats.lost += i
+                if i:
+                    self.stats.resyncs += 1
+                return self.pending.popleft()
+        return None
+
+    def cancel(self):
+        """ Fail every command still waiting for a response. """
+        with self.lock:
+            while self.pending:
+                self.pending.popleft().set(None)
+            self.lock.notify_all()
+
+
+class CommandCoalescer:
+    """ Collects the actuator commands of a control cycle and sends them in
+        one write.
+
+        A value is queued per actuator (the motors, a group of LEDs). A
+        later value replaces the queued one unless that has a higher
+        priority, so a safety action such as a bump reversal is not undone
+        by a routine command in the same cycle. encode, if registered for
+        the actuator, turns the winning value into the command line. A
+        command equal to the last one sent for the actuator is held back
+        until keepalive seconds after that (0 sends it every time). """
+
+    def __init__(self, engine, keepalive=0.0, stats=None):
+        self.engine = engine
+        self.keepalive = keepalive
+        self.stats = stats or engine.stats
+        self.encoders = {}  # actuator -> function making the command line
+        self.queued = {}  # actuator -> (priority, value)
+        self.order = []  # actuators in the order first queued
+        self.last = {}  # actuator -> future of the last command sent
+        self.lock = threading.Lock()
+
+    def actuator(self, name, encode):
+        """ Register the function making the command line for name. """
+        self.encoders[name] = encode
+
+    def set(self, actuator, value, priority=0):
+        """ Queue value for actuator, returns False if a higher priority
+            value is queued for it already. """
+        with self.lock:
+            queued = self.queued.get(actuator)
+            if queued is None:
+                self.order.append(actuator)
+            else:
+                self.stats.coalesced += 1
+                if queued[0] > priority:
+                    return False
+            self.queued[actuator] = (priority, value)
+        return True
+
+    def flush(self, now=None, urgent=False):
+        """ Send the queued commands in one write, returns their futures.
+            urgent is passed on to CommandEngine.submitMany.
+
+            A flush that is not urgent waits for room in the engine's window
+            before taking the lock, so an urgent flush from another thread
+            never waits behind it, and then writes without waiting. """
+        reserved = False
+        if not urgent and hasattr(self.engine, "reserve"):
+            with self.lock:
+                count = len(self.order)
+            if count:
+                self.engine.reserve(count)
+                reserved = True
+        if now is None:
+            now = monotonic()
+        with self.lock:
+            commands = []
+            actuators = []
+            for actuator in self.order:
+                value = self.queued[actuator][1]
+                encode = self.encoders.get(actuator)
+                command = encode(*value) if encode else value
+                last = self.last.get(actuator)
+                # sent is None while an engine on an event loop has yet to
+                # write it, which is as recent as it gets
+                if (last and last.command == command and
+                        (last.sent is None or
+                         now - last.sent < self.keepalive)):
+                    self.stats.suppressed += 1
+                    continue
+                commands.append(command)
+                actuators.append(actuator)
+            self.queued.clear()
+            del self.order[:]
+            if not commands:
+                return []
+            futures = self.engine.submitMany(commands, urgent or reserved)
+            for actuator, future in zip(actuators, futures):
+                self.last[actuator] = future
+        return futures
+
+
+def requestTime(command):
+    """ Estimated monotonic time the robot acted on a command: halfway
+        between writing it and the first byte of the response arriving.
+        None if the command was not answered. """
+    if command is None or command.sent is None or command.started is None:
+        return None
+    return (command.sent + command.started) / 2
+
+
+class PollQuery:
+    """ A query polled by a PollScheduler. """
+
+    def __init__(self, name, command, rate, priority, required=False):
+        self.name = name
+        self.command = command
+        self.rate = rate  # target rate in Hz
+        self.priority = priority  # higher goes first
+        self.required = required  # sent whenever due, even over budget
+        self.due = None  # monotonic time the query is due next
+        self.cost = None  # moving average of its link time in seconds
+        self.count = 0  # responses since the last PollScheduler.rates()
+        self.timeouts = 0
+
+
+class PollScheduler:
+    """ Decides which sensor queries to send to the Neato each control cycle.
+
+        The Neato cannot answer every query every cycle, so each query has a
+        target rate and a priority. Due queries are sent highest priority
+        first for as long as the link time of their responses fits in the
+        part of the cycle set aside for polling; the others wait for a later
+        cycle. A query held back for starve of its own periods is sent
+        anyway, which also measures its link time again. """
+
+    def __init__(self, period, budget=0.6, starve=4):
+        self.period = period  # seconds per control cycle
+        self.budget = budget  # fraction of the cycle the queries may use
+        self.starve = starve  # periods of a query it may be held back
+        self.queries = []
+        self.since = monotonic()
+
+    def add(self, name, command, rate, priority, required=False):
+        query = PollQuery(name, command, rate, priority, required)
+        self.queries.append(query)
+        self.queries.sort(key=lambda q: -q.priority)
+        return query
+
+    def select(self, now=None):
+        """ Returns the queries to send this cycle, highest priority first. """
+        if now is None:
+            now = monotonic()
+        self.stagger(now)
+        available = self.period * self.budget
+        chosen = []
+        for query in self.queries:
+            # anything due before the middle of this cycle goes now
+            if query.rate <= 0 or now + self.period / 2 < query.due:
+                continue
+            cost = query.cost or 0.0
+            starved = now - query.due >= self.starve / query.rate
+            if cost > available and not (query.required or starved):
+                continue
+            available -= cost
+
+            # keep the phase, but don't try to catch up on missed polls
+            query.due = max(query.due + 1.0 / query.rate, now)
+            chosen.append(query)
+        return chosen
+
+    def stagger(self, now):
+        """ Make the queries seen for the first time due: the required ones
+            now, the others a cycle apart, so starting up does not send them
+            all at once. """
+        offset = 0
+        for query in self.queries:
+            if query.required or query.rate <= 0:
+                if query.due is None:
+                    query.due = now
+                continue
+            if query.due is None:
+                query.due = now + (offset * self.period) % (1.0 / query.rate)
+            offset += 1
+
+    def record(self, query, pending):
+        """ Account for the response to a query sent this cycle. Its cost is
+            the time its own response took to arrive. The wait for the
+            responses ahead of it on the wire is left out, as those are
+            costed themselves. """
+        if pending.received is None:
+            query.timeouts += 1
+            return
+        cost = pending.received - (pending.started or pending.sent)
+        query.cost = (cost if query.cost is None
+                      else 0.8 * query.cost + 0.2 * cost)
+        query.count += 1
+
+    def rates(self):
+        """ Returns [(query, achieved rate in Hz)] since the last call. """
+        now = monotonic()
+        elapsed = max(now - self.since, 1e-6)
+        self.since = now
+        achieved = []
+        for query in self.queries:
+            achieved.append((query, query.count / elapsed))
+            query.count = 0
+        return achieved
+
+
+# upper bounds of the latency histogram buckets, in milliseconds
+LATENCY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class LatencyHistogram:
+    """ Fixed bucket histogram of round trip times. """
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        ms = seconds * 1000
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, ms)] += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+
+    def percentile(self, p):
+        """ Upper bound (ms) of the bucket holding the p-th percentile. """
+        n = sum(self.counts)
+        if not n:
+            return 0.0
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= n * p / 100.0:
+                return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else self.max
+        return self.max
+
+
+class LinkStats:
+    """ Counters describing the serial link to the Neato.
+
+        Updating is a plain attribute increment so it can be left on all the
+        time, snapshot() returns the current values as a flat dict. """
+
+    def __init__(self):
+        self.started = monotonic()
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.timeouts = 0  # commands whose caller gave up waiting
+        self.lost = 0  # commands whose response never came
+        self.resyncs = 0  # responses that did not belong to the oldest command
+        self.unmatched = 0  # responses dropped, no pending command echoed
+        self.scans = 0
+        self.incompleteScans = 0  # scans with fewer than 360 readings
+        self.loops = 0
+        self.overruns = 0  # control loop cycles that took too long
+        self.writes = 0  # writes to the port
+        self.coalesced = 0  # commands replaced by a later one in the cycle
+        self.suppressed = 0  # unchanged commands held back
+        self.latency = {}  # command name -> LatencyHistogram
+        self.startup = 0.0  # seconds the driver took to start
+
+    def command(self, cmd, rtt):
+        """ Record the round trip time of a command. """
+        name = cmd.split(" ", 1)[0].lower()
+        histogram = self.latency.get(name)
+        if histogram is None:
+            histogram = self.latency[name] = LatencyHistogram()
+        histogram.add(rtt)
+
+    def scan(self, count):
+        """ Record a scan with count readings. """
+        self.scans += 1
+        if count < 360:
+            self.incompleteScans += 1
+
+    def loop(self, elapsed, period):
+        """ Record a control loop cycle. """
+        self.loops += 1
+        if elapsed > period:
+            self.overruns += 1
+
+    def snapshot(self):
+        """ Returns all counters as a dict of name -> number. """
+        elapsed = max(monotonic() - self.started, 1e-6)
+        values = {
+            "uptime": elapsed,
+            "startup_time": self.startup,
+            "bytes_in": self.bytesIn,
+            "bytes_out": self.bytesOut,
+            "bytes_in_per_sec": self.bytesIn / elapsed,
+            "bytes_out_per_sec": self.bytesOut / elapsed,
+            "writes": self.writes,
+            "coalesced_commands": self.coalesced,
+            "suppressed_commands": self.suppressed,
+            "timeouts": self.timeouts,
+            "lost": self.lost,
+            "resyncs": self.resyncs,
+            "unmatched": self.unmatched,
+            "scans": self.scans,
+            "incomplete_scans": self.incompleteScans,
+            "loops": self.loops,
+            "loop_overruns": self.overruns,
+        }
+        for name, histogram in self.latency.items():
+            n = sum(histogram.counts)
+            values["%s_count" % name] = n
+            values["%s_mean_ms" % name] = histogram.total / n if n else 0.0
+            values["%s_p95_ms" % name] = histogram.percentile(95)
+            values["%s_max_ms" % name] = histogram.max
+        return values
+
+
+# capture files start with CAPTURE_MAGIC, followed by one record per read
+# from or write to the port: a CAPTURE_RECORD header (seconds since the
+# capture started, direction, length) and then the bytes.
+CAPTURE_MAGIC = b"NEATOCAP\x01"
+CAPTURE_RECORD = struct.Struct("<dBI")
+FROM_ROBOT = 0
+TO_ROBOT = 1
+
+
+class CaptureWriter:
+    """ Appends raw serial traffic to a capture file. """
+
+    def __init__(self, path):
+        self.file = open(path, "wb")
+        self.file.write(CAPTURE_MAGIC)
+        self.start = monotonic()
+        self.lock = threading.Lock()
+
+    def record(self, direction, data):
+        header = CAPTURE_RECORD.pack(monotonic() - self.start, direction,
+                                     len(data))
+        with self.lock:
+            if not self.file.closed:
+                self.file.write(header)
+                self.file.write(data)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class CapturingPort:
+    """ Wraps a serial port, teeing all traffic into a CaptureWriter. """
+
+    def __init__(self, port, capture):
+        self.port = port
+        self.capture = capture
+
+    def read(self, size=1):
+        data = self.port.read(size)
+        if data:
+            self.capture.record(FROM_ROBOT, data)
+        return data
+
+    def write(self, data):
+        self.capture.record(TO_ROBOT, data)
+        return self.port.write(data)
+
+    def close(self):
+        self.port.close()
+        self.capture.close()
+
+    def __getattr__(self, name):
+        return getattr(self.port, name)
+
+
+def readCapture(path):
+    """ Yields the (time, direction, bytes) records of a capture file. """
+    with open(path, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if data[:len(CAPTURE_MAGIC)] != CAPTURE_MAGIC:
+            raise ValueError("%s is not a neato capture file" % path)
+        pos = len(CAPTURE_MAGIC)
+        while pos + CAPTURE_RECORD.size <= len(data):
+            t, direction, length = CAPTURE_RECORD.unpack_from(data, pos)
+            pos += CAPTURE_RECORD.size
+            yield t, direction, data[pos:pos + length]
+            pos += length
+    finally:
+        data.close()
+
+
+class ReplayPort:
+    """ serial.Serial compatible port that plays back what the robot sent in
+        a capture file, in real time or as fast as it is read.
+        Writes are accepted and dropped. """
+
+    def __init__(self, path, realtime=True, timeout=0.1):
+        self.records = [(t, data) for t, direction, data in readCapture(path)
+                        if direction == FROM_ROBOT]
+        self.realtime = realtime
+        self.timeout = timeout
+        self.index = 0
+        self.offset = 0  # bytes of the current record already read
+        self.start = monotonic()
+        self.is_open = True
+
+    def isOpen(self):
+        return self.is_open
+
+    @property
+    def finished(self):
+        return self.index >= len(self.records)
+
+    def available(self):
+        """ Index of the first record not available yet. """
+        if not self.realtime:
+            return len(self.records)
+        elapsed = monotonic() - self.start
+        end = self.index
+        while end < len(self.records) and self.records[end][0] <= elapsed:
+            end += 1
+        return end
+
+    @property
+    def in_waiting(self):
+        end = self.available()
+        return sum(len(data) for t, data in self.records[self.index:end]) - \
+            self.offset
+
+    def read(self, size=1):
+        end = self.available()
+        if end == self.index:
+            # nothing due, wait like a serial port would
+            if self.finished:
+                time.sleep(self.timeout)
+                return b""
+            due = self.start + self.records[self.index][0] - monotonic()
+            time.sleep(max(0, min(self.timeout, due)))
+            end = self.available()
+
+        chunks = []
+        while self.index < end and size > 0:
+            data = self.records[self.index][1]
+            chunk = data[self.offset:self.offset + size]
+            chunks.append(chunk)
+            size -= len(chunk)
+            self.offset += len(chunk)
+            if self.offset >= len(data):
+                self.index += 1
+                self.offset = 0
+        return b"".join(chunks)
+
+    def write(self, data):
+        return len(data)
+
+    def flushInput(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.is_open = False
+
+
+def replayCapture(path, engine, framer=None):
+    """ Feed a capture through a CommandEngine as fast as possible, in the
+        recorded order: command lines the driver wrote are submitted and what
+        the robot sent is framed and dispatched. The engine should be given a
+        port that drops writes, such as a ReplayPort.
+        Returns the CommandFutures of the replayed commands. """
+    framer = framer or ResponseFramer()
+    futures = []
+    for t, direction, data in readCapture(path):
+        if direction == TO_ROBOT:
+            for line in data.decode("ascii", "replace").splitlines():
+                if line.strip():
+                    futures.append(engine.submit(line))
+        else:
+            engine.stats.bytesIn += len(data)
+            engine.dispatch(framer.feed(data), framer.starts)
+    return futures
@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+"""
+neato_sim.py is a software stand-in for a Neato robot on the serial port.
+
+SimulatedNeato behaves like a serial.Serial opened on the robot: commands
+written to it are answered with the response formats of the real robot
+(echoed command line, CRLF lines and a ^Z terminator), delivered no faster
+than the configured baud rate allows. The robot drives around a rectangular
+room so encoders and laser scans change as it is commanded to move.
+
+Run the driver against it with the port parameter set to "sim", or run this
+file to serve the simulated robot on a pseudo terminal:
+
+    python neato_sim.py [--baud 115200]
+"""
+
+import math
+import os
+import random
+import threading
+from collections import deque
+
+import numpy as np
+
+from neato_lds import BEAMS
+from neato_serial import monotonic
+
+USB_PACKET = 64  # bytes delivered together
+
+MOTOR_PARAMETERS = ("Brush_RPM", "Brush_mA", "Vacuum_RPM", "Vacuum_mA",
+                    "LeftWheel_RPM", "LeftWheel_Load%",
+                    "LeftWheel_PositionInMM", "LeftWheel_Speed",
+                    "RightWheel_RPM", "RightWheel_Load%",
+                    "RightWheel_PositionInMM", "RightWheel_Speed",
+                    "Charger_mAH", "SideBrush_mA")
+
+ANALOG_SENSORS = (("WallSensorInMM", 60), ("BatteryVoltageInmV", 16348),
+                  ("LeftDropInMM", 0), ("RightDropInMM", 0),
+                  ("LeftMagSensor", 0), ("RightMagSensor", 0),
+                  ("UIButtonInmV", 3330), ("VacuumCurrentInmA", 0),
+                  ("ChargeVoltInmV", 24024), ("BatteryTemp0InC", 30),
+                  ("BatteryTemp1InC", 28), ("CurrentInmA", 40),
+                  ("SideBrushCurrentInmA", 0), ("VoltageReferenceInmV", 1225),
+                  ("AccelXInmG", 36), ("AccelYInmG", -16),
+                  ("AccelZInmG", 1008))
+
+DIGITAL_SENSORS = ("SNSR_DC_JACK_CONNECT", "SNSR_DUSTBIN_IS_IN",
+                   "SNSR_LEFT_WHEEL_EXTENDED", "SNSR_RIGHT_WHEEL_EXTENDED",
+                   "LSIDEBIT", "LFRONTBIT", "RSIDEBIT", "RFRONTBIT")
+
+BUTTONS = ("BTN_SOFT_KEY", "BTN_SCROLL_UP", "BTN_START", "BTN_BACK",
+           "BTN_SCROLL_DOWN")
+
+BASE_WIDTH = 248  # millimeters
+LDS_PERIOD = 0.2  # seconds per rotation of the LDS
+LDS_OFFSET = (-0.090, 0.0)  # meters, where the LDS sits on the robot
+
+
+def roomRanges(x, y, th, room=(4.0, 3.0)):
+    """ Ranges (m) of the beams of a LDS at pose x, y, th (numbers, or
+        arrays with one value per beam) in a rectangular room centered on
+        the origin, as the simulated robot sees it without noise. """
+    angles = th + np.radians(np.arange(BEAMS))
+    c, s = np.cos(angles), np.sin(angles)
+    with np.errstate(divide="ignore"):
+        wall_x = (np.copysign(room[0] / 2, c) - x) / c
+        wall_y = (np.copysign(room[1] / 2, s) - y) / s
+    return np.minimum(np.abs(wall_x), np.abs(wall_y)).astype(np.float32)
+
+
+class SimulatedNeato:
+    """ serial.Serial compatible simulated Neato robot. """
+
+    def __init__(self, port="sim", baudrate=115200, timeout=0.1,
+                 responseDelay=0.001, room=(4.0, 3.0), seed=0):
+        self.port = port
+        self.baudrate = baudrate  # None delivers responses instantly
+        self.timeout = timeout
+        self.responseDelay = responseDelay  # seconds the robot takes to answer
+        self.room = room  # width and depth in meters, robot starts centered
+        self.random = random.Random(seed)
+
+        self.is_open = True
+        self.input = b""  # partial command line written to the robot
+        self.output = []  # [ready time, bytes] chunks to be read
+        self.ready = threading.Condition(threading.Lock())
+        self.lineFree = 0.0  # time the outgoing line is free for the next byte
+
+        self.testMode = False
+        self.ldsRotation = False
+        self.leds = set()
+        self.digital = dict((name, 0) for name in DIGITAL_SENSORS)
+        self.digital["SNSR_DUSTBIN_IS_IN"] = 1
+        self.buttons = dict((name, 0) for name in BUTTONS)
+        self.fuelPercent = 93
+
+        # wheel motion from setmotor: position, target and speed per wheel
+        self.wheels = [0.0, 0.0]
+        self.targets = [0.0, 0.0]
+        self.speeds = [0.0, 0.0]
+        self.moved = monotonic()
+        self.pose = [0.0, 0.0, 0.0]  # x, y (m) and heading (rad) in the room
+        self.track = deque()  # (time, x, y, th) of the last second
+        self.ldsStarted = None  # time the LDS was turned on
+
+    # serial.Serial interface
+
+    def isOpen(self):
+        return self.is_open
+
+    @property
+    def in_waiting(self):
+        now = monotonic()
+        with self.ready:
+            return sum(len(data) for ready, data in self.output if ready <= now)
+
+    def inWaiting(self):
+        return self.in_waiting
+
+    def read(self, size=1):
+        """ Read up to size bytes, waiting up to timeout for the first one. """
+        deadline = monotonic() + (self.timeout or 0)
+        with self.ready:
+            while True:
+                now = monotonic()
+                if self.output and self.output[0][0] <= now:
+                    break
+                if now >= deadline:
+                    return b""
+                wait = deadline - now
+                if self.output:
+                    wait = min(wait, self.output[0][0] - now)
+                self.ready.wait(wait)
+
+            data = b""
+            while self.output and self.output[0][0] <= now and len(data) < size:
+                chunk = self.output[0][1]
+                take = size - len(data)
+                data += chunk[:take]
+                if take < len(chunk):
+                    self.output[0][1] = chunk[take:]
+                else:
+                    self.output.pop(0)
+            return data
+
+    def write(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode("ascii")
+        self.input += data
+        while b"\n" in self.input:
+            line, self.input = self.input.split(b"\n", 1)
+            self.respond(line.decode("ascii", "replace").strip("\r"))
+        return len(data)
+
+    def flushInput(self):
+        with self.ready:
+            self.output = []
+
+    reset_input_buffer = flushInput
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.is_open = False
+
+    # robot
+
+    def respond(self, line):
+        """ Queue the response to a command line, as the robot would. """
+        words = line.split()
+        name = words[0].lower() if words else ""
+        handler = getattr(self, "cmd_" + name, None)
+        if not words:
+            body = []
+        elif handler is None:
+            body = ["Unknown Cmd: '%s'" % words[0]]
+        else:
+            body = handler(words[1:])
+
+        text = "\r\n".join([line] + body) + "\r\n\x1a"
+        self.send(text.encode("ascii"))
+
+    def send(self, data):
+        """ Queue bytes for reading, paced by the baud rate. """
+        now = monotonic()
+        with self.ready:
+            start = max(now + self.responseDelay, self.lineFree)
+            if not self.baudrate:
+                self.output.append([start, data])
+            else:
+                perByte = 10.0 / self.baudrate  # start + 8 data + stop bits
+                for i in range(0, len(data), USB_PACKET):
+                    chunk = data[i:i + USB_PACKET]
+                    start += len(chunk) * perByte
+                    self.output.append([start, chunk])
+            self.lineFree = start
+            self.ready.notify_all()
+
+    def move(self):
+        """ Advance the wheels and the pose to the current time. """
+        now = monotonic()
+        dt = now - self.moved
+        self.moved = now
+
+        deltas = []
+        for i in range(2):
+            remaining = self.targets[i] - self.wheels[i]
+            step = min(abs(remaining), self.speeds[i] * dt)
+            step = math.copysign(step, remaining)
+            self.wheels[i] += step
+            deltas.append(step / 1000.0)
+
+        d = (deltas[0] + deltas[1]) / 2
+        dth = (deltas[1] - deltas[0]) / (BASE_WIDTH / 1000.0)
+        x, y, th = self.pose
+        self.pose = [x + d * math.cos(th + dth / 2),
+                     y + d * math.sin(th + dth / 2), th + dth]
+        self.track.append((now, self.pose[0], self.pose[1], self.pose[2]))
+        while self.track[0][0] < now - 1.0:
+            self.track.popleft()
+
+    def poseAt(self, t):
+        """ The pose at time t, interpolated along the track. """
+        after = next((i for i, point in enumerate(self.track)
+                      if point[0] >= t), len(self.track) - 1)
+        t1, x1, y1, th1 = self.track[after]
+        if after == 0 or t >= t1:
+            return x1, y1, th1
+        t0, x0, y0, th0 = self.track[after - 1]
+        f = (t - t0) / (t1 - t0)
+        return x0 + f * (x1 - x0), y0 + f * (y1 - y0), th0 + f * (th1 - th0)
+
+    def cmd_testmode(self, args):
+        self.testMode = bool(args) and args[0].lower() == "on"
+        return []
+
+    def cmd_setldsrotation(self, args):
+        on = bool(args) and args[0].lower() == "on"
+        if on and not self.ldsRotation:
+            self.ldsStarted = monotonic()
+        self.ldsRotation = on
+        return []
+
+    def cmd_setled(self, args):
+        if args:
+            self.leds.add(args[0])
+        return []
+
+    def cmd_setmotor(self, args):
+        values = dict(zip([a.lower() for a in args[0::2]], args[1::2]))
+        try:
+            left = int(values.get("lwheeldist", 0))
+            right = int(values.get("rwheeldist", 0))
+            speed = abs(int(values.get("speed", 0)))
+        except ValueError:
+            return ["Invalid argument"]
+
+        self.move()
+        self.targets = [self.wheels[0] + left, self.wheels[1] + right]
+        longest = max(abs(left), abs(right)) or 1
+        self.speeds = [speed * abs(left) / float(longest),
+                       speed * abs(right) / float(longest)]
+        return []
+
+    def cmd_getmotors(self, args):
+        self.move()
+        values = dict((name, 0) for name in MOTOR_PARAMETERS)
+        values["LeftWheel_PositionInMM"] = int(self.wheels[0])
+        values["RightWheel_PositionInMM"] = int(self.wheels[1])
+        values["LeftWheel_Speed"] = int(self.speeds[0])
+        values["RightWheel_Speed"] = int(self.speeds[1])
+        return ["Parameter,Value"] + ["%s,%d" % (name, values[name])
+                                     for name in MOTOR_PARAMETERS]
+
+    def cmd_getanalogsensors(self, args):
+        return ["SensorName,Value"] + ["%s,%d," % (name, value)
+                                       for name, value in ANALOG_SENSORS]
+
+    def cmd_getdigitalsensors(self, args):
+        return ["Digital Sensor Name, Value"] + [
+            "%s,%d" % (name, self.digital[name]) for name in DIGITAL_SENSORS]
+
+    def cmd_getbuttons(self, args):
+        return ["Button Name,Pressed"] + [
+            "%s,%d" % (name, self.buttons[name]) for name in BUTTONS]
+
+    def cmd_getcharger(self, args):
+        return ["Label,Value",
+                "FuelPercent,%d" % self.fuelPercent,
+                "BatteryOverTemp,0",
+                "ChargingActive,0",
+                "ChargingEnabled,1",
+                "ConfidentOnFuel,0",
+                "OnReservedFuel,0",
+                "EmptyFuel,0",
+                "BatteryFailure,0",
+                "ExtPwrPresent,0",
+                "ThermistorPresent[0],1",
+                "ThermistorPresent[1],1",
+                "BattTempCAvg[0],30",
+                "BattTempCAvg[1],28",
+                "VBattV,16.34",
+                "VExtV,0.00",
+                "Charger_mAH,0"]
+
+    def cmd_getldsscan(self, args):
+        lines = ["AngleInDegrees,DistInMM,Intensity,ErrorCodeHEX"]
+        if not self.ldsRotation:
+            lines += ["%d,0,0,8035" % a for a in range(360)]
+            return lines + ["ROTATION_SPEED,0.00"]
+
+        # the answer is the last complete rotation, seen from where the
+        # robot was halfway through it
+        self.move()
+        turns = math.floor((self.moved - self.ldsStarted) / LDS_PERIOD)
+        x, y, th = self.poseAt(self.ldsStarted + (turns - 0.5) * LDS_PERIOD)
+        distances = roomRanges(
+            x + LDS_OFFSET[0] * math.cos(th) - LDS_OFFSET[1] * math.sin(th),
+            y + LDS_OFFSET[0] * math.sin(th) + LDS_OFFSET[1] * math.cos(th),
+            th, room=self.room)
+        for a in range(360):
+            mm = int(distances[a] * 1000 + self.random.gauss(0, 5))
+            if self.random.random() < 0.02 or mm > 5000:
+                lines.append("%d,0,0,8035" % a)  # no return
+            else:
+                intensity = max(10, 2000 - mm // 3)
+                lines.append("%d,%d,%d,0" % (a, mm, intensity))
+        return lines + ["ROTATION_SPEED,%.2f" % (
+            1 / LDS_PERIOD + self.random.gauss(0, 0.02))]
+
+
+def servePty(baudrate):
+    """ Serve a simulated Neato on a pseudo terminal until interrupted. """
+    import tty
+
+    master, slave = os.openpty()
+    tty.setraw(master)
+    tty.setraw(slave)
+    robot = SimulatedNeato(baudrate=baudrate)
+
+    def forward():
+        while True:
+            data = robot.read(4096)
+            if data:
+                os.write(master, data)
+
+    thread = threading.Thread(None, forward)
+    thread.daemon = True
+    thread.start()
+
+    print("Simulated Neato on %s" % os.ttyname(slave))
+    while True:
+        robot.write(os.read(master, 4096))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Simulated Neato robot")
+    parser.add_argument("--baud", type=int, default=115200,
+                        help="baud rate to pace responses at, 0 for no limit")
+    try:
+        servePty(parser.parse_args().baud or None)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+""" Tests for reading captures in scripts/build_map.py. """
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "src"))
+sys.path.insert(0, os.path.join(HERE, "..", "..", "scripts"))
+
+import numpy as np  # noqa: E402
+
+from build_map import LASER_OFFSET, buildMap, readCaptureFile  # noqa: E402
+from neato_serial import (CAPTURE_MAGIC, CAPTURE_RECORD,  # noqa: E402
+                          CTRL_Z, FROM_ROBOT, ResponseFramer, readCapture)
+
+# the driver recording neato_sim.py driving an arc (0.2 m/s, 0.3 rad/s)
+CAPTURE = os.path.join(HERE, "data", "driving.cap")
+
+
+def dropResponses(source, path, drop):
+    """ Copy the capture at source to path without the responses drop
+        picks. drop is called with each response frame and returns True to
+        leave it out, as if it was lost on the wire. Each response is
+        written at the time its first byte arrived. """
+    framer = ResponseFramer()
+    with open(path, "wb") as f:
+        f.write(CAPTURE_MAGIC)
+        for t, direction, data in readCapture(source):
+            if direction == FROM_ROBOT:
+                frames = framer.feed(data, t)
+                records = [(start, frame + CTRL_Z) for start, frame in
+                           zip(framer.starts, frames) if not drop(frame)]
+            else:
+                records = [(t, data)]
+            for stamp, record in records:
+                f.write(CAPTURE_RECORD.pack(stamp, direction, len(record)))
+                f.write(record)
+
+
+class Nth:
+    """ Picks the n-th response to a command. """
+
+    def __init__(self, command, n):
+        self.command = command.encode("ascii")
+        self.n = n
+        self.dropped = None  # the frame picked
+
+    def __call__(self, frame):
+        if frame.lstrip().lower().startswith(self.command):
+            self.n -= 1
+            if self.n == 0:
+                self.dropped = frame
+                return True
+        return False
+
+
+class ReadCaptureFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.stamps, self.scans, self.poses = readCaptureFile(CAPTURE,
+                                                              LASER_OFFSET)
+        self.assertGreater(len(self.stamps), 15)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def lose(self, command, n):
+        path = os.path.join(self.dir, "lost.cap")
+        drop = Nth(command, n)
+        dropResponses(CAPTURE, path, drop)
+        self.assertIsNotNone(drop.dropped)
+        return readCaptureFile(path, LASER_OFFSET)
+
+    def test_lost_motors_response(self):
+        # the odometry misses one update, every scan keeps its pose
+        stamps, scans, poses = self.lose("getmotors", 20)
+        self.assertEqual(stamps, self.stamps)
+        np.testing.assert_allclose(poses, self.poses, atol=1e-3)
+
+    def test_lost_scan_response(self):
+        # only that scan is missing, the others keep their stamps and poses
+        stamps, scans, poses = self.lose("getldsscan", 10)
+        self.assertEqual(len(stamps), len(self.stamps) - 1)
+        lost = next(i for i, (a, b) in enumerate(zip(stamps, self.stamps))
+                    if a != b)
+        keep = [i for i in range(len(self.stamps)) if i != lost]
+        self.assertEqual(stamps, [self.stamps[i] for i in keep])
+        np.testing.assert_allclose(poses, self.poses[keep], atol=1e-3)
+        for points, i in zip(scans, keep):
+            np.testing.assert_array_equal(points, self.scans[i])
+
+    def test_matching_keeps_to_odometry(self):
+        # the recording is clean, so the odometry is good to a few cm and
+        # the scan matching shouldn't drift away from it
+        poses, grid = buildMap(self.scans, self.poses, LASER_OFFSET, 2)
+        self.assertLess(np.hypot(*(poses - self.poses)[:, :2].T).max(), 0.05)
+        self.assertLess(np.abs(poses - self.poses)[:, 2].max(), 0.05)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+""" Tests for neato_serial.CommandCoalescer. """
+
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "src"))
+
+from neato_serial import CommandCoalescer, CommandEngine  # noqa: E402
+
+
+class Port:
+    """ Records what is written, never answers. """
+
+    def __init__(self):
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append(data.decode("ascii"))
+
+
+class CommandCoalescerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.port = Port()
+        self.engine = CommandEngine(self.port, maxInFlight=1, timeout=0.5)
+        self.output = CommandCoalescer(self.engine)
+
+    def test_later_value_replaces_queued_one(self):
+        self.output.set("motors", "setmotor 1")
+        self.output.set("motors", "setmotor 2")
+        self.output.set("leds", "setled ledgreen")
+        self.output.flush()
+        self.assertEqual(self.port.writes,
+                         ["setmotor 2\nsetled ledgreen\n"])
+
+    def test_higher_priority_value_is_kept(self):
+        self.output.set("motors", "setmotor back", priority=10)
+        self.assertFalse(self.output.set("motors", "setmotor forward"))
+        self.output.flush()
+        self.assertEqual(self.port.writes, ["setmotor back\n"])
+
+    def test_urgent_flush_does_not_wait_behind_a_full_window(self):
+        self.engine.submit("getldsscan")  # fills the window, never answered
+        self.output.set("leds", "setled ledgreen")
+        routine = threading.Thread(None, self.output.flush)
+        routine.start()
+        time.sleep(0.05)  # routine is now waiting for a slot
+
+        start = time.time()
+        self.output.set("motors", "setmotor 1")
+        self.output.flush(urgent=True)
+        self.assertLess(time.time() - start, 0.1)
+        # the queued led command goes out with it
+        self.assertEqual(self.port.writes[1:],
+                         ["setled ledgreen\nsetmotor 1\n"])
+
+        routine.join()  # nothing left for it once getldsscan timed out
+        self.assertEqual(len(self.port.writes), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
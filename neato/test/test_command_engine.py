@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+""" Tests for neato_serial.CommandEngine. """
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "src"))
+
+from neato_serial import CommandEngine  # noqa: E402
+
+
+class Port:
+    """ Records what is written, never answers. """
+
+    def __init__(self):
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append(data)
+
+
+def response(command, body):
+    """ A response frame as the Neato sends it, without the ^Z. """
+    return ("%s\r\n%s\r\n" % (command, body)).encode("latin-1")
+
+
+class CommandEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = CommandEngine(Port())
+
+    def test_responses_complete_their_commands(self):
+        futures = self.engine.submitMany(["getmotors", "getcharger"])
+        self.engine.dispatch([response("getmotors", "motors"),
+                              response("GetCharger", "charger")])
+        self.assertEqual([f.result(0) for f in futures],
+                         [["motors"], ["charger"]])
+
+    def test_lost_response_only_fails_its_own_command(self):
+        futures = self.engine.submitMany(["getmotors", "getcharger"])
+        self.engine.dispatch([response("getcharger", "charger")])
+        self.assertEqual([f.result(0) for f in futures], [None, ["charger"]])
+        self.assertEqual(self.engine.stats.lost, 1)
+
+    def test_late_response_is_dropped(self):
+        stale = self.engine.submit("getcharger")
+        self.engine.cancel()  # given up on, its response is still coming
+        futures = self.engine.submitMany(
+            ["getanalogsensors", "getdigitalsensors", "getmotors"])
+        self.engine.dispatch([response("getcharger", "stale"),
+                              response("getanalogsensors", "analog"),
+                              response("getdigitalsensors", "digital"),
+                              response("getmotors", "motors")])
+        self.assertIsNone(stale.result(0))
+        self.assertEqual([f.result(0) for f in futures],
+                         [["analog"], ["digital"], ["motors"]])
+        self.assertEqual(self.engine.stats.lost, 0)
+        self.assertEqual(self.engine.stats.unmatched, 1)
+
+    def test_garbled_echo_is_dropped(self):
+        futures = self.engine.submitMany(["getmotors", "getcharger"])
+        self.engine.dispatch([response("getm\xf8tors", "garbled"),
+                              response("getcharger", "charger")])
+        self.assertEqual([f.result(0) for f in futures], [None, ["charger"]])
+        self.assertEqual(self.engine.stats.unmatched, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
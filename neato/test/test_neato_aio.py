@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+""" Tests for neato_aio.py. """
+
+import asyncio
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "src"))
+
+from neato_aio import AsyncCommandEngine, AsyncNeatoLink  # noqa: E402
+
+
+class Port:
+    """ Records what is written, never answers. """
+
+    def __init__(self):
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append(data)
+
+    def read(self, size):
+        time.sleep(0.01)
+        return b""
+
+
+class AsyncNeatoLinkTest(unittest.TestCase):
+
+    def test_unanswered_commands_are_given_up_on(self):
+        link = AsyncNeatoLink(Port(), timeout=0.05)
+
+        async def send():
+            return await link.requestMany(["getmotors", "getcharger"],
+                                          urgent=True)
+
+        entries = asyncio.new_event_loop().run_until_complete(send())
+        self.assertEqual([entry.frame for entry in entries], [None, None])
+        self.assertEqual(len(link.pending), 0)
+        self.assertEqual(link.stats.lost, 2)
+
+        # their responses turning up late complete nothing
+        link.dispatch([b"getmotors\r\nParameter,Value\r\n"])
+        self.assertEqual(link.stats.unmatched, 1)
+
+
+class AsyncCommandEngineTest(unittest.TestCase):
+
+    def test_sent_is_when_the_loop_wrote_it(self):
+        engine = AsyncCommandEngine(Port(), timeout=0.05)
+        try:
+            before = time.time()
+            pending = engine.submit("getmotors")
+            self.assertIsNone(pending.raw(1))
+            self.assertIs(pending.sent, pending.entry.sent)
+            self.assertIsNotNone(pending.sent)
+            self.assertIsNone(pending.received)
+        finally:
+            engine.cancel()
+        self.assertLess(time.time() - before, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+""" Tests for the LIDAR scan handling of neato_lds.py. """
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "src"))
+
+import numpy as np  # noqa: E402
+
+from neato_lds import (BEAMS, ScanBuffer, ScanDeskewer,  # noqa: E402
+                       ScanFilter, ScanParser, ScanView)
+from neato_odom import WheelOdometry  # noqa: E402
+from neato_serial import (FROM_ROBOT, CommandFuture,  # noqa: E402
+                          ResponseFramer, readCapture)
+from neato_sim import roomRanges  # noqa: E402
+
+CAPTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data",
+                       "standing.cap")
+
+
+def referenceFilter(history, ranges, intensities, window, median, outlier,
+                    minIntensity):
+    """ ScanFilter.apply one beam at a time. history is a list of the
+        (ranges, intensities) lists of the scans so far. """
+    ranges, intensities = list(ranges), list(intensities)
+    for a in range(BEAMS):
+        if intensities[a] < minIntensity:
+            ranges[a] = intensities[a] = 0
+    clean = list(ranges)
+    for a in range(BEAMS):
+        if outlier and (abs(clean[a] - clean[a - 1]) > outlier and
+                        abs(clean[a] - clean[(a + 1) % BEAMS]) > outlier):
+            ranges[a] = intensities[a] = 0
+    history.append((list(ranges), list(intensities)))
+    del history[:-window]
+
+    for a in range(BEAMS):
+        if not median and ranges[a]:
+            continue
+        readings = sorted(r[a] for r, i in history if r[a])
+        n = len(readings)
+        if n:
+            ranges[a] = (readings[(n - 1) // 2] + readings[n // 2]) / 2
+            intensities[a] = sum(i[a] for r, i in history) / n
+        else:
+            ranges[a] = intensities[a] = 0
+    return ranges, intensities
+
+
+def recordedFrames():
+    """ The getldsscan responses in data/standing.cap, which the driver
+        recorded (its ~capture parameter) from neato_sim.py standing still.
+        They have the noise and the holes (no return) of the simulated
+        LDS. """
+    framer = ResponseFramer()
+    frames = []
+    for t, direction, data in readCapture(CAPTURE):
+        if direction == FROM_ROBOT:
+            frames += [frame for frame in framer.feed(data)
+                       if b"AngleInDegrees" in frame]
+    return frames
+
+
+def recordedScans():
+    """ (ranges, intensities) of the recorded scans. """
+    parser = ScanParser()
+    scans = []
+    for frame in recordedFrames():
+        if parser.parse(frame) == BEAMS and parser.rotationSpeed:
+            scans.append((parser.ranges.copy(), parser.intensities.copy()))
+    return scans
+
+
+def request(t):
+    """ A getldsscan command answered at t. """
+    command = CommandFuture("getldsscan")
+    command.sent = command.started = t
+    return command
+
+
+class ScanFilterTest(unittest.TestCase):
+
+    def check(self, median, outlier, minIntensity):
+        scanFilter = ScanFilter(3, median, True, outlier, minIntensity)
+        parser = ScanParser()
+        history = []
+        scans = recordedScans()
+        self.assertGreater(len(scans), 10)
+        for n, (ranges, intensities) in enumerate(scans):
+            if outlier:
+                ranges[n::29] += 1.5  # a few single beam outliers
+            parser.ranges[:] = ranges
+            parser.intensities[:] = intensities
+            expected = referenceFilter(history, ranges, intensities, 3,
+                                       median, outlier, minIntensity)
+            scanFilter.apply(parser)
+            np.testing.assert_allclose(parser.ranges, expected[0],
+                                       atol=1e-5)
+            np.testing.assert_allclose(parser.intensities, expected[1],
+                                       atol=1e-3)
+
+    def test_fill_holes(self):
+        self.check(False, 0.0, 0)
+
+    def test_fill_holes_outliers_and_intensity(self):
+        # the simulated LDS is weaker than 1250 beyond about 2.25 m
+        self.check(False, 0.3, 1250)
+
+    def test_temporal_median_and_outliers(self):
+        self.check(True, 0.3, 0)
+
+    def test_recorded_holes_are_filled(self):
+        scanFilter = ScanFilter(3)
+        parser = ScanParser()
+        for ranges, intensities in recordedScans():
+            holes = np.count_nonzero(ranges == 0)
+            parser.ranges[:] = ranges
+            parser.intensities[:] = intensities
+            scanFilter.apply(parser)
+            self.assertEqual(scanFilter.filled,
+                             holes - np.count_nonzero(parser.ranges == 0))
+        self.assertGreater(holes, 0)
+        # no beam of this capture is empty in all three scans of the window
+        self.assertEqual(np.count_nonzero(parser.ranges == 0), 0)
+
+    def test_hole_filled_from_earlier_scans(self):
+        scanFilter = ScanFilter(3)
+        parser = ScanParser()
+        for value in (1.0, 1.2, 0.0):
+            parser.ranges[:] = value
+            parser.intensities[:] = 100
+            scanFilter.apply(parser)
+        # median of the readings of the beam in the window, holes left out
+        np.testing.assert_allclose(parser.ranges, 1.1)
+
+
+class ScanBufferTest(unittest.TestCase):
+
+    def setUp(self):
+        self.frames = [frame for frame in recordedFrames()
+                       if b"ROTATION_SPEED,0.00" not in frame]
+        self.scans = ScanBuffer(scanFilter=ScanFilter(3))
+
+    def test_holes_filled_from_the_scans_before(self):
+        for i, frame in enumerate(self.frames[:3]):
+            scan = self.scans.parse(frame, request(i * 0.2))
+        self.assertGreater(self.scans.filter.filled, 0)
+        self.assertEqual(np.count_nonzero(scan.ranges == 0), 0)
+
+    def test_filter_starts_over_after_a_gap(self):
+        self.scans.parse(self.frames[0], request(0.0))
+        scan = self.scans.parse(self.frames[1], request(5.0))
+        self.assertEqual(self.scans.filter.filled, 0)
+        self.assertGreater(np.count_nonzero(scan.ranges == 0), 0)
+
+    def test_filter_starts_over_when_the_lds_stops(self):
+        off = (b"getldsscan\r\nAngleInDegrees,DistInMM,Intensity,"
+               b"ErrorCodeHEX\r\n" +
+               b"".join(b"%d,0,0,8035\r\n" % a for a in range(BEAMS)) +
+               b"ROTATION_SPEED,0.00\r\n")
+        self.scans.parse(self.frames[0], request(0.0))
+        scan = self.scans.parse(off, request(0.2))
+        self.assertFalse(scan.ranges.any())  # not filled from before
+        scan = self.scans.parse(self.frames[1], request(0.4))
+        self.assertEqual(self.scans.filter.filled, 0)
+        self.assertGreater(np.count_nonzero(scan.ranges == 0), 0)
+
+
+class ScanViewTest(unittest.TestCase):
+
+    def setUp(self):
+        self.parser = ScanParser()
+        self.parser.ranges[:] = np.arange(BEAMS)
+        self.parser.intensities[:] = np.arange(BEAMS) + 1000
+
+    def test_sector(self):
+        view = ScanView(-90, 90, 2)
+        view.update(self.parser)
+        self.assertEqual(len(view.ranges), 91)
+        self.assertEqual(view.ranges[0], 270)
+        self.assertEqual(view.ranges[45], 0)
+        self.assertEqual(view.ranges[-1], 90)
+
+    def test_sector_wrapping_through_zero(self):
+        view = ScanView(350, 10, 5, intensities=False)
+        view.update(self.parser)
+        np.testing.assert_array_equal(view.ranges, [350, 355, 0, 5, 10])
+        self.assertEqual(len(view.intensities), 0)
+        self.assertTrue(view.wraps)
+
+    def test_whole_scan(self):
+        view = ScanView()
+        view.update(self.parser)
+        np.testing.assert_array_equal(view.ranges, self.parser.ranges)
+        np.testing.assert_array_equal(view.intensities,
+                                      self.parser.intensities)
+        self.assertFalse(view.wraps)
+
+
+class ScanDeskewerTest(unittest.TestCase):
+
+    def test_deskewed_scan_matches_scan_standing_still(self):
+        # driving 0.3 m/s while turning 0.5 rad/s, encoders every 50 ms
+        v, w, period = 0.3, 0.5, 0.2
+        odometry = WheelOdometry(0.248)
+        for i in range(-1, 60):
+            t = i * 0.05
+            odometry.update((v - w * 0.124) * t * 1000,
+                            (v + w * 0.124) * t * 1000, t)
+
+        deskewer = ScanDeskewer(odometry.posesAt)
+        parser = ScanParser()
+        parser.start, parser.scanTime = 1.0, period
+        beamTimes = parser.start + np.arange(BEAMS) * period / BEAMS
+        parser.ranges[:] = roomRanges(*odometry.posesAt(beamTimes))
+        parser.intensities[:] = 100
+        skewed = parser.ranges.copy()
+        deskewer.apply(parser)
+
+        reference = parser.start + period / 2
+        self.assertAlmostEqual(parser.deskewed, reference)
+        x, y, th = odometry.posesAt(reference)
+        expected = roomRanges(np.full(BEAMS, x), np.full(BEAMS, y),
+                              np.full(BEAMS, th))
+
+        # the binning to whole degrees leaves the corners and the odd beam
+        # empty, compare the median error of the rest
+        error = np.median(np.abs(parser.ranges - expected)[parser.ranges > 0])
+        before = np.median(np.abs(skewed - expected))
+        self.assertLess(error, 0.01)
+        self.assertLess(error, before / 4)
+        self.assertGreater(np.count_nonzero(parser.ranges), BEAMS * 0.9)
+
+    def test_standing_still_leaves_scan_alone(self):
+        odometry = WheelOdometry(0.248)
+        for i in range(10):
+            odometry.update(0.0, 0.0, i * 0.05)
+        deskewer = ScanDeskewer(odometry.posesAt)
+        parser = ScanParser()
+        parser.start, parser.scanTime = 0.1, 0.2
+        parser.ranges[:] = roomRanges(np.zeros(BEAMS), np.zeros(BEAMS),
+                                      np.zeros(BEAMS))
+        expected = parser.ranges.copy()
+        deskewer.apply(parser)
+        np.testing.assert_allclose(parser.ranges, expected, atol=1e-6)
+
+
+if __name__ == "__main__":
+    unittest.main()
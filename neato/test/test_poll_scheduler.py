@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+""" Tests for the sensor query scheduling of neato_serial.PollScheduler. """
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "src"))
+
+from neato_serial import PollScheduler  # noqa: E402
+
+
+class Response:
+    """ What PollScheduler.record reads of a CommandFuture, answered after
+        waiting for wait seconds behind other responses. """
+
+    def __init__(self, sent, cost, wait=0.0):
+        self.sent = sent
+        self.started = sent + wait
+        self.received = self.started + cost
+
+
+class PollSchedulerTest(unittest.TestCase):
+
+    def run_cycles(self, scheduler, cycles, rtts):
+        """ Select and record for cycles of the scheduler, answering each
+            query after rtts[name] seconds. Returns the cycles each query
+            was sent in. """
+        sent = dict((query.name, []) for query in scheduler.queries)
+        for cycle in range(cycles):
+            now = cycle * scheduler.period
+            for query in scheduler.select(now):
+                sent[query.name].append(cycle)
+                scheduler.record(query, Response(now, rtts[query.name]))
+        return sent
+
+    def test_sends_due_queries_within_budget(self):
+        scheduler = PollScheduler(0.1)
+        scheduler.add("motors", "getmotors", 10, 100, required=True)
+        scheduler.add("analog", "getanalogsensors", 5, 40)
+        sent = self.run_cycles(scheduler, 20,
+                               {"motors": 0.01, "analog": 0.01})
+        self.assertEqual(len(sent["motors"]), 20)
+        self.assertEqual(len(sent["analog"]), 10)
+
+    def test_over_budget_query_is_not_starved(self):
+        # the round trip of digital takes longer than the budget of a cycle,
+        # it is held back but still sent every starve of its periods
+        scheduler = PollScheduler(0.1, budget=0.6, starve=4)
+        scheduler.add("motors", "getmotors", 10, 100, required=True)
+        scheduler.add("digital", "getdigitalsensors", 5, 80)
+        sent = self.run_cycles(scheduler, 100,
+                               {"motors": 0.01, "digital": 0.2})
+        self.assertEqual(len(sent["motors"]), 100)
+        digital = sent["digital"]
+        self.assertGreater(len(digital), 5)
+        gaps = [b - a for a, b in zip(digital, digital[1:])]
+        # due a period (2 cycles) after it was sent, then held back for 4
+        # more periods
+        self.assertLessEqual(max(gaps), 10)
+
+    def test_startup_is_staggered(self):
+        scheduler = PollScheduler(0.05)
+        scheduler.add("motors", "getmotors", 20, 100, required=True)
+        scheduler.add("digital", "getdigitalsensors", 10, 90)
+        scheduler.add("analog", "getanalogsensors", 5, 50)
+        scheduler.add("buttons", "GetButtons", 5, 20)
+        scheduler.add("charger", "getcharger", 5, 10)
+        sent = self.run_cycles(scheduler, 40, dict(
+            (query.name, 0.001) for query in scheduler.queries))
+        self.assertEqual(sent["motors"], list(range(40)))
+        self.assertEqual(sent["digital"], list(range(0, 40, 2)))
+        self.assertEqual(sent["analog"], list(range(1, 40, 4)))
+        self.assertEqual(sent["buttons"], list(range(2, 40, 4)))
+        self.assertEqual(sent["charger"], list(range(3, 40, 4)))
+
+    def test_cost_is_the_transfer_of_its_own_response(self):
+        scheduler = PollScheduler(0.1)
+        motors = scheduler.add("motors", "getmotors", 10, 100, required=True)
+        scheduler.record(motors, Response(0.0, 0.002, wait=0.05))
+        self.assertAlmostEqual(motors.cost, 0.002)
+
+    def test_required_query_ignores_budget(self):
+        scheduler = PollScheduler(0.1)
+        scheduler.add("motors", "getmotors", 10, 100, required=True)
+        sent = self.run_cycles(scheduler, 10, {"motors": 0.5})
+        self.assertEqual(len(sent["motors"]), 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
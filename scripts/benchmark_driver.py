@@ -0,0 +1,614 @@
+# Benchmarks for the serial protocol code used by the neato driver.
+# No robot (or ROS) is required, recorded serial traffic (or traffic from
+# the simulated neato in neato_sim.py) is replayed through a fake serial port.
+
+# License: BSD
+
+# Run this script:
+#   python benchmark_driver.py [--stream recorded_bytes.bin | --capture file]
+#                              [--json results.json] [--baseline old.json]
+# where a capture file is recorded by the driver with its ~capture parameter.
+# --json writes every measured number to a file, --baseline compares them to
+# an earlier one and exits with 1 if any got worse by more than --tolerance.
+
+import argparse
+import json
+import os
+import platform
+import sys
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "neato", "src"))
+
+import numpy as np  # noqa: E402
+
+from neato_lds import (BEAMS, ScanDeskewer, ScanFilter,  # noqa: E402
+                       ScanParser)
+from neato_odom import WheelOdometry  # noqa: E402
+from neato_sensors import ANALOG, BUTTONS, CHARGER, DIGITAL  # noqa: E402
+from neato_serial import (FROM_ROBOT, CommandEngine,  # noqa: E402
+                          CommandFuture, ReplayPort, ResponseFramer,
+                          afterHeader, monotonic, readCapture, replayCapture,
+                          splitLines)
+from neato_sim import SimulatedNeato, roomRanges  # noqa: E402
+
+import ros_stub  # noqa: E402
+
+# name -> number of everything measured, see --json. Names ending in _per_s
+# are better higher, all others lower.
+results = {}
+
+
+def syntheticStream(cycles=200):
+    """ Serial traffic of a number of driver cycles, as sent by the
+        simulated Neato (getmotors, getdigitalsensors, getldsscan). """
+    robot = SimulatedNeato(baudrate=None, responseDelay=0, timeout=0)
+    robot.write("testmode on\nsetldsrotation on\n")
+    robot.read(4096)
+    parts = []
+    for i in range(cycles):
+        robot.write("getmotors\ngetdigitalsensors\ngetldsscan\n")
+        data = robot.read(65536)
+        while data:
+            parts.append(data)
+            data = robot.read(65536)
+    return b"".join(parts)
+
+
+class FakeSerial:
+    """ Serves a byte stream the way a USB serial port does, in packets. """
+
+    def __init__(self, data, packet=64):
+        self.data = data
+        self.packet = packet
+        self.pos = 0
+
+    @property
+    def in_waiting(self):
+        return min(self.packet, len(self.data) - self.pos)
+
+    def read(self, n=1):
+        chunk = self.data[self.pos:self.pos + n]
+        self.pos += len(chunk)
+        return chunk
+
+
+def legacyReader(port):
+    """ The original byte at a time reader loop of driver.py. """
+    frames = []
+    comsData = []
+    line = ""
+    while True:
+        val = port.read(1)
+        if len(val) == 0:
+            return frames
+        c = ord(val)
+        if c == 13:
+            pass
+        elif c == 26:
+            if len(line) > 0:
+                comsData.append(line)
+                line = ""
+            frames.append(list(comsData))
+            comsData = []
+        elif c == 10:
+            if len(line) > 0:
+                comsData.append(line)
+                line = ""
+        else:
+            line = line + chr(c)
+
+
+def chunkedReader(port):
+    """ The driver.py reader loop using ResponseFramer. """
+    framer = ResponseFramer()
+    frames = []
+    while True:
+        val = port.read(port.in_waiting or 1)
+        if len(val) == 0:
+            return [splitLines(f) for f in frames]
+        frames.extend(framer.feed(val))
+
+
+def legacyScanRanges(frame):
+    """ The original list based getScanRanges of driver.py. """
+    ranges = list()
+    intensities = list()
+    angle = 0
+    lines = splitLines(frame)
+    while lines and lines.pop(0).split(",")[0] != "AngleInDegrees":
+        pass
+    for line in lines:
+        vals = line.split(",")
+        if (ord(vals[0][0]) >= 48 and ord(vals[0][0]) <= 57):
+            try:
+                a = int(vals[0])
+                r = int(vals[1])
+                i = int(vals[2])
+                e = int(vals[3])
+                while (angle < a):
+                    ranges.append(0)
+                    intensities.append(0)
+                    angle += 1
+                if (e == 0):
+                    ranges.append(r / 1000.0)
+                    intensities.append(i)
+                else:
+                    ranges.append(0)
+                    intensities.append(0)
+            except:
+                ranges.append(0)
+                intensities.append(0)
+            angle += 1
+    return ranges, intensities
+
+
+def legacySensors(frames, sensors):
+    """ The original dict based sensor parsers and publishSensors copy of
+        driver.py. """
+    analog, digital, buttons, charger = [
+        afterHeader(splitLines(frame), header) for frame, header in zip(
+            frames, ("SensorName", "Digital Sensor Name", "Button Name",
+                     "Label"))]
+    analogSensors = {}
+    for line in analog:
+        values = line.split(",")
+        analogSensors[values[0]] = int(values[1])
+    digitalSensors = {}
+    for line in digital:
+        values = line.split(",")
+        digitalSensors[values[0]] = int(values[1])
+    buttonValues = {}
+    for line in buttons:
+        values = line.split(",")
+        buttonValues[values[0]] = (values[1] == '1')
+    chargerValues = {}
+    for line in charger:
+        values = line.split(",")
+        if values[0] in ["VBattV", "VExtV"]:
+            chargerValues['m' + values[0]] = int(float(values[1]) * 100)
+        elif values[0] in ["BatteryOverTemp", "ChargingActive", "ChargingEnabled", "ConfidentOnFuel", "OnReservedFuel", "EmptyFuel", "BatteryFailure", "ExtPwrPresent"]:
+            chargerValues[values[0]] = (values[1] == '1')
+        elif values[0] in ["FuelPercent", "MaxPWM", "PWM"]:
+            chargerValues[values[0]] = int(values[1])
+
+    for name, _, _ in ANALOG.fields:
+        setattr(sensors, name, analogSensors[name])
+    for name, _, _ in DIGITAL.fields:
+        setattr(sensors, name, digitalSensors[name])
+    return sensors
+
+
+def timeIt(fn, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        result = fn()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def benchReader(stream):
+    old, oldFrames = timeIt(lambda: legacyReader(FakeSerial(stream)))
+    new, newFrames = timeIt(lambda: chunkedReader(FakeSerial(stream)))
+    if oldFrames != newFrames:
+        raise RuntimeError("chunked reader frames differ from legacy reader")
+    mb = len(stream) / 1e6
+    results["reader_bytes_per_s"] = len(stream) / new
+    print("reader: %d bytes, %d frames" % (len(stream), len(newFrames)))
+    print("  legacy byte reader:  %8.2f MB/s" % (mb / old))
+    print("  chunked frame reader: %8.2f MB/s (%.1fx)" % (mb / new, old / new))
+
+
+def benchScan(frames):
+    parser = ScanParser()
+
+    def legacy():
+        for frame in frames:
+            legacyScanRanges(frame)
+
+    def vectorized():
+        for frame in frames:
+            parser.parse(frame)
+
+    for frame in frames[:10]:
+        ranges, intensities = legacyScanRanges(frame)
+        parser.parse(frame)
+        if (max(abs(parser.ranges - ranges)) > 1e-6 or
+                max(abs(parser.intensities - intensities)) > 0):
+            raise RuntimeError("ScanParser result differs from legacy parser")
+
+    old, _ = timeIt(legacy)
+    new, _ = timeIt(vectorized)
+    results["scan_parser_scans_per_s"] = len(frames) / new
+    print("scan parser: %d getldsscan frames" % len(frames))
+    print("  legacy list parser: %8.0f scans/s" % (len(frames) / old))
+    print("  ScanParser:         %8.0f scans/s (%.1fx)" %
+          (len(frames) / new, old / new))
+
+
+def benchScanFilter(frames):
+    """ Latency of ScanFilter on recorded scans (its output is checked by
+        neato/test/test_neato_lds.py). """
+    parser = ScanParser()
+    configs = (("fill holes", False, 0.0, 0),
+               ("fill holes + outliers + intensity", False, 0.3, 20),
+               ("temporal median + outliers", True, 0.3, 0))
+    print("scan filter: window of 3 scans, %d getldsscan frames" % len(frames))
+    for name, median, outlier, minIntensity in configs:
+        scanFilter = ScanFilter(3, median, True, outlier, minIntensity)
+        parsed = []
+        for frame in frames:
+            parser.parse(frame)
+            parsed.append((parser.ranges.copy(), parser.intensities.copy()))
+
+        def run():
+            for ranges, intensities in parsed:
+                parser.ranges[:] = ranges
+                parser.intensities[:] = intensities
+                scanFilter.apply(parser)
+
+        elapsed, _ = timeIt(run)
+        results["scan_filter_%s_us" % name.split()[0]] = \
+            elapsed / len(parsed) * 1e6
+        print("  %-34s %6.1f us/scan" % (name + ":",
+                                           elapsed / len(parsed) * 1e6))
+
+
+def benchDeskew(scans=200, v=0.3, w=0.5):
+    """ Deskewing scans taken while driving v m/s and turning w rad/s, and
+        how far they are from the scan the LDS would see standing still
+        (which neato/test/test_neato_lds.py checks). """
+    period = 0.2
+    odometry = WheelOdometry(0.248)
+    for i in range(-1, 60):
+        # encoders every 50 ms, the robot drives an arc
+        t = i * 0.05
+        left = (v - w * 0.124) * t * 1000
+        right = (v + w * 0.124) * t * 1000
+        odometry.update(left, right, t)
+
+    deskewer = ScanDeskewer(odometry.posesAt)
+    parser = ScanParser()
+    parser.start, parser.scanTime = 1.0, period
+    beamTimes = parser.start + np.arange(BEAMS) * period / BEAMS
+    parser.ranges[:] = roomRanges(*odometry.posesAt(beamTimes))
+    parser.intensities[:] = 100
+    skewed = parser.ranges.copy()
+    deskewer.apply(parser)
+    reference = parser.start + period / 2
+    x, y, th = odometry.posesAt(reference)
+    expected = roomRanges(np.full(BEAMS, x), np.full(BEAMS, y),
+                          np.full(BEAMS, th))
+
+    # the binning to whole degrees leaves the corners and the odd empty beam
+    error = np.abs(parser.ranges - expected)[parser.ranges > 0]
+    before = np.median(np.abs(skewed - expected))
+    after = np.median(error)
+
+    def run():
+        for _ in range(scans):
+            parser.ranges[:] = skewed
+            deskewer.apply(parser)
+
+    elapsed, _ = timeIt(run)
+    results["deskew_us"] = elapsed / scans * 1e6
+    results["deskew_error_mm"] = after * 1000
+    print("deskew: %.1f m/s, %.1f rad/s, %.0f ms per rotation" %
+          (v, w, period * 1000))
+    print("  median range error: %.1f mm skewed, %.1f mm deskewed" %
+          (before * 1000, after * 1000))
+    print("  ScanDeskewer: %6.1f us/scan" % (elapsed / scans * 1e6))
+
+
+def scanFrames(stream):
+    framer = ResponseFramer()
+    return [f for f in framer.feed(stream) if b"AngleInDegrees" in f]
+
+
+def captureStream(path):
+    """ The bytes the robot sent in a capture file. """
+    return b"".join(data for t, direction, data in readCapture(path)
+                    if direction == FROM_ROBOT)
+
+
+def benchReplay(path):
+    """ Replays a capture through the CommandEngine as fast as possible. """
+    def replay():
+        engine = CommandEngine(ReplayPort(path, realtime=False),
+                               maxInFlight=64, timeout=0)
+        futures = replayCapture(path, engine)
+        engine.cancel()
+        return engine, futures
+
+    elapsed, (engine, futures) = timeIt(replay)
+    records = list(readCapture(path))
+    duration = records[-1][0] if records else 0
+    stats = engine.stats.snapshot()
+    print("replay: %s, %.1f s of traffic, %d commands" %
+          (os.path.basename(path), duration, len(futures)))
+    print("  replayed in %.3f s (%.0fx real time)" %
+          (elapsed, duration / elapsed if elapsed else 0))
+    print("  answered %d, lost %d, resyncs %d, unmatched %d" %
+          (sum(1 for f in futures if f.frame is not None),
+           stats["lost"], stats["resyncs"], stats["unmatched"]))
+
+
+def benchSensors(cycles=2000):
+    """ Decoding the sensor queries of a cycle into a Sensors like object. """
+    robot = SimulatedNeato(baudrate=None, responseDelay=0, timeout=0)
+    frames = []
+    for schema in (ANALOG, DIGITAL, BUTTONS, CHARGER):
+        robot.write(schema.command + "\n")
+        frame = robot.read(65536).rstrip(b"\x1a")
+        frames.append(frame.partition(b"\n")[2])  # without the echo
+
+    # stands in for the neato/Sensors message, which has slots per field
+    Sensors = type("Sensors", (object,), {"__slots__": tuple(
+        name for name, _, _ in ANALOG.fields + DIGITAL.fields)})
+    sensors = Sensors()
+    buttons = BUTTONS.state()
+    charger = CHARGER.state()
+
+    def legacy():
+        for _ in range(cycles):
+            legacySensors(frames, Sensors())
+
+    def schema():
+        for _ in range(cycles):
+            ANALOG.parse(frames[0], sensors)
+            DIGITAL.parse(frames[1], sensors)
+            BUTTONS.parse(frames[2], buttons)
+            CHARGER.parse(frames[3], charger)
+
+    check = legacySensors(frames, Sensors())
+    schema()
+    for name in Sensors.__slots__:
+        if getattr(check, name) != getattr(sensors, name):
+            raise RuntimeError("schema parser differs on %s" % name)
+
+    old, _ = timeIt(legacy)
+    new, _ = timeIt(schema)
+    results["sensor_parse_per_s"] = cycles * 4 / new
+    print("sensors: analog + digital + buttons + charger per cycle")
+    print("  legacy dict parsers: %6.1f us" % (old / cycles * 1e6))
+    print("  schema parsers:      %6.1f us (%.1fx)" %
+          (new / cycles * 1e6, old / new))
+
+
+def benchLink(cycles, baudrate, responseDelay):
+    """ Driver cycles per second against the simulated Neato at baudrate
+        (None for a USB link), sending one command at a time and pipelined. """
+    robot = SimulatedNeato(baudrate=baudrate, responseDelay=responseDelay)
+    engine = CommandEngine(robot, maxInFlight=4)
+    framer = ResponseFramer()
+    reading = [True]
+
+    def read():
+        while reading[0]:
+            data = robot.read(robot.in_waiting or 1)
+            if data:
+                engine.dispatch(framer.feed(data))
+
+    reader = threading.Thread(None, read)
+    reader.start()
+    engine.submit("setldsrotation on").result()
+    commands = ("getmotors", "getdigitalsensors", "getldsscan")
+
+    def sequential():
+        for _ in range(cycles):
+            for cmd in commands:
+                engine.submit(cmd).raw()
+
+    def pipelined():
+        for _ in range(cycles):
+            for pending in [engine.submit(cmd) for cmd in commands]:
+                pending.raw()
+
+    try:
+        one, _ = timeIt(sequential, 1)
+        many, _ = timeIt(pipelined, 1)
+    finally:
+        reading[0] = False
+        reader.join()
+
+    link = "link_%s" % (baudrate or "usb")
+    results[link + "_sequential_cycles_per_s"] = cycles / one
+    results[link + "_pipelined_cycles_per_s"] = cycles / many
+    print("link: %s, simulated neato at %s baud, %.0f ms response delay" %
+          (" + ".join(commands), baudrate or "USB", responseDelay * 1000))
+    print("  one command at a time: %6.1f cycles/s" % (cycles / one))
+    print("  pipelined:             %6.1f cycles/s (%.1fx)" %
+          (cycles / many, one / many))
+
+
+def startDriver(params):
+    """ A driver.Neato on the simulated neato with ROS stubbed out (see
+        ros_stub.py). Returns the robot and the ros_stub state. """
+    state = ros_stub.install(dict({"~port": "sim"}, **params))
+    import driver
+    return driver.Neato(), state
+
+
+def stopDriver(robot):
+    robot.reading = False
+    if robot.readThread:
+        robot.readThread.join()
+    else:
+        robot.engine.cancel()
+
+
+def benchDriverScans(frames):
+    """ Neato.getScanRanges on recorded getldsscan responses, which adds
+        the ScanBuffer hand-off and stamping to the parsing. """
+    robot, state = startDriver({})
+    try:
+        futures = []
+        for frame in frames:
+            future = CommandFuture("getldsscan")
+            future.sent = future.started = time.time()
+            future.set(frame.partition(b"\n")[2])  # without the echo
+            futures.append(future)
+
+        def scans():
+            for future in futures:
+                robot.getScanRanges(future)
+
+        elapsed, _ = timeIt(scans)
+    finally:
+        stopDriver(robot)
+    results["driver_scans_per_s"] = len(frames) / elapsed
+    print("driver: Neato.getScanRanges")
+    print("  %8.0f scans/s" % (len(frames) / elapsed))
+
+
+def benchSpin(cycles, baudrate, responseDelay=0.001, memory=False):
+    """ Neato.spin() cycles per second against the simulated neato at
+        baudrate (None for USB) with rospy.Rate not sleeping, and with
+        memory the memory it allocates. """
+    def run(trace=False):
+        robot, state = startDriver({"~sim_baud": baudrate or 0})
+        robot.port.responseDelay = responseDelay
+        try:
+            state.maxCycles = cycles
+            if trace:
+                tracemalloc.start()
+                before = tracemalloc.get_traced_memory()[0]
+            start = time.time()
+            robot.spin()
+            elapsed = time.time() - start
+            if trace:
+                current, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                return current - before, peak - before
+            return elapsed
+        finally:
+            stopDriver(robot)
+
+    elapsed = run()
+    if memory:
+        # memory still held after each cycle (what leaks) and the most in
+        # use at once, over a second run on a new driver since spin() ends
+        # by stopping the reader and turning the neato off.
+        retained, peak = run(trace=True)
+
+    link = "spin_%s" % (baudrate or "usb")
+    results[link + "_cycles_per_s"] = cycles / elapsed
+    print("spin: simulated neato at %s baud, %.0f ms response delay" %
+          (baudrate or "USB", responseDelay * 1000))
+    print("  %6.1f cycles/s" % (cycles / elapsed))
+    if memory:
+        retained = max(0, retained) / float(cycles)
+        results[link + "_retained_bytes_per_cycle"] = retained
+        results[link + "_peak_bytes"] = peak
+        print("  %.0f bytes retained per cycle, %.0f KB peak" %
+              (retained, peak / 1024.0))
+
+
+def benchCmdVel(commands=100, baudrate=None):
+    """ Time from Neato.cmdVelCb to its setmotor being written, while
+        spin() runs against the simulated neato. """
+    robot, state = startDriver({"~sim_baud": baudrate or 0,
+                                "~cmd_vel_rate": 0})
+    spinner = threading.Thread(None, robot.spin)
+    spinner.start()
+    latencies = []
+    try:
+        while robot.unread:
+            time.sleep(0.01)  # cmd_vel is left to spin() until then
+        for i in range(commands):
+            twist = ros_stub.Message(
+                linear=ros_stub.Message(x=0.05 + 0.001 * i),
+                angular=ros_stub.Message(z=0.0))
+            start = monotonic()
+            robot.cmdVelCb(twist)
+            last = robot.output.last.get("motors")
+            if last and last.sent is not None and last.sent >= start:
+                latencies.append(last.sent - start)
+            time.sleep(0.01)
+    finally:
+        state.shutdown = True
+        spinner.join()
+        stopDriver(robot)
+
+    latencies.sort()
+    n = len(latencies)
+    if not n:
+        raise RuntimeError("no cmd_vel reached the wire")
+    link = "cmd_vel_%s" % (baudrate or "usb")
+    results[link + "_to_wire_p50_ms"] = latencies[n // 2] * 1000
+    results[link + "_to_wire_p95_ms"] = latencies[int(n * 0.95)] * 1000
+    results[link + "_to_wire_max_ms"] = latencies[-1] * 1000
+    print("cmd_vel: simulated neato at %s baud, spin() running" %
+          (baudrate or "USB"))
+    print("  to wire: %.3f ms median, %.3f ms p95, %.3f ms max (%d of %d)" %
+          (latencies[n // 2] * 1000, latencies[int(n * 0.95)] * 1000,
+           latencies[-1] * 1000, n, commands))
+
+
+def compareBaseline(path, tolerance):
+    """ Print the results that got worse by more than tolerance (a fraction)
+        than in the --json file path. Returns how many did. """
+    with open(path) as f:
+        baseline = json.load(f)["results"]
+    worse = 0
+    for name in sorted(results):
+        old = baseline.get(name)
+        if not old:
+            continue
+        change = results[name] / old - 1
+        if not name.endswith("_per_s"):
+            change = -change
+        if change < -tolerance:
+            worse += 1
+            print("REGRESSION %s: %.4g, was %.4g (%+.0f%%)" %
+                  (name, results[name], old, change * 100))
+    return worse
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Neato driver benchmarks")
+    parser.add_argument("--stream", help="file of raw bytes read from a neato")
+    parser.add_argument("--capture", help="capture file recorded by the driver")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="results file to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="fraction a result may get worse (default 0.2)")
+    args = parser.parse_args()
+
+    if args.capture:
+        stream = captureStream(args.capture)
+        benchReplay(args.capture)
+    elif args.stream:
+        with open(args.stream, "rb") as f:
+            stream = f.read()
+    else:
+        stream = syntheticStream()
+
+    benchReader(stream)
+    frames = scanFrames(stream)
+    benchScan(frames)
+    benchScanFilter(frames)
+    benchDeskew()
+    benchSensors()
+    benchLink(5, 115200, 0.001)
+    benchLink(50, None, 0.005)
+    benchDriverScans(frames)
+    benchSpin(10, 115200)
+    benchSpin(200, None, memory=True)
+    benchCmdVel()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"time": time.time(),
+                       "python": platform.python_version(),
+                       "results": dict((name, float(value))
+                                       for name, value in results.items())},
+                      f, indent=2, sort_keys=True)
+    if args.baseline and compareBaseline(args.baseline, args.tolerance):
+        sys.exit(1)
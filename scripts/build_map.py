@@ -0,0 +1,249 @@
+# Builds a map for neato_nav offline from recorded laser scans and
+# odometry, instead of driving the robot around with gmapping running.
+# Scan matching and ray casting run on a pool of processes, see
+# neato/src/neato_map.py for how the map is built.
+
+# License: BSD
+
+# Run this script:
+#   python build_map.py recording [--output ../neato_nav/maps/map]
+#                       [--processes N] [--window 10] [--resolution 0.05]
+# where recording is a capture file recorded by the driver with its ~capture
+# parameter, or a bag with the /scan and /odom topics (needs rosbag). The
+# map is written as output.pgm and output.yaml, which
+#   roslaunch neato base_nav.launch map_name:=map
+# loads for amcl and the static_map layer of the global costmap.
+
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+from collections import deque
+from math import atan2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "neato", "src"))
+
+import numpy as np  # noqa: E402
+
+from neato_lds import BEAMS, ScanParser, scanTiming  # noqa: E402
+from neato_map import (OccupancyGrid, chain, keyframes,  # noqa: E402
+                       matchWindow, relative, scanPoints, writeMap)
+from neato_odom import WheelOdometry  # noqa: E402
+from neato_serial import (TO_ROBOT, CommandEngine,  # noqa: E402
+                          ResponseFramer, afterHeader, readCapture,
+                          requestTime, splitLines)
+
+BASE_WIDTH = 248  # millimeters, as in driver.py
+LASER_OFFSET = (-0.090, 0.0)  # the driver's default ~laser_offset
+
+
+class Written:
+    """ Stands in for the port of the CommandEngine matching the responses
+        in a capture to their commands, which were already written when it
+        was recorded. """
+
+    def write(self, data):
+        pass
+
+
+def readCaptureFile(path, offset, baseWidth=BASE_WIDTH):
+    """ The getldsscan and getmotors responses in a capture file, as the
+        stamps, points (see neato_map.scanPoints) and odometry poses of the
+        scans. Responses are stamped the way the driver does, halfway
+        between the command being written and its response arriving.
+
+        Each response is matched to its command by a CommandEngine, as the
+        driver did, so a response that was lost only loses its own
+        command. """
+    engine = CommandEngine(Written())
+    framer = ResponseFramer()
+    parser = ScanParser()
+    odometry = WheelOdometry(baseWidth / 1000.0, history=None)
+    angles = np.radians(np.arange(BEAMS))
+    sent = deque()  # commands in the order they were written
+    stamps, scans = [], []
+
+    for t, direction, data in readCapture(path):
+        if direction == TO_ROBOT:
+            lines = [line for line in data.decode("ascii", "replace")
+                     .splitlines() if line.strip()]
+            for command in engine.submitMany(lines, urgent=True):
+                command.sent = t
+                sent.append(command)
+            continue
+        engine.dispatch(framer.feed(data, t), framer.starts)
+
+        while sent and sent[0].done.is_set():
+            command = sent.popleft()
+            name = command.command.split()[0].lower()
+            frame = command.frame
+            if frame is None:
+                continue  # lost
+            if name == "getldsscan":
+                if parser.parse(frame) < BEAMS // 4:
+                    continue  # the LDS is off or still spinning up
+                start, period = scanTiming(command, parser.rotationSpeed)
+                stamps.append(start + period / 2)
+                scans.append(scanPoints(parser.ranges, angles, offset))
+            elif name == "getmotors":
+                values = {}
+                for line in afterHeader(splitLines(frame), "Parameter") or []:
+                    fields = line.split(",")
+                    if len(fields) > 1:
+                        values[fields[0]] = fields[1]
+                try:
+                    odometry.update(float(values["LeftWheel_PositionInMM"]),
+                                    float(values["RightWheel_PositionInMM"]),
+                                    requestTime(command))
+                except (KeyError, ValueError):
+                    pass
+
+    if not stamps or not odometry.history:
+        return [], [], np.zeros((0, 3))
+    x, y, th = odometry.posesAt(np.array(stamps))
+    return stamps, scans, np.column_stack((x, y, th))
+
+
+def readBag(path, offset, scanTopic="/scan", odomTopic="/odom"):
+    """ The stamps, points and odometry poses of the LaserScans and Odometry
+        messages recorded in a bag. """
+    import rosbag  # only needed for bags
+
+    stamps, scans, odom = [], [], []
+    with rosbag.Bag(path) as bag:
+        for topic, msg, t in bag.read_messages(topics=[scanTopic, odomTopic]):
+            stamp = msg.header.stamp.to_sec()
+            if topic == odomTopic:
+                q = msg.pose.pose.orientation
+                odom.append((stamp, msg.pose.pose.position.x,
+                             msg.pose.pose.position.y,
+                             2 * atan2(q.z, q.w)))  # yaw of a planar pose
+            else:
+                ranges = np.asarray(msg.ranges, np.float64)
+                angles = msg.angle_min + msg.angle_increment * np.arange(
+                    len(ranges))
+                # the middle beam, the pose is interpolated to it
+                stamps.append(stamp + msg.time_increment * len(ranges) / 2)
+                scans.append(scanPoints(ranges, angles, offset,
+                                        max(msg.range_min, 0.02),
+                                        msg.range_max))
+
+    if not stamps or not odom:
+        return [], [], np.zeros((0, 3))
+    t, x, y, th = np.array(sorted(odom)).T
+    th = np.unwrap(th)
+    return stamps, scans, np.column_stack((np.interp(stamps, t, x),
+                                           np.interp(stamps, t, y),
+                                           np.interp(stamps, t, th)))
+
+
+# set in every worker by the pool initializer, so the scans are sent to each
+# process once rather than with every task
+_scans = None
+_options = None
+
+
+def _initWorker(scans, options):
+    global _scans, _options
+    _scans, _options = scans, options
+
+
+def _match(task):
+    first, poses = task  # poses of the scans first.. up to the matched one
+    window = [(_scans[first + i], pose) for i, pose in enumerate(poses[:-1])]
+    return matchWindow(window, _scans[first + len(poses) - 1], poses[-1],
+                       **_options)
+
+
+def _cast(job):
+    origin, shape, resolution, indices, poses, offset = job
+    grid = OccupancyGrid(origin, shape, resolution)
+    grid.cast([_scans[i] for i in indices], poses, offset)
+    return grid
+
+
+def buildMap(scans, odometry, offset, processes=None, window=10,
+             resolution=0.05, search=0.1, angle=0.1):
+    """ Corrected poses of scans and the OccupancyGrid they make. """
+    processes = processes or multiprocessing.cpu_count()
+    chunksize = max(1, len(scans) // (8 * processes))
+    pool = multiprocessing.Pool(processes, _initWorker,
+                                (scans, {"search": search, "angle": angle}))
+    try:
+        # each scan against the one before, the corrections to the odometry
+        # between them are chained
+        matched = pool.map(_match, [(k - 1, odometry[k - 1:k + 1])
+                                    for k in range(1, len(scans))], chunksize)
+        poses = chain(tuple(odometry[0]), [
+            relative(odometry[k], pose) for k, pose in enumerate(matched)])
+
+        # then against the window before it, which evens out the errors
+        # the chain left between neighbouring scans
+        matched = pool.map(_match, [(max(0, k - window), poses[
+            max(0, k - window):k + 1]) for k in range(1, len(scans))],
+            chunksize)
+        poses = np.array([poses[0]] + matched)
+
+        # one grid per process, summed
+        grid = OccupancyGrid.around(scans, poses, resolution)
+        jobs = [(grid.origin, grid.shape, resolution, chunk, poses[chunk],
+                 offset)
+                for chunk in np.array_split(np.arange(len(scans)), processes)
+                if len(chunk)]
+        for part in pool.imap_unordered(_cast, jobs):
+            grid.add(part)
+    finally:
+        pool.close()
+        pool.join()
+    return poses, grid
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a map offline")
+    parser.add_argument("recording", help="capture file or bag")
+    parser.add_argument("--output", default=os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "..", "neato_nav", "maps",
+        "map"), help="path of the map without extension")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="worker processes (default one per CPU)")
+    parser.add_argument("--window", type=int, default=10,
+                        help="scans each scan is matched against")
+    parser.add_argument("--resolution", type=float, default=0.05,
+                        help="meters per cell (default 0.05, as the costmap)")
+    parser.add_argument("--search", type=float, default=0.1,
+                        help="meters around the odometry to search")
+    parser.add_argument("--angle", type=float, default=0.1,
+                        help="radians around the odometry to search")
+    parser.add_argument("--laser-offset", type=float, nargs=2,
+                        default=LASER_OFFSET, metavar=("X", "Y"),
+                        help="where the LDS is on base_link")
+    parser.add_argument("--scan-topic", default="/scan")
+    parser.add_argument("--odom-topic", default="/odom")
+    args = parser.parse_args()
+
+    start = time.time()
+    if args.recording.endswith(".bag"):
+        stamps, scans, odometry = readBag(args.recording, args.laser_offset,
+                                          args.scan_topic, args.odom_topic)
+    else:
+        stamps, scans, odometry = readCaptureFile(args.recording,
+                                                  args.laser_offset)
+    if not scans:
+        sys.exit("%s has no scans with odometry" % args.recording)
+
+    kept = keyframes(odometry)
+    scans = [scans[i] for i in kept]
+    odometry = odometry[kept]
+    print("%d scans, %d after dropping the ones taken standing still "
+          "(%.1f s)" % (len(stamps), len(scans), time.time() - start))
+
+    poses, grid = buildMap(scans, odometry, args.laser_offset,
+                           args.processes, args.window, args.resolution,
+                           args.search, args.angle)
+    writeMap(args.output, grid)
+    drift = np.hypot(*(poses[-1][:2] - odometry[-1][:2]))
+    print("%dx%d map written to %s.yaml (%.1f s), the odometry was %.2f m "
+          "off at the end" % (grid.shape[1], grid.shape[0], args.output,
+                              time.time() - start, drift))
@@ -0,0 +1,158 @@
+# Stand-ins for rospy, tf and the message packages used by driver.py, so
+# the driver can be run (and benchmarked) without a ROS installation.
+# Only what driver.py uses is provided, publishers drop their messages.
+
+# License: BSD
+
+# Use it before importing driver.py:
+#   import ros_stub
+#   ros_stub.install({"~port": "sim"})
+
+import sys
+import time
+import types
+
+
+class Message(object):
+    """ Any message: keyword arguments become fields, fields that were
+        never set are empty nested messages. """
+
+    def __init__(self, *args, **kwargs):
+        self.args = args
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        value = Message()
+        setattr(self, name, value)
+        return value
+
+
+def message(name, **constants):
+    return type(name, (Message,), constants)
+
+
+class Publisher(object):
+
+    def __init__(self, topic, msgType, *args, **kwargs):
+        self.topic = topic
+        self.count = 0
+
+    def publish(self, msg):
+        self.count += 1
+
+    def get_num_connections(self):
+        return 0
+
+
+class Time(object):
+
+    def __init__(self, secs=0.0):
+        self.secs = secs
+
+    @classmethod
+    def from_sec(cls, secs):
+        return cls(secs)
+
+    @classmethod
+    def now(cls):
+        return cls(time.time())
+
+
+class Rate(object):
+    """ Does not sleep, so the loop runs as fast as the link allows. """
+
+    def __init__(self, hz):
+        self.hz = hz
+
+    def sleep(self):
+        state.cycles += 1
+
+
+class Timer(object):
+
+    def __init__(self, period, callback):
+        pass
+
+    def shutdown(self):
+        pass
+
+
+class State(object):
+    params = {}
+    cycles = 0  # Rate.sleep calls
+    maxCycles = None  # is_shutdown() once this many cycles ran
+    shutdown = False
+
+
+state = State()
+
+
+def get_param(name, default=None):
+    return state.params.get(name, default)
+
+
+def is_shutdown():
+    return state.shutdown or (
+        state.maxCycles is not None and state.cycles >= state.maxCycles)
+
+
+def signal_shutdown(reason):
+    state.shutdown = True
+
+
+def log(msg):
+    pass
+
+
+def module(name, **attributes):
+    mod = types.ModuleType(name)
+    mod.__dict__.update(attributes)
+    sys.modules[name] = mod
+    return mod
+
+
+def install(params=None):
+    """ Put the stand-ins in sys.modules, params are the parameters
+        get_param returns (by their full name, e.g. "~port"). """
+    state.params = dict(params or {})
+    state.cycles = 0
+    state.maxCycles = None
+    state.shutdown = False
+
+    rospy = module(
+        "rospy", init_node=lambda *a, **k: None, get_param=get_param,
+        is_shutdown=is_shutdown, signal_shutdown=signal_shutdown,
+        loginfo=log, logwarn=log, logerr=log, Publisher=Publisher,
+        Subscriber=lambda *a, **k: None, Service=lambda *a, **k: None,
+        Rate=Rate, Timer=Timer, Duration=lambda secs: secs, Time=Time,
+        get_time=time.time, Header=message("Header"))
+    rospy.numpy_msg = module("rospy.numpy_msg", numpy_msg=lambda cls: cls)
+    module("serial", Serial=None)
+    module("tf")
+    module("tf.broadcaster", TransformBroadcaster=lambda: types.SimpleNamespace(
+        sendTransformMessage=log))
+    module("nav_msgs")
+    module("nav_msgs.msg", Odometry=message("Odometry"))
+    module("geometry_msgs")
+    module("geometry_msgs.msg", Twist=message("Twist"),
+           TransformStamped=message("TransformStamped"))
+    module("diagnostic_msgs")
+    module("diagnostic_msgs.msg", DiagnosticArray=message("DiagnosticArray"),
+           DiagnosticStatus=message("DiagnosticStatus", OK=0, WARN=1,
+                                    ERROR=2),
+           KeyValue=message("KeyValue"))
+    module("neato")
+    module("neato.msg", ButtonEvent=message("ButtonEvent"),
+           BumperEvent=message("BumperEvent"), Sensors=message("Sensors"))
+    module("sensor_msgs")
+    module("sensor_msgs.msg", LaserScan=message("LaserScan"),
+           BatteryState=message("BatteryState"),
+           PointCloud2=message("PointCloud2"),
+           PointField=message("PointField", FLOAT32=7))
+    module("std_srvs")
+    module("std_srvs.srv", Trigger=message("Trigger"),
+           TriggerResponse=message("TriggerResponse"))
+    return state